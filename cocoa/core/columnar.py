@@ -0,0 +1,253 @@
+'''
+Columnar storage of examples.
+
+Events of all examples are stored as parallel arrays with one row per event:
+    agents.npy: agent of the event (int8)
+    actions.npy: index of the action in the manifest's action table (int16)
+    times.npy: time of the event if it is a number (float64)
+    time_kinds.npy: type of the time (see TIME_KINDS)
+    data_offsets.npy: start of the event's fields in data.bin, plus the end (int64)
+    data.bin: pickled dict of the other fields of each event (data, start_time, metadata etc.)
+and example i owns rows event_offsets[i]:event_offsets[i+1]. The remaining fields
+of each example (scenario, outcome, uuid etc.) are pickled in examples.bin
+(located by example_offsets.npy). The arrays are memory-mapped when loaded.
+
+Examples are converted to and from their JSON dict (Example.to_dict) without loss.
+'''
+
+import os
+import cPickle as pickle
+import numpy as np
+
+from cocoa.core.util import read_json, write_json
+from cocoa.core.event import Event
+from cocoa.core.dataset import Example
+
+# How the time of an event is stored: None, int or float in times.npy, other (e.g. str) in data.bin
+TIME_KINDS = ('none', 'int', 'float', 'other')
+TIME_NONE, TIME_INT, TIME_FLOAT, TIME_OTHER = range(len(TIME_KINDS))
+
+# Larger integers are not exact as float64
+MAX_EXACT_INT = 2**53
+
+COLUMNS = ('agents', 'actions', 'times', 'time_kinds', 'data_offsets', 'event_offsets', 'example_offsets')
+
+
+def _dumps(obj):
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+class ColumnarWriter(object):
+    '''
+    Append examples (Example or its dict) and write the columns to directory `path`.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.action_to_id = {}
+        self.agents = []
+        self.actions = []
+        self.times = []
+        self.time_kinds = []
+        self.data_offsets = [0]
+        self.event_offsets = [0]
+        self.example_offsets = [0]
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.data_file = open(os.path.join(path, 'data.bin'), 'wb')
+        self.examples_file = open(os.path.join(path, 'examples.bin'), 'wb')
+
+    def get_action_id(self, action):
+        if action not in self.action_to_id:
+            self.action_to_id[action] = len(self.action_to_id)
+        return self.action_to_id[action]
+
+    def add_event(self, raw):
+        '''
+        raw: event dict (Event.to_dict)
+        '''
+        fields = dict(raw)
+        self.agents.append(fields.pop('agent'))
+        self.actions.append(self.get_action_id(fields.pop('action')))
+        time = fields.pop('time')
+        if time is None:
+            kind = TIME_NONE
+        elif type(time) in (int, long) and abs(time) <= MAX_EXACT_INT:
+            kind = TIME_INT
+        elif type(time) is float:
+            kind = TIME_FLOAT
+        else:
+            kind = TIME_OTHER
+            fields['time'] = time
+        self.times.append(float(time) if kind in (TIME_INT, TIME_FLOAT) else np.nan)
+        self.time_kinds.append(kind)
+        data = _dumps(fields)
+        self.data_file.write(data)
+        self.data_offsets.append(self.data_offsets[-1] + len(data))
+
+    def add(self, example):
+        if isinstance(example, Example):
+            example = example.to_dict()
+        fields = dict(example)
+        for raw in fields.pop('events'):
+            self.add_event(raw)
+        self.event_offsets.append(len(self.agents))
+        data = _dumps(fields)
+        self.examples_file.write(data)
+        self.example_offsets.append(self.example_offsets[-1] + len(data))
+
+    def close(self):
+        self.data_file.close()
+        self.examples_file.close()
+        columns = {
+                'agents': np.array(self.agents, dtype=np.int8),
+                'actions': np.array(self.actions, dtype=np.int16),
+                'times': np.array(self.times, dtype=np.float64),
+                'time_kinds': np.array(self.time_kinds, dtype=np.int8),
+                'data_offsets': np.array(self.data_offsets, dtype=np.int64),
+                'event_offsets': np.array(self.event_offsets, dtype=np.int64),
+                'example_offsets': np.array(self.example_offsets, dtype=np.int64),
+                }
+        for name, array in columns.iteritems():
+            np.save(os.path.join(self.path, '{}.npy'.format(name)), array)
+        actions = sorted(self.action_to_id, key=lambda a: self.action_to_id[a])
+        # Written last: a directory without a manifest is incomplete
+        write_json({'actions': actions, 'num_examples': len(self.event_offsets) - 1}, os.path.join(self.path, 'manifest.json'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_columnar(examples, path):
+    with ColumnarWriter(path) as writer:
+        for example in examples:
+            writer.add(example)
+
+
+def is_columnar(path):
+    '''
+    Whether |path| is a (complete) directory written by ColumnarWriter.
+    '''
+    return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+
+class ColumnarDataset(object):
+    '''
+    A read-only sequence of examples stored by ColumnarWriter.
+    Supports len(), iteration, integer indexing, slicing and lookup by example uuid.
+    Files are opened on first access, so that slices can be sent to other processes.
+    '''
+    def __init__(self, path, Scenario, max_examples=None, Event=Event, ids=None):
+        '''
+        :param ids: indices of the stored examples in this dataset (all, up to |max_examples|, if not given)
+        '''
+        self.path = path
+        self.Scenario = Scenario
+        self.Event = Event
+        if ids is None:
+            num_examples = read_json(os.path.join(path, 'manifest.json'))['num_examples']
+            if max_examples is not None and max_examples >= 0:
+                num_examples = min(num_examples, max_examples)
+            ids = np.arange(num_examples)
+        self.ids = ids
+        self.uuid_to_id = None
+        self.opened = False
+
+    def _open(self):
+        self.action_table = read_json(os.path.join(self.path, 'manifest.json'))['actions']
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.path, '{}.npy'.format(name)), mmap_mode='r'))
+        self.data_file = open(os.path.join(self.path, 'data.bin'), 'rb')
+        self.examples_file = open(os.path.join(self.path, 'examples.bin'), 'rb')
+        self.opened = True
+
+    def __getstate__(self):
+        return {'path': self.path, 'Scenario': self.Scenario, 'Event': self.Event, 'ids': self.ids}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['Scenario'], Event=state['Event'], ids=state['ids'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _read(self, fin, offsets, start, end):
+        '''
+        Unpickle records start..end-1 located by offsets.
+        '''
+        offsets = offsets[start:end+1].tolist()
+        fin.seek(offsets[0])
+        buf = fin.read(offsets[-1] - offsets[0])
+        base = offsets[0]
+        return [pickle.loads(buf[offsets[j]-base:offsets[j+1]-base]) for j in xrange(end - start)]
+
+    def _example_fields(self, i):
+        if not self.opened:
+            self._open()
+        return self._read(self.examples_file, self.example_offsets, i, i+1)[0]
+
+    def iter_event_fields(self, i):
+        '''
+        Yield (agent, action, time, other fields) of the events of stored example i.
+        '''
+        if not self.opened:
+            self._open()
+        start, end = int(self.event_offsets[i]), int(self.event_offsets[i+1])
+        agents = self.agents[start:end].tolist()
+        action_table = self.action_table
+        actions = [action_table[a] for a in self.actions[start:end].tolist()]
+        times = self.times[start:end].tolist()
+        time_kinds = self.time_kinds[start:end].tolist()
+        fields = self._read(self.data_file, self.data_offsets, start, end)
+        for agent, action, time, kind, other in zip(agents, actions, times, time_kinds, fields):
+            if kind == TIME_NONE:
+                time = None
+            elif kind == TIME_INT:
+                time = int(time)
+            elif kind == TIME_OTHER:
+                time = other.pop('time')
+            yield agent, action, time, other
+
+    def get_raw(self, i):
+        '''
+        The JSON dict of example i, same as Example.to_dict.
+        '''
+        i = int(self.ids[i])
+        raw = self._example_fields(i)
+        events = []
+        for agent, action, time, other in self.iter_event_fields(i):
+            other.update({'agent': agent, 'action': action, 'time': time})
+            events.append(other)
+        raw['events'] = events
+        return raw
+
+    def get_events(self, i):
+        return [self.Event(agent, time, action, other.get('data'),
+                    start_time=other.get('start_time'), metadata=other.get('metadata'))
+                for agent, action, time, other in self.iter_event_fields(i)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ColumnarDataset(self.path, self.Scenario, Event=self.Event, ids=self.ids[i])
+        i = int(self.ids[i])
+        raw = self._example_fields(i)
+        scenario = self.Scenario.from_dict(None, raw['scenario'])
+        agents = {int(k): v for k, v in raw['agents'].iteritems()} if raw.get('agents') is not None else None
+        return Example(scenario, raw['scenario_uuid'], self.get_events(i), raw['outcome'], raw['uuid'],
+                agents, agents_info=raw.get('agents_info'))
+
+    def get(self, uuid):
+        if self.uuid_to_id is None:
+            self.uuid_to_id = {self._example_fields(int(self.ids[i]))['uuid']: i for i in xrange(len(self))}
+        return self[self.uuid_to_id[uuid]]
+
+    def close(self):
+        if self.opened:
+            self.data_file.close()
+            self.examples_file.close()
+            self.opened = False
@@ -2,7 +2,10 @@
 Data structures for events, examples, and datasets.
 '''
 
-from util import read_json
+import os
+import ujson as json
+
+from util import read_json, write_json, iter_json, iter_json_with_offsets
 from event import Event
 from kb import KB
 
@@ -11,6 +14,8 @@ class Example(object):
     An example is a dialogue grounded in a scenario, has a set of events, and has some reward at the end.
     Created by through live conversation, serialized, and then read for training.
     '''
+    __slots__ = ('scenario', 'uuid', 'events', 'outcome', 'ex_id', 'agents', 'agents_info', '__dict__')
+
     def __init__(self, scenario, uuid, events, outcome, ex_id, agents, agents_info=None):
         self.scenario = scenario
         self.uuid = uuid
@@ -20,6 +25,15 @@ class Example(object):
         self.agents = agents
         self.agents_info = agents_info
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        state.update((k, getattr(self, k)) for k in self.__slots__ if k != '__dict__')
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+
     def add_event(self, event):
         self.events.append(event)
 
@@ -69,6 +83,84 @@ class Example(object):
             'agents_info': self.agents_info,
         }
 
+class LazyDataset(object):
+    '''
+    A read-only sequence of examples that are parsed from JSON / JSON-lines files on demand.
+    Records are located by a byte-offset index, which is built once per file
+    and saved next to it (see load_index).
+    Supports len(), iteration, integer indexing, slicing and lookup by example uuid.
+    '''
+    def __init__(self, paths, Scenario, max_examples=None, index=None):
+        '''
+        :param index: list of (path_id, offset, length, uuid); built from |paths| if not given
+        '''
+        self.paths = paths
+        self.Scenario = Scenario
+        if index is None:
+            index = []
+            for path_id, path in enumerate(paths):
+                print 'index examples: %s' % path
+                if max_examples >= 0 and len(index) >= max_examples:
+                    break
+                for uuid, offset, length in load_index(path, max_examples - len(index) if max_examples >= 0 else None):
+                    index.append((path_id, offset, length, uuid))
+        self.index = index
+        self.uuid_to_id = None
+        self.files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in xrange(len(self.index)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyDataset(self.paths, self.Scenario, index=self.index[i])
+        return Example.from_dict(self.get_raw(i), self.Scenario)
+
+    def get_raw(self, i):
+        path_id, offset, length, _ = self.index[i]
+        if path_id not in self.files:
+            self.files[path_id] = open(self.paths[path_id])
+        fin = self.files[path_id]
+        fin.seek(offset)
+        return json.loads(fin.read(length))
+
+    def get(self, uuid):
+        if self.uuid_to_id is None:
+            self.uuid_to_id = {entry[3]: i for i, entry in enumerate(self.index)}
+        return self[self.uuid_to_id[uuid]]
+
+    def close(self):
+        for fin in self.files.itervalues():
+            fin.close()
+        self.files = {}
+
+def load_index(path, max_examples=None):
+    '''
+    Return a list of (uuid, offset, length) of examples in |path|.
+    The index of the full file is cached in <path>.index and rebuilt when the file changes.
+    '''
+    index_path = path + '.index'
+    stat = os.stat(path)
+    if os.path.exists(index_path):
+        cached = read_json(index_path)
+        if cached['size'] == stat.st_size and cached['mtime'] == int(stat.st_mtime):
+            return cached['examples'][:max_examples]
+
+    index = []
+    for raw, start, end in iter_json_with_offsets(path):
+        if max_examples is not None and len(index) >= max_examples:
+            return index
+        index.append((raw['uuid'], start, end - start))
+    try:
+        write_json({'size': stat.st_size, 'mtime': int(stat.st_mtime), 'examples': index}, index_path)
+    except IOError:
+        print 'WARNING: cannot write index file %s' % index_path
+    return index
+
 class Dataset(object):
     '''
     A dataset consists of a list of train and test examples.
@@ -105,8 +197,79 @@ class EvalExample(object):
         scores = raw['results']
         return EvalExample(ex_id, kb, agent, role, prev_turns, prev_roles, target, candidates, scores)
 
+class TranscriptWriter(object):
+    '''
+    Streams examples to a JSON-lines file (one example per line),
+    so that examples do not need to be kept in memory until the end of a run.
+    '''
+    def __init__(self, path, flush_every=10, resume=False):
+        '''
+        :param flush_every: flush the file after every |flush_every| examples
+        :param resume: append to an existing transcript file instead of overwriting it
+        '''
+        self.path = path
+        self.flush_every = flush_every
+        self.num_written = 0
+        self.last_uuid = None
+        if resume and os.path.exists(path):
+            self._scan()
+            self.out = open(path, 'a')
+        else:
+            self.out = open(path, 'w')
+
+    def _scan(self):
+        '''
+        Find the last example written and drop an incomplete trailing line,
+        e.g. left by a crash in the middle of a write.
+        '''
+        valid_size = 0
+        with open(self.path) as fin:
+            for line in iter(fin.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                if line.strip():
+                    try:
+                        raw = json.loads(line)
+                    except ValueError:
+                        break
+                    if not isinstance(raw, dict):
+                        raise ValueError('Cannot resume %s: not a JSON-lines transcript file' % self.path)
+                    self.last_uuid = raw['uuid']
+                    self.num_written += 1
+                valid_size = fin.tell()
+        with open(self.path, 'r+') as fout:
+            fout.truncate(valid_size)
+
+    def write(self, example):
+        '''
+        :param example: an Example or its dict (Example.to_dict())
+        '''
+        if isinstance(example, Example):
+            example = example.to_dict()
+        self.out.write(json.dumps(example) + '\n')
+        self.num_written += 1
+        self.last_uuid = example['uuid']
+        if self.num_written % self.flush_every == 0:
+            self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 ############################################################
 
+def iter_examples(path, Scenario):
+    '''
+    Lazily read examples from a JSON array file or a JSON-lines file.
+    '''
+    for raw in iter_json(path):
+        yield Example.from_dict(raw, Scenario)
+
 def read_examples(paths, max_examples, Scenario):
     '''
     Read a maximum of |max_examples| examples from |paths|.
@@ -114,12 +277,26 @@ def read_examples(paths, max_examples, Scenario):
     examples = []
     for path in paths:
         print 'read_examples: %s' % path
-        for raw in read_json(path):
+        if max_examples >= 0 and len(examples) >= max_examples:
+            break
+        for example in iter_examples(path, Scenario):
+            examples.append(example)
             if max_examples >= 0 and len(examples) >= max_examples:
                 break
-            examples.append(Example.from_dict(raw, Scenario))
     return examples
 
+def load_examples(paths, Scenario, max_examples=None):
+    '''
+    A ColumnarDataset if |paths| is one columnar directory (see cocoa.core.columnar),
+    otherwise a LazyDataset of the JSON / JSON-lines files.
+    '''
+    # Imported here since columnar imports Example from this module
+    from cocoa.core.columnar import ColumnarDataset, is_columnar
+    if paths and len(paths) == 1 and is_columnar(paths[0]):
+        print 'load columnar examples: %s' % paths[0]
+        return ColumnarDataset(paths[0], Scenario, max_examples)
+    return LazyDataset(paths, Scenario, max_examples)
+
 def read_dataset(args, Scenario):
     """
     Given the paths of the dataset, parse the json files and convert them into python objects
@@ -130,8 +307,8 @@ def read_dataset(args, Scenario):
         and commands, like offering a price and accepting one. Each example also contains the outcome of the scenario
         which includes the reward and the agreed upon price
     """
-    train_examples = read_examples(args.train_examples_paths, args.train_max_examples, Scenario)
-    test_examples = read_examples(args.test_examples_paths, args.test_max_examples, Scenario)
+    train_examples = load_examples(args.train_examples_paths, Scenario, args.train_max_examples)
+    test_examples = load_examples(args.test_examples_paths, Scenario, args.test_max_examples)
     print("We found {0} train examples and {1} test examples".format(len(train_examples), len(test_examples)))
     dataset = Dataset(train_examples, test_examples)
     return dataset
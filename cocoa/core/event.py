@@ -11,6 +11,9 @@ class Event(object):
     message to send)
     """
 
+    # Other attributes (e.g. tags) go to a __dict__ that is only created when they are set
+    __slots__ = ('agent', 'time', 'action', 'data', 'start_time', 'metadata', '__dict__')
+
     decorative_events = ('join', 'leave', 'typing', 'eval')
 
     def __init__(self, agent, time, action, data, start_time=None, metadata=None):
@@ -21,6 +24,15 @@ class Event(object):
         self.start_time = start_time
         self.metadata = metadata
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        state.update((k, getattr(self, k)) for k in self.__slots__ if k != '__dict__')
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+
     @staticmethod
     def from_dict(raw):
         return Event(raw['agent'], raw['time'], raw['action'], raw['data'], start_time=raw.get('start_time'), metadata=raw.get('metadata'))
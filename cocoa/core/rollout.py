@@ -0,0 +1,205 @@
+'''
+Parallel self-play: run Controller.simulate for many scenarios in a process pool.
+'''
+
+from __future__ import print_function
+
+import os
+import random
+import multiprocessing
+import ujson as json
+from collections import namedtuple
+import numpy as np
+
+from util import generate_uuid
+
+def add_rollout_arguments(parser):
+    parser.add_argument('--num-workers', type=int, default=1,
+        help='Number of rollout processes (1 runs all dialogues in the main process)')
+    parser.add_argument('--chunk-size', type=int, default=1,
+        help='Number of dialogues sent to a worker at a time')
+    parser.add_argument('--resume', default=False, action='store_true',
+        help='Continue an interrupted run with the same arguments after the last task done')
+
+# index: position of the task in the run (also used to derive its seed)
+# scenario_index: index into the scenario list
+# agents: keys of the two systems playing agent 0 and agent 1
+# session_names: names recorded in the example (None to use the controller's default)
+RolloutTask = namedtuple('RolloutTask', ['index', 'scenario_index', 'agents', 'session_names'])
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+def rollout_uuid():
+    '''
+    Random example uuid that does not depend on the (seeded) random state,
+    so that runs with the same seed do not produce the same uuids.
+    '''
+    return generate_uuid('E', _uuid_rng)
+
+_uuid_rng = random.SystemRandom()
+
+class RolloutLog(object):
+    '''
+    Records which tasks of a run are done next to its transcript file (at
+    |path|.rollout), so that an interrupted run can be resumed. The first line
+    holds the run arguments and each following line the index of a finished task
+    and the uuid of its example (None if the example was not written).
+    '''
+    def __init__(self, path, run_args, last_uuid=None, resume=False):
+        '''
+        :param run_args: a JSON-serializable dict of the arguments that determine the tasks and the dialogues
+        :param last_uuid: uuid of the last example in the transcript file (TranscriptWriter.last_uuid)
+        '''
+        self.path = path + '.rollout'
+        self.num_done = 0
+        if resume and os.path.exists(self.path):
+            entries = self._read(run_args, last_uuid)
+            self.num_done = len(entries)
+            self.out = open(self.path, 'w')
+            self.out.write(json.dumps(run_args) + '\n')
+            for entry in entries:
+                self.out.write(json.dumps(entry) + '\n')
+        else:
+            if resume and last_uuid is not None:
+                raise ValueError('Cannot resume %s: %s is missing' % (path, self.path))
+            self.out = open(self.path, 'w')
+            self.out.write(json.dumps(run_args) + '\n')
+        self.out.flush()
+
+    def _read(self, run_args, last_uuid):
+        '''
+        Return the entries of tasks that are done. The log may be ahead of the
+        transcript file if a run was interrupted before the transcript was
+        flushed; tasks whose example is not in the transcript are not done.
+        '''
+        with open(self.path) as fin:
+            lines = [line for line in fin if line.endswith('\n')]
+        if not lines or json.loads(lines[0]) != json.loads(json.dumps(run_args)):
+            raise ValueError('Cannot resume %s: the run arguments have changed' % self.path)
+        entries = [json.loads(line) for line in lines[1:]]
+        # Tasks up to the last written example, and the skipped tasks right after it
+        found = last_uuid is None
+        num_done = 0
+        for i, entry in enumerate(entries):
+            if entry['uuid'] == last_uuid and last_uuid is not None:
+                found = True
+                num_done = i + 1
+            elif found and entry['uuid'] is None and num_done == i:
+                num_done = i + 1
+        if not found:
+            raise ValueError('Cannot resume: example %s is not in %s' % (last_uuid, self.path))
+        return entries[:num_done]
+
+    def remaining_tasks(self, tasks):
+        return tasks[self.num_done:]
+
+    def add(self, task_index, uuid):
+        '''
+        Record that a task is done, before its example (if any) is written:
+        the log is flushed right away and the transcript file periodically, so
+        that the log is never behind the transcript file.
+        '''
+        self.out.write(json.dumps({'index': task_index, 'uuid': uuid}) + '\n')
+        self.out.flush()
+        self.num_done += 1
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class RolloutWorker(object):
+    '''
+    Holds the systems of one process and simulates dialogues for RolloutTasks.
+    '''
+    def __init__(self, systems, scenarios, Controller, max_turns=None, seed=1, verbose=False):
+        '''
+        :param systems: a dict from agent key to a System
+        :param scenarios: the list of scenarios (ScenarioDB.scenarios_list)
+        :param Controller: task-specific controller class
+        '''
+        self.systems = systems
+        self.scenarios = scenarios
+        self.Controller = Controller
+        self.max_turns = max_turns
+        self.seed = seed
+        self.verbose = verbose
+
+    def run(self, task):
+        # Seed per dialogue so that the output does not depend on the number of workers
+        set_seed(self.seed + task.index)
+        scenario = self.scenarios[task.scenario_index]
+        sessions = [self.systems[name].new_session(agent, scenario.kbs[agent])
+                for agent, name in enumerate(task.agents)]
+        if task.session_names is None:
+            controller = self.Controller(scenario, sessions)
+        else:
+            controller = self.Controller(scenario, sessions, session_names=task.session_names)
+        ex = controller.simulate(self.max_turns, verbose=self.verbose)
+        ex.ex_id = rollout_uuid()
+        return task.index, ex.to_dict(), controller.complete()
+
+# Worker state of each pool process
+_worker = None
+
+def _init_worker(get_system, system_specs, worker_kwargs):
+    global _worker
+    systems = {name: get_system(system_type, model_path=model_path)
+            for name, (system_type, model_path) in system_specs.iteritems()}
+    _worker = RolloutWorker(systems, **worker_kwargs)
+
+def _run_task(task):
+    return _worker.run(task)
+
+class RolloutEngine(object):
+    '''
+    Simulates dialogues for a list of RolloutTasks and yields
+    (index, example dict, complete) in the order of the tasks.
+    Each worker process loads the systems once and is given |chunk_size| tasks at a time.
+    '''
+    def __init__(self, get_system, system_specs, scenarios, Controller, num_workers=1, chunk_size=1, max_turns=None, seed=1, verbose=False):
+        '''
+        :param get_system: function (system_type, model_path=...) -> System
+        :param system_specs: a dict from agent key to (system_type, model_path)
+        '''
+        self.get_system = get_system
+        self.system_specs = system_specs
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.worker_kwargs = {
+                'scenarios': scenarios,
+                'Controller': Controller,
+                'max_turns': max_turns,
+                'seed': seed,
+                'verbose': verbose,
+                }
+
+    def run(self, tasks):
+        if self.num_workers <= 1:
+            _init_worker(self.get_system, self.system_specs, self.worker_kwargs)
+            for task in tasks:
+                yield _run_task(task)
+            return
+
+        pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                initargs=(self.get_system, self.system_specs, self.worker_kwargs))
+        try:
+            for result in pool.imap(_run_task, tasks, chunksize=self.chunk_size):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
@@ -1,5 +1,8 @@
 import random
+import threading
+from collections import OrderedDict
 import ujson as json
+from json import JSONDecoder
 import string
 import cPickle as pickle
 import numpy as np
@@ -14,11 +17,126 @@ def random_multinomial(probs):
             return i
         i += 1
 
-def generate_uuid(prefix):
-    return prefix + '_' + ''.join([random.choice(string.digits + string.letters) for _ in range(16)])
+class LRUCache(object):
+    '''
+    Thread-safe cache that keeps the |max_size| most recently used entries.
+    To key entries by the identity of an object (id(obj)), keep a reference to
+    the object in the value, so that its id is not reused while it is cached.
+    '''
+    _missing = object()
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.pop(key, self._missing)
+            if value is self._missing:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        '''
+        Return the value of |key|, or compute it (outside the lock) with compute() and cache it.
+        '''
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def generate_uuid(prefix, rng=random):
+    return prefix + '_' + ''.join([rng.choice(string.digits + string.letters) for _ in range(16)])
 
 def read_json(path):
-    return json.load(open(path))
+    '''
+    Read a JSON file or a JSON-lines file (one record per line), which is returned as a list.
+    The format is decided by the first non-whitespace character, as in iter_json.
+    '''
+    with open(path) as fin:
+        content = fin.read()
+    lines = [line for line in content.splitlines() if line.strip()]
+    if content.lstrip()[:1] != '{' or len(lines) == 1:
+        return json.loads(content)
+    # JSON-lines if the first line is a complete record, otherwise a multi-line JSON object
+    try:
+        first = json.loads(lines[0])
+    except ValueError:
+        return json.loads(content)
+    return [first] + [json.loads(line) for line in lines[1:]]
+
+def iter_json(path, chunk_size=1<<16):
+    '''
+    Lazily iterate over the records of a JSON array file or a JSON-lines file.
+    '''
+    for raw, _, _ in iter_json_with_offsets(path, chunk_size):
+        yield raw
+
+def iter_json_with_offsets(path, chunk_size=1<<16):
+    '''
+    Same as iter_json but also yields the byte offsets [start, end) of each record in the file.
+    '''
+    with open(path) as fin:
+        buf = fin.read(chunk_size)
+        start = len(buf) - len(buf.lstrip())
+        if buf[start:start+1] == '[':
+            for record in _iter_json_array(fin, buf, start + 1, chunk_size):
+                yield record
+        else:
+            fin.seek(0)
+            offset = 0
+            for line in iter(fin.readline, ''):
+                if line.strip():
+                    yield json.loads(line), offset, offset + len(line)
+                offset += len(line)
+
+def _iter_json_array(fin, buf, pos, chunk_size):
+    decoder = JSONDecoder()
+    # File offset of buf[0]
+    base = 0
+    while True:
+        # Skip separators; read more if we run out of buffer
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            base += len(buf)
+            buf = fin.read(chunk_size)
+            pos = 0
+            if not buf:
+                return
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            raw, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The record is not complete in the buffer yet
+            chunk = fin.read(max(chunk_size, len(buf) - pos))
+            if not chunk:
+                raise
+            base += pos
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield raw, base + pos, base + end
+        pos = end
 
 def write_json(raw, path):
     with open(path, 'w') as out:
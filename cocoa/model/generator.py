@@ -8,6 +8,102 @@ from cocoa.model.ngram import MLENgramModel
 
 from core.tokenizer import detokenize
 
+class TemplateIndex(object):
+    """TF-IDF retrieval over partitions of the templates.
+
+    A partition is the set of templates whose columns have given values, e.g.
+    category, role and tags. The rows of a partition and their tf-idf vectors
+    are computed once and cached, so that a query only scores the templates in
+    one partition. Used templates are excluded with a boolean mask over rows.
+    """
+    def __init__(self, templates, tfidf_matrix):
+        self.templates = templates
+        self.tfidf_matrix = tfidf_matrix.tocsr()
+        self.num_templates = len(templates)
+        # Map from template id to row
+        self.template_rows = {id_: i for i, id_ in enumerate(templates.id.values)}
+        self.columns = {}
+        # Map from conditions to (rows, tf-idf matrix of the rows)
+        self.partitions = {(): (np.arange(self.num_templates), self.tfidf_matrix)}
+
+    def get_column(self, column):
+        if column not in self.columns:
+            self.columns[column] = self.templates[column].values
+        return self.columns[column]
+
+    def get_partition(self, conditions):
+        """Rows and tf-idf matrix of templates matching `conditions` ({column: value}).
+        """
+        key = tuple(sorted(conditions.iteritems()))
+        if key not in self.partitions:
+            loc = np.ones(self.num_templates, dtype=bool)
+            for column, value in key:
+                loc &= (self.get_column(column) == value)
+            rows = np.flatnonzero(loc)
+            self.partitions[key] = (rows, self.tfidf_matrix[rows])
+        return self.partitions[key]
+
+    def get_used_mask(self, used_templates):
+        """Mask of used templates over rows, or None if none (or all) of the templates are used.
+        """
+        if not used_templates:
+            return None
+        rows = [self.template_rows[id_] for id_ in used_templates if id_ in self.template_rows]
+        if len(rows) == 0 or len(rows) == self.num_templates:
+            return None
+        mask = np.zeros(self.num_templates, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def _available(self, rows, used_mask):
+        if used_mask is None:
+            return None
+        return ~used_mask[rows]
+
+    def count(self, levels, used_templates=None):
+        """Number of unused templates satisfying all `levels`.
+        """
+        conditions = {}
+        for level in levels:
+            conditions.update(level)
+        rows, _ = self.get_partition(conditions)
+        available = self._available(rows, self.get_used_mask(used_templates))
+        return len(rows) if available is None else np.sum(available)
+
+    def search(self, features, levels, used_templates=None, topk=20):
+        """Return rows of the `topk` templates most similar to `features`, in descending order of the score.
+
+        Args:
+            features: tf-idf vector (1 x vocab_size) of the query.
+            levels (list[dict]): conditions {column: value} added at each level.
+                Templates are retrieved from the last level whose partition
+                (with conditions of all levels up to it) has unused templates.
+            used_templates: ids of templates to exclude, unless all templates are used.
+        """
+        used_mask = self.get_used_mask(used_templates)
+        partitions = [self.get_partition({})]
+        conditions = {}
+        for level in levels:
+            conditions.update(level)
+            partitions.append(self.get_partition(conditions))
+
+        for rows, matrix in partitions[::-1]:
+            available = self._available(rows, used_mask)
+            if available is None:
+                if len(rows) > 0:
+                    break
+            elif np.any(available):
+                break
+
+        scores = (matrix * features.T).toarray().ravel()
+        if available is not None:
+            rows, scores = rows[available], scores[available]
+        if len(rows) > topk:
+            top = np.argpartition(-scores, topk)[:topk]
+            rows, scores = rows[top], scores[top]
+        return rows[np.argsort(scores)[::-1]]
+
+
 class Generator(object):
     def __init__(self, templates):
         self.templates = templates.templates
@@ -17,43 +113,26 @@ class Generator(object):
     def build_tfidf(self):
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix)
 
-    def _add_filter(self, locs, cond):
-        locs.append(locs[-1] & cond)
-
-    def _select_filter(self, locs):
-        print [np.sum(loc) for loc in locs]
-        for loc in locs[::-1]:
-            if np.sum(loc) > 0:
-                return loc
-        return locs[0]
-
-    def get_filter(self, used_templates=None):
-        if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
-            if np.sum(loc) > 0:
-                return loc
-        # All templates
-        return self.templates.id.notnull()
+    def get_filters(self, used_templates=None, **kwargs):
+        """Return a list of levels of conditions ({column: value}) for TemplateIndex.search,
+        or None if no template should be retrieved.
+        """
+        return []
 
     def retrieve(self, context, used_templates=None, topk=20, T=1., **kwargs):
-        loc = self.get_filter(used_templates=used_templates, **kwargs)
-        if loc is None:
+        levels = self.get_filters(used_templates=used_templates, **kwargs)
+        if levels is None:
             return None
 
         if isinstance(context, list):
             context = detokenize(context)
         features = self.vectorizer.transform([context])
-        scores = self.tfidf_matrix * features.T
-        scores = scores.todense()[loc]
-        scores = np.squeeze(np.array(scores), axis=1)
-        ids = np.argsort(scores)[::-1][:topk]
-
-        candidates = self.templates[loc]
-        candidates = candidates.iloc[ids]
-        rows = self.templates[loc]
-        rows = rows.iloc[ids]
-        logp = rows['logp'].values
+        rows = self.index.search(features, levels, used_templates=used_templates, topk=topk)
+
+        candidates = self.templates.iloc[rows]
+        logp = candidates['logp'].values
 
         return self.sample(logp, candidates, T)
 
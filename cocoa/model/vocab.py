@@ -1,7 +1,10 @@
-import numpy as np
+import os
 import time
+import numpy as np
 from collections import Counter
 
+from cocoa.io.utils import read_pickle, write_pickle
+
 class Vocabulary(object):
 
     UNK = '<unk>'
@@ -50,9 +53,16 @@ class Vocabulary(object):
                 n += 1
 
         self.size = len(self.ind_to_word)
+        self._word_array = None
 
         self.finished = True
 
+    def __getstate__(self):
+        # The word array is rebuilt on demand
+        state = dict(self.__dict__)
+        state.pop('_word_array', None)
+        return state
+
     def to_ind(self, word):
         if word in self.word_to_ind:
             return self.word_to_ind[word]
@@ -66,6 +76,58 @@ class Vocabulary(object):
     def to_word(self, ind):
         return self.ind_to_word[ind]
 
+    def to_inds(self, words):
+        unk = self.word_to_ind.get(self.UNK)
+        if unk is None:
+            return [self.to_ind(w) for w in words]
+        get = self.word_to_ind.get
+        return [get(w, unk) for w in words]
+
+    def to_words(self, inds):
+        ind_to_word = self.ind_to_word
+        return [ind_to_word[i] for i in inds]
+
+    @property
+    def word_array(self):
+        """
+        Words as an object array such that word_array[inds] decodes an index array.
+        """
+        if getattr(self, '_word_array', None) is None:
+            # Filled one by one since words can be tuples (entities)
+            words = np.empty(len(self.ind_to_word), dtype=object)
+            for i, w in enumerate(self.ind_to_word):
+                words[i] = w
+            self._word_array = words
+        return self._word_array
+
+    def encode_batch(self, sequences, pad, max_len=None):
+        """
+        Map a list of word sequences to a (num_seqs, max_len) int32 array
+        right-padded with the index `pad`. Sequences longer than `max_len` are truncated.
+        """
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        if max_len is None:
+            max_len = int(lengths.max()) if len(sequences) > 0 else 0
+        else:
+            lengths = np.minimum(lengths, max_len)
+        array = np.full([len(sequences), max_len], pad, dtype=np.int32)
+        inds = self.to_inds([w for seq, n in zip(sequences, lengths) for w in seq[:n]])
+        mask = np.arange(max_len) < lengths[:, None]
+        array[mask] = inds
+        return array
+
+    def decode_batch(self, array, pad=None):
+        """
+        Inverse of encode_batch: map an index array (num_seqs, seq_len) to a list
+        of word lists, dropping `pad`.
+        """
+        array = np.asarray(array)
+        words = self.word_array[array]
+        if pad is None:
+            return words.tolist()
+        mask = array != pad
+        return [row[m].tolist() for row, m in zip(words, mask)]
+
     def dump(self):
         for i, w in enumerate(self.ind_to_word):
             print '{:<8}{:<}'.format(i, w)
@@ -76,15 +138,101 @@ class Vocabulary(object):
         print 'Loading pretrained word vectors:', wordvec_file
         start_time = time.time()
         embeddings = np.random.uniform(-1., 1., [self.size, dim])
-        num_exist = 0
-        with open(wordvec_file, 'r') as f:
-            for line in f:
-                ss = line.split()
-                word = ss[0]
-                if word in self.word_to_ind:
-                    num_exist += 1
-                    vec = np.array([float(x) for x in ss[1:]])
-                    embeddings[self.word_to_ind[word]] = vec
+        wordvec = WordVectors.load(wordvec_file)
+        inds, rows = [], []
+        for i, w in enumerate(self.ind_to_word):
+            row = wordvec.word_to_row.get(w)
+            if row is not None:
+                inds.append(i)
+                rows.append(row)
+        num_exist = len(inds)
+        if num_exist > 0:
+            embeddings[inds] = wordvec.vectors[rows]
         print '[%d s]' % (time.time() - start_time)
         print '%d pretrained' % num_exist
         return embeddings
+
+
+class WordVectors(object):
+    """
+    Pretrained word vectors (e.g. GloVe) in text format: one word per line
+    followed by its vector components.
+
+    The first load parses the text file and writes a binary cache next to it:
+        <wordvec_file>.npy: float32 matrix with one row per line
+        <wordvec_file>.words.pkl: the words and the size and mtime of the text file
+    Later loads memory-map the matrix. The cache is rebuilt when the text file changes.
+    If the cache cannot be written, the vectors are parsed into memory on every load.
+    Vectors are stored in single precision, which is what the models use.
+    """
+    def __init__(self, words, vectors):
+        self.words = words
+        self.vectors = vectors
+        # Same as reading the file line by line: later lines override earlier ones
+        self.word_to_row = {w: i for i, w in enumerate(words)}
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    @classmethod
+    def cache_paths(cls, wordvec_file):
+        return wordvec_file + '.npy', wordvec_file + '.words.pkl'
+
+    @classmethod
+    def source_stamp(cls, wordvec_file):
+        stat = os.stat(wordvec_file)
+        return (stat.st_size, int(stat.st_mtime))
+
+    @classmethod
+    def load(cls, wordvec_file, cache=True):
+        if not cache:
+            words, vectors = cls.parse(wordvec_file)
+            return cls(words, vectors)
+
+        vectors_path, words_path = cls.cache_paths(wordvec_file)
+        if os.path.exists(vectors_path) and os.path.exists(words_path):
+            stamp, words = read_pickle(words_path)
+            if stamp == cls.source_stamp(wordvec_file):
+                return cls(words, np.load(vectors_path, mmap_mode='r'))
+
+        try:
+            words, vectors = cls.parse(wordvec_file, vectors_path)
+            # Written last: vectors without words are ignored
+            write_pickle((cls.source_stamp(wordvec_file), words), words_path)
+        except (IOError, OSError) as e:
+            # E.g. a read-only or shared embeddings directory
+            print 'Cannot write the cache of %s: %s' % (wordvec_file, e)
+            words, vectors = cls.parse(wordvec_file)
+        return cls(words, vectors)
+
+    @classmethod
+    def parse(cls, wordvec_file, vectors_path=None):
+        """
+        Parse the text file into a list of words and a float32 matrix, which is
+        written to `vectors_path` as an .npy file if given.
+        """
+        with open(wordvec_file, 'r') as f:
+            num_lines = 0
+            dim = None
+            for line in f:
+                if dim is None:
+                    dim = len(line.split()) - 1
+                num_lines += 1
+
+        shape = (num_lines, dim or 0)
+        if vectors_path is None:
+            vectors = np.empty(shape, dtype=np.float32)
+        else:
+            vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=shape)
+
+        words = []
+        with open(wordvec_file, 'r') as f:
+            for i, line in enumerate(f):
+                ss = line.split()
+                words.append(ss[0])
+                vectors[i] = np.array(ss[1:], dtype=np.float32)
+
+        if vectors_path is not None:
+            vectors.flush()
+        return words, vectors
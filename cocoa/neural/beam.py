@@ -13,10 +13,15 @@ class Scorer(object):
         Additional term add to log probability
         See https://arxiv.org/pdf/1609.08144.pdf.
         """
-        l_term = (((5 + len(beam.next_ys)) ** self.alpha) /
+        return self.length_score(logprobs, len(beam.next_ys))
+
+    def length_score(self, logprobs, length):
+        """
+        Length-normalized log probability of hypotheses with `length` symbols (including bos).
+        """
+        l_term = (((5 + length) ** self.alpha) /
                   ((5 + 1) ** self.alpha))
         return (logprobs / l_term)
 
     def update_global_state(self, beam):
         return
-
@@ -2,15 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import division
-import six
 import sys
 import os
 import numpy as np
 import argparse
 import torch
-from tqdm import tqdm as progress_bar
 
 from cocoa.io.utils import read_pickle
+from cocoa.model.vocab import WordVectors
 
 parser = argparse.ArgumentParser(description='embeddings_to_torch.py')
 parser.add_argument('--emb-file', required=True,
@@ -34,23 +33,20 @@ def get_vocabs(vocab_path, vocab_type):
     return vocab
 
 def get_embeddings(file_):
-    embs = dict()
-    with open(file_, 'r') as f:
-        for l in progress_bar(f):
-            l_split = l.strip().split()
-            embs[l_split[0]] = [float(em) for em in l_split[1:]]
-    print("Got {} embeddings from {}".format(len(embs), file_))
+    # Parsed once, then memory-mapped from the binary cache next to file_
+    embs = WordVectors.load(file_)
+    print("Got {} embeddings from {}".format(len(embs.word_to_row), file_))
 
     return embs
 
 
 def match_embeddings(vocab, emb):
-    dim = len(six.next(six.itervalues(emb)))
+    dim = emb.dim
     filtered_embeddings = np.zeros((len(vocab), dim))
     count = {"match": 0, "miss": 0}
     for w, w_id in vocab.word_to_ind.items():
-        if w in emb:
-            filtered_embeddings[w_id] = emb[w]
+        if w in emb.word_to_row:
+            filtered_embeddings[w_id] = emb.vectors[emb.word_to_row[w]]
             count['match'] += 1
         else:
             if opt.verbose:
@@ -1,3 +1,5 @@
+import copy
+
 import torch
 from torch.autograd import Variable
 
@@ -5,7 +7,6 @@ import onmt.io
 from onmt.Utils import aeq
 
 from symbols import markers
-from beam import Beam
 from utterance import UtteranceBuilder
 
 
@@ -61,19 +62,22 @@ class Generator(object):
 
     def _run_attention_memory(self, batch, enc_memory_bank):
         if batch.num_context > 0 and hasattr(self.model, 'kb_embedder'):
-            context_inputs = batch.context_inputs
-            _, context_memory_bank = self.model.context_embedder(context_inputs)
+            # Set by the session if the context turns have not changed
+            context_memory_bank = getattr(batch, 'context_memory_bank', None)
+            if context_memory_bank is None:
+                _, context_memory_bank = self.model.context_embedder(batch.context_inputs)
             memory_bank = [enc_memory_bank, context_memory_bank]
 
             # TODO: hacky. fix.
             if hasattr(batch, 'title_inputs') and self.model.kb_embedder:
-                title_inputs = batch.title_inputs
-                _, title_memory_bank = self.model.kb_embedder(title_inputs)
-                memory_bank.append(title_memory_bank)
-
-                desc_inputs = batch.desc_inputs
-                _, desc_memory_bank = self.model.kb_embedder(desc_inputs)
-                memory_bank.append(desc_memory_bank)
+                if hasattr(self.model, 'encode_kb'):
+                    kbs = batch.context_data.get('kbs')
+                    title_memory_bank, desc_memory_bank = self.model.encode_kb(
+                            batch.title_inputs, batch.desc_inputs, kbs)
+                else:
+                    _, title_memory_bank = self.model.kb_embedder(batch.title_inputs)
+                    _, desc_memory_bank = self.model.kb_embedder(batch.desc_inputs)
+                memory_bank.extend([title_memory_bank, desc_memory_bank])
 
             elif hasattr(batch, 'scene_inputs') and self.model.kb_embedder:
                 scene_inputs = batch.scene_inputs
@@ -87,7 +91,9 @@ class Generator(object):
         """
         Generate a batch of sentences.
 
-        Mostly a wrapper around :obj:`Beam`.
+        Beam search over the whole batch: scores, back-pointers and finished
+        flags of all examples are kept in (batch_size, beam_size) tensors, and
+        examples whose search is done are dropped from the active batch.
 
         Args:
            batch (:obj:`Batch`): a batch from a dataset object
@@ -100,35 +106,15 @@ class Generator(object):
         beam_size = self.beam_size
         batch_size = batch.size
         vocab = self.vocab
-
-        def get_bos(b):
-            """Get the starting symbol. If starting (enforced) prefix is longer
-            than 1, use the last symbol as the starting symbol. The rest (previous
-            ones) will be force decoded later. See (1.1) Go over forced prefix.
-            """
-            bos = batch.decoder_inputs[gt_prefix-1][b].data.cpu().numpy()[0]
-            return bos
-
-        beam = [Beam(beam_size, n_best=self.n_best,
-                     cuda=self.cuda,
-                     global_scorer=self.global_scorer,
-                     pad=vocab.word_to_ind[markers.PAD],
-                     bos=get_bos(b),
-                     eos=vocab.word_to_ind[markers.EOS],
-                     min_length=self.min_length)
-                for b in range(batch_size)]
+        pad = vocab.word_to_ind[markers.PAD]
+        eos = vocab.word_to_ind[markers.EOS]
+        tt = torch.cuda if self.cuda else torch
 
         # Help functions for working with beams and batches
         def var(a): return Variable(a, volatile=True)
 
         def rvar(a): return var(a.repeat(1, beam_size, 1))
 
-        def bottle(m):
-            return m.view(batch_size * beam_size, -1)
-
-        def unbottle(m):
-            return m.view(beam_size, batch_size, -1)
-
         # (1) Run the encoder on the src.
         lengths = batch.lengths
         dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
@@ -141,94 +127,168 @@ class Generator(object):
                 inp, memory_bank, dec_states, memory_lengths=lengths)
 
         # (2) Repeat src objects `beam_size` times.
-        #src_map = rvar(batch.src_map.data) \
-        #    if data_type == 'text' and self.copy_attn else None
+        # Decoder inputs are beam-major: position k * n + j is the k-th
+        # hypothesis of the j-th active example (n active examples).
         # TODO: num_context should be a property of the model, not the data!!
-        if batch.num_context > 0 and hasattr(self.model, 'context_embedder'):
+        multi_bank = batch.num_context > 0 and hasattr(self.model, 'context_embedder')
+        if multi_bank:
             memory_bank = [rvar(bank.data) for bank in memory_bank]
         else:
             memory_bank = rvar(memory_bank.data)
         memory_lengths = lengths.repeat(beam_size)
         dec_states.repeat_beam_size_times(beam_size)
 
-        # (3) run the decoder to generate sentences, using beam search.
-        for i in range(self.max_length):
-            if all((b.done() for b in beam)):
-                break
-
-            # Construct batch x beam_size nxt words.
-            # Get all the pending current beam words and arrange for forward.
-            inp = var(torch.stack([b.get_current_state() for b in beam])
-                     .t().contiguous().view(1, -1))
+        # (2.1) Search state of the active examples.
+        # Original batch index of each active example
+        active = range(batch_size)
+        # Current symbol of each hypothesis. If the (enforced) prefix is
+        # longer than 1, start from its last symbol; the rest has been force
+        # decoded in (1.1).
+        tokens = tt.LongTensor(batch_size, beam_size).fill_(pad)
+        tokens[:, 0].copy_(batch.decoder_inputs[gt_prefix-1].data)
+        scores = tt.FloatTensor(batch_size, beam_size).zero_()
+        # Finished flags: EOS has topped the beam / number of finished hypotheses
+        eos_top = tt.ByteTensor(batch_size).zero_()
+        num_finished = tt.LongTensor(batch_size).zero_()
+
+        # Search history indexed by the original example: back-pointers,
+        # outputs and attention at each step, finished hypotheses
+        # (score, timestep, k), and the final beam of each example.
+        prev_ks, next_ys, attns = [], [], []
+        finished = [[] for _ in xrange(batch_size)]
+        final_scores = [None] * batch_size
+        final_steps = [0] * batch_size
 
-            # Turn any copied words to UNKs
-            # 0 is unk
-            #if self.copy_attn:
-            #    inp = inp.masked_fill(
-            #        inp.gt(len(self.vocab) - 1), 0)
-
-            # Temporary kludge solution to handle changed dim expectation
-            # in the decoder
-            #inp = inp.unsqueeze(2)
+        # (3) run the decoder to generate sentences, using beam search.
+        for i in xrange(self.max_length):
+            n = len(active)
+            inp = var(tokens.t().contiguous().view(1, -1))
 
             # Run one step.
             dec_out, dec_states, attn = self.model.decoder(inp, memory_bank,
                         dec_states, memory_lengths=memory_lengths)
             dec_out = dec_out.squeeze(0)
-            # dec_out: beam x rnn_size
+            # dec_out: (beam_size * n, rnn_size)
 
-            # (b) Compute a vector of batch*beam word scores.
+            # (b) Compute the word scores of each hypothesis.
             out = self.model.generator.forward(dec_out).data
-            out = unbottle(out)
-            # beam x tgt_vocab
-
-            #if not self.copy_attn:
-            #    out = self.model.generator.forward(dec_out).data
-            #    out = unbottle(out)
-            #    # beam x tgt_vocab
-            #else:
-            #    out = self.model.generator.forward(dec_out,
-            #                                       attn["copy"].squeeze(0),
-            #                                       src_map)
-            #    # beam x (tgt_vocab + extra_vocab)
-            #    out = data.collapse_copy_scores(
-            #        unbottle(out.data),
-            #        batch, self.vocab, data.src_vocabs)
-            #    # beam x tgt_vocab
-            #    out = out.log()
-
-            # (c) Advance each beam.
-            # beam: (batch_size,)
-            # out: (beam_size, batch_size, vocab_size)
-            for j, b in enumerate(beam):
-                b.advance(
-                    out[:, j],
-                    unbottle(attn["std"]).data[:, j, :memory_lengths[j]])
-                dec_states.beam_update(j, b.get_current_origin(), beam_size)
+            out = out.view(beam_size, n, -1).transpose(0, 1).contiguous()
+            num_words = out.size(2)
+            # out: (n, beam_size, vocab_size)
+            attn = attn["std"].data.view(beam_size, n, -1).transpose(0, 1)
+            # attn: (n, beam_size, src_len)
+
+            # (c) Advance all beams.
+            # Force the output to be longer than min_length
+            if i + 1 < self.min_length:
+                out[:, :, eos] = -1e20
+            if i == 0:
+                # All hypotheses start from the same symbol
+                beam_scores = out[:, :1].contiguous()
+            else:
+                beam_scores = out + scores.unsqueeze(2).expand_as(out)
+                # Don't let EOS have children.
+                beam_scores.masked_fill_(
+                    tokens.eq(eos).unsqueeze(2).expand_as(beam_scores), -1e20)
+            scores, best_ids = beam_scores.view(n, -1).topk(beam_size, 1, True, True)
+            # best_ids is flattened beam x word array, so calculate which
+            # word and beam each score came from
+            prev_k = best_ids / num_words
+            tokens = best_ids - prev_k * num_words
+            attn = attn.gather(1, prev_k.unsqueeze(2).expand(n, beam_size, attn.size(2)))
+
+            active_ids = tt.LongTensor(active)
+            prev_ks.append(prev_k.new(batch_size, beam_size).zero_().index_copy_(0, active_ids, prev_k))
+            next_ys.append(tokens.new(batch_size, beam_size).fill_(pad).index_copy_(0, active_ids, tokens))
+            attns.append(attn.new(batch_size, beam_size, attn.size(2)).zero_().index_copy_(0, active_ids, attn))
+
+            is_eos = tokens.eq(eos)
+            if is_eos.sum() > 0:
+                step_scores = self._length_score(scores, i + 2).cpu().tolist()
+                for j, k in is_eos.nonzero().cpu().tolist():
+                    finished[active[j]].append((step_scores[j][k], i + 1, k))
+            eos_top = eos_top | is_eos[:, 0]
+            num_finished = num_finished + is_eos.long().sum(1)
+
+            done = eos_top & num_finished.ge(self.n_best)
+            if i + 1 == self.max_length:
+                done.fill_(1)
+            if done.sum() > 0:
+                done_scores = scores.cpu().tolist()
+                for j in done.nonzero().view(-1).cpu().tolist():
+                    final_scores[active[j]] = done_scores[j]
+                    final_steps[active[j]] = i + 1
+                if done.sum() == n:
+                    break
+                # Drop finished examples from the active batch.
+                keep = (1 - done).nonzero().view(-1)
+                active = [active[j] for j in keep.cpu().tolist()]
+                tokens = tokens.index_select(0, keep)
+                scores = scores.index_select(0, keep)
+                prev_k = prev_k.index_select(0, keep)
+                eos_top = eos_top.index_select(0, keep)
+                num_finished = num_finished.index_select(0, keep)
+                positions = (tt.LongTensor(range(beam_size)).unsqueeze(1) * n +
+                             keep.unsqueeze(0)).view(-1)
+                if multi_bank:
+                    memory_bank = [var(bank.data.index_select(1, positions)) for bank in memory_bank]
+                else:
+                    memory_bank = var(memory_bank.data.index_select(1, positions))
+                memory_lengths = memory_lengths.index_select(0, positions)
+            else:
+                keep = tt.LongTensor(range(n))
+
+            # (d) Reorder decoder states following the back-pointers.
+            # Hypothesis k of example keep[j] comes from hypothesis prev_k[j][k].
+            positions = prev_k * n + keep.unsqueeze(1).expand_as(prev_k)
+            dec_states.index_select(positions.t().contiguous().view(-1))
 
         # (4) Extract sentences from beam.
-        ret = self._from_beam(beam)
+        ret = self._from_beam(finished, final_scores, final_steps,
+                              prev_ks, next_ys, attns, lengths)
         ret["gold_score"] = [0] * batch_size
         #if "tgt" in batch.__dict__:
         #    ret["gold_score"] = self._run_target(batch, data)
         ret["batch"] = batch
         return ret
 
-    def _from_beam(self, beam):
+    def _length_score(self, scores, length):
+        if self.global_scorer is None:
+            return scores
+        return self.global_scorer.length_score(scores, length)
+
+    def _from_beam(self, finished, final_scores, final_steps, prev_ks, next_ys, attns, lengths):
         ret = {"predictions": [],
                "scores": [],
                "attention": [],
                }
-        for b in beam:
-            n_best = self.n_best
-            scores, ks = b.sort_finished(minimum=n_best)
-            hyps, attn = [], []
-            for i, (times, k) in enumerate(ks[:n_best]):
-                hyp, att = b.get_hyp(times, k)
-                hyps.append(hyp)
-                attn.append(att)
-            ret["predictions"].append(hyps)
-            ret["scores"].append(scores)
+        n_best = self.n_best
+        prev_ks = torch.stack(prev_ks).cpu().tolist()
+        next_ys = torch.stack(next_ys).cpu().tolist()
+        attns = torch.stack(attns).cpu()
+        lengths = lengths.cpu().tolist()
+        for b, hyps in enumerate(finished):
+            # Add from beam until we have n_best outputs.
+            timestep = final_steps[b]
+            k = 0
+            while len(hyps) < n_best:
+                s = self._length_score(final_scores[b][k], timestep + 1)
+                hyps.append((s, timestep, k))
+                k += 1
+            hyps.sort(key=lambda a: -a[0])
+
+            preds, attn = [], []
+            for _, timestep, k in hyps[:n_best]:
+                # Walk back to construct the full hypothesis.
+                hyp, att = [], []
+                for j in xrange(timestep - 1, -1, -1):
+                    hyp.append(next_ys[j][b][k])
+                    att.append(attns[j][b][k][:lengths[b]])
+                    k = prev_ks[j][b][k]
+                preds.append(hyp[::-1])
+                attn.append(torch.stack(att[::-1]))
+            ret["predictions"].append(preds)
+            ret["scores"].append([s for s, _, _ in hyps])
             ret["attention"].append(attn)
         return ret
 
@@ -264,6 +324,14 @@ class Generator(object):
         return gold_scores
 
 class Sampler(Generator):
+    """
+    Sample a response for each example in the batch.
+
+    Decoding stops for an example once it samples EOS: finished examples are
+    dropped from the active batch and sampling ends when all examples are done
+    (or after max_length steps). Scores are the log-probabilities of the
+    sampled sequences (including EOS) under the model.
+    """
     def __init__(self, model, vocab,
                  temperature=1, max_length=100, cuda=False):
         self.model = model
@@ -273,45 +341,100 @@ class Sampler(Generator):
         self.cuda = cuda
         self.tt = torch.cuda if cuda else torch
         self.eos = vocab.to_ind(markers.EOS)
+        self.pad = vocab.to_ind(markers.PAD)
 
         # For debugging
         self.builder = UtteranceBuilder(vocab)
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
-        # (1) Run the encoder on the src.
-        lengths = batch.lengths
-        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
-        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+    def _sample(self, out):
+        """
+        Sample from the logprobs `out` (n, vocab_size) with temperature.
+        Return the samples (n,) and their logprobs (n,).
+        """
+        scores = out.div(self.temperature)
+        scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
+        pred = torch.multinomial(scores.exp(), 1)  # (n, 1)
+        return pred.squeeze(1), out.gather(1, pred).squeeze(1)
 
-        # (1.1) Go over forced prefix.
-        inp = batch.decoder_inputs[:gt_prefix]
-        dec_out, dec_states, _ = self.model.decoder(
-            inp, memory_bank, dec_states, memory_lengths=lengths)
+    def _select_state(self, state, rows):
+        """
+        Return the decoder state of `rows` along the batch dimension, leaving
+        `state` unchanged (it may be still referenced by finished examples).
+        """
+        state = copy.copy(state)
+        state.index_select(rows)
+        return state
 
-        # (2) Sampling
-        batch_size = batch.size
+    def _merge_states(self, states, order):
+        """
+        Concatenate `states` along the batch dimension and reorder them by `order`.
+        """
+        state = type(states[0]).cat(states)
+        state.index_select(order)
+        return state
+
+    def _sample_sequences(self, dec_out, state, forward, batch_size):
+        """
+        Sample from the decoder until all sequences have emitted EOS.
+
+        Args:
+            dec_out: decoder output of the last prefix step (1, batch_size, rnn_size)
+            state: decoder state after the prefix
+            forward (fn): forward(inp, state, rows) runs one decoder step on
+                inp (1, n); if rows (LongTensor) is not None, only these rows of
+                the previous step are still active and forward must drop the
+                other rows of its own inputs (e.g. the memory bank).
+
+        Returns:
+            preds (batch_size, seq_len) padded after EOS, scores (batch_size,)
+            and the decoder state of each example when it emitted EOS (EOS is
+            not fed to the decoder).
+        """
+        tt = self.tt
+        # Original batch index of each active example
+        active = tt.LongTensor(range(batch_size))
+        scores = tt.FloatTensor(batch_size).zero_()
         preds = []
+        # (original indices, decoder state) of finished examples
+        finished = []
         for i in xrange(self.max_length):
-            # Outputs to probs
-            dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
-            out = self.model.generator.forward(dec_out).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
-            preds.append(pred)
+            out = self.model.generator.forward(dec_out.squeeze(0)).data  # Logprob (n, vocab_size)
+            pred, logprob = self._sample(out)
+            scores.index_add_(0, active, logprob)
+            preds.append(pred.new(batch_size).fill_(self.pad).index_copy_(0, active, pred))
+
+            is_eos = pred.eq(self.eos)
+            num_eos = is_eos.sum()
+            if num_eos == active.size(0) or i + 1 == self.max_length:
+                break
+            rows = None
+            if num_eos > 0:
+                done = is_eos.nonzero().view(-1)
+                finished.append((active.index_select(0, done), self._select_state(state, done)))
+                rows = is_eos.eq(0).nonzero().view(-1)
+                active = active.index_select(0, rows)
+                pred = pred.index_select(0, rows)
+                state = self._select_state(state, rows)
             # Forward step
-            inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            dec_out, dec_states, _ = self.model.decoder(
-                inp, memory_bank, dec_states, memory_lengths=lengths)
+            inp = Variable(pred.view(1, -1))  # (seq_len=1, n)
+            dec_out, state = forward(inp, state, rows)
+        finished.append((active, state))
+
+        # Put the final states back in the original batch order
+        positions = torch.cat([p for p, _ in finished])
+        order = positions.sort()[1]
+        state = self._merge_states([s for _, s in finished], order)
 
-        preds = torch.stack(preds).t()  # (batch_size, seq_len)
+        preds = torch.stack(preds, 1)  # (batch_size, seq_len)
+        return preds, scores, state
+
+    def _make_output(self, batch, preds, scores, dec_states):
         # Insert one dimension (n_best) so that its structure is consistent
         # with beam search generator
         preds = preds.unsqueeze(1)
-        # TODO: add actual scores
+        batch_size = batch.size
         ret = {"predictions": preds,
-               "scores": [[0]] * batch_size,
+               "scores": [[s] for s in scores.cpu().tolist()],
                "attention": [None] * batch_size,
                "dec_states": dec_states,
                }
@@ -320,7 +443,47 @@ class Sampler(Generator):
         ret["batch"] = batch
         return ret
 
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
+        # (1) Run the encoder on the src.
+        lengths = batch.lengths
+        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+
+        # (1.1) Go over forced prefix.
+        inp = batch.decoder_inputs[:gt_prefix]
+        dec_out, dec_states, _ = self.model.decoder(
+            inp, memory_bank, dec_states, memory_lengths=lengths)
+
+        # (2) Sampling
+        # Memory of the active examples
+        memory = {'bank': memory_bank, 'lengths': lengths}
+        def forward(inp, state, rows):
+            if rows is not None:
+                bank = memory['bank']
+                if isinstance(bank, list):
+                    memory['bank'] = [Variable(b.data.index_select(1, rows), volatile=True) for b in bank]
+                else:
+                    memory['bank'] = Variable(bank.data.index_select(1, rows), volatile=True)
+                memory['lengths'] = memory['lengths'].index_select(0, rows)
+            dec_out, state, _ = self.model.decoder(
+                inp, memory['bank'], state, memory_lengths=memory['lengths'])
+            return dec_out, state
+
+        preds, scores, dec_states = self._sample_sequences(dec_out, dec_states, forward, batch.size)
+        return self._make_output(batch, preds, scores, dec_states)
+
 class LMSampler(Sampler):
+    # The LM state is the RNN hidden state: a Variable or a tuple of Variables (e.g. LSTM)
+    def _select_state(self, state, rows):
+        if isinstance(state, tuple):
+            return tuple(self._select_state(s, rows) for s in state)
+        return Variable(state.data.index_select(1, rows), volatile=True)
+
+    def _merge_states(self, states, order):
+        if isinstance(states[0], tuple):
+            return tuple(self._merge_states(s, order) for s in zip(*states))
+        return Variable(torch.cat([s.data for s in states], 1).index_select(1, order), volatile=True)
+
     def generate_batch(self, batch, gt_prefix=1, enc_state=None):
         # (1.1) Go over forced prefix.
         inp = batch.inputs
@@ -328,32 +491,8 @@ class LMSampler(Sampler):
         dec_out = outputs[-1:]
 
         # (2) Sampling
-        batch_size = batch.size
-        preds = []
-        for i in xrange(self.max_length):
-            # Outputs to probs
-            dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
-            out = self.model.generator.forward(dec_out).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
-            preds.append(pred)
-            # Forward step
-            inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            dec_out, enc_state = self.model(inp, None, enc_state=enc_state)
-
-        preds = torch.stack(preds).t()  # (batch_size, seq_len)
-        # Insert one dimension (n_best) so that its structure is consistent
-        # with beam search generator
-        preds = preds.unsqueeze(1)
-        # TODO: add actual scores
-        ret = {"predictions": preds,
-               "scores": [[0]] * batch_size,
-               "attention": [None] * batch_size,
-               "dec_states": enc_state,
-               }
+        def forward(inp, state, rows):
+            return self.model(inp, None, enc_state=state)
 
-        ret["gold_score"] = [0] * batch_size
-        ret["batch"] = batch
-        return ret
+        preds, scores, enc_state = self._sample_sequences(dec_out, enc_state, forward, batch.size)
+        return self._make_output(batch, preds, scores, enc_state)
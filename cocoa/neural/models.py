@@ -1,4 +1,6 @@
 from __future__ import division
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -710,6 +712,27 @@ class RNNDecoderState(DecoderState):
         self.hidden = tuple(vars[:-1])
         self.input_feed = vars[-1]
 
+    def index_select(self, positions):
+        """ Select (and reorder) states along batch dimension. """
+        vars = [Variable(e.data.index_select(1, positions), volatile=True)
+                for e in self._all]
+        self.hidden = tuple(vars[:-1])
+        self.input_feed = vars[-1]
+        if self.coverage is not None:
+            self.coverage = Variable(self.coverage.data.index_select(1, positions), volatile=True)
+
+    @classmethod
+    def cat(cls, states):
+        """ Concatenate states along batch dimension. """
+        state = copy.copy(states[0])
+        vars = [Variable(torch.cat([e.data for e in es], 1), volatile=True)
+                for es in zip(*[s._all for s in states])]
+        state.hidden = tuple(vars[:-1])
+        state.input_feed = vars[-1]
+        if state.coverage is not None:
+            state.coverage = Variable(torch.cat([s.coverage.data for s in states], 1), volatile=True)
+        return state
+
 class MultiAttnDecoder(StdRNNDecoder):
 
     def __init__(self, rnn_type, bidirectional_encoder, num_layers,
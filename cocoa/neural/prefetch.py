@@ -0,0 +1,106 @@
+import sys
+import time
+import threading
+from Queue import Queue, Empty, Full
+
+import torch
+
+# Kinds of queue items
+_ITEM, _END, _ERROR = range(3)
+
+
+class PrefetchIterator(object):
+    """
+    Iterate over `iterator` (e.g. DataGenerator.generator) while a background
+    thread builds up to `queue_size` items ahead of consumption.
+
+    Items, including None end-of-dialogue sentinels, come out in the same order
+    as from `iterator`; exceptions raised by `iterator` are re-raised on the
+    consumer side. With queue_size=0 items are built on the calling thread.
+
+    The current CUDA device is per thread: if `iterator` puts tensors on the
+    GPU, pass the consumer's `device` (torch.cuda.current_device()) so that the
+    background thread builds them on the same device.
+
+    wait_time is the time the consumer spent waiting for items and build_time
+    the time spent producing them.
+    """
+    def __init__(self, iterator, queue_size=2, device=None):
+        self.iterator = iter(iterator)
+        self.queue_size = queue_size
+        self.device = device
+        self.wait_time = 0.
+        self.build_time = 0.
+        self.finished = False
+        if queue_size > 0:
+            self.queue = Queue(maxsize=queue_size)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._produce)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce(self):
+        if self.device is not None:
+            torch.cuda.set_device(self.device)
+        while True:
+            start_time = time.time()
+            try:
+                item = (_ITEM, next(self.iterator))
+            except StopIteration:
+                item = (_END, None)
+            except Exception:
+                item = (_ERROR, sys.exc_info())
+            self.build_time += time.time() - start_time
+            if not self._put(item) or item[0] != _ITEM:
+                return
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration
+
+        start_time = time.time()
+        if self.queue_size > 0:
+            kind, value = self.queue.get()
+        else:
+            try:
+                kind, value = _ITEM, next(self.iterator)
+            except StopIteration:
+                kind, value = _END, None
+            self.build_time += time.time() - start_time
+        self.wait_time += time.time() - start_time
+
+        if kind == _ITEM:
+            return value
+        self.finished = True
+        if kind == _ERROR:
+            raise value[0], value[1], value[2]
+        raise StopIteration
+
+    def close(self):
+        """
+        Stop the background thread, e.g. when iteration ends early.
+        """
+        self.finished = True
+        if self.queue_size > 0:
+            self.stopped.set()
+            self.thread.join()
+
+    def report(self, total_time):
+        """
+        Time spent waiting for data vs. computing, out of `total_time` seconds.
+        """
+        print('Data: %.1fs waiting, %.1fs building batches (%d prefetched); compute: %.1fs' %
+              (self.wait_time, self.build_time, self.queue_size, total_time - self.wait_time))
+        sys.stdout.flush()
@@ -43,6 +43,25 @@ class Statistics(BaseStatistics):
                self.mean_reward()))
         sys.stdout.flush()
 
+class RunningStats(object):
+    """Running mean and standard deviation of a stream of values (Welford's algorithm).
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def std(self):
+        if self.n == 0:
+            return 0.
+        return (self.m2 / self.n) ** 0.5
+
 # TODO: refactor
 class RLTrainer(Trainer):
     pass
@@ -11,6 +11,7 @@ from onmt.Trainer import Statistics as BaseStatistics
 from onmt.Utils import use_gpu
 
 from cocoa.io.utils import create_path
+from cocoa.neural.prefetch import PrefetchIterator
 
 
 class Statistics(BaseStatistics):
@@ -85,16 +86,21 @@ class Trainer(object):
         print(' * number of epochs: %d' % opt.epochs)
         print(' * batch size: %d' % opt.batch_size)
 
+        # Device set by --gpuid, for batches built by the prefetch thread
+        device = torch.cuda.current_device() if use_gpu(opt) else None
+
         for epoch in range(opt.epochs):
             print('')
 
             # 1. Train for one epoch on the training set.
-            train_iter = data.generator('train', cuda=use_gpu(opt))
+            train_iter = PrefetchIterator(data.generator('train', cuda=use_gpu(opt)),
+                    opt.prefetch_batches, device)
             train_stats = self.train_epoch(train_iter, opt, epoch, report_func)
             print('Train loss: %g' % train_stats.mean_loss())
 
             # 2. Validate on the validation set.
-            valid_iter = data.generator('dev', cuda=use_gpu(opt))
+            valid_iter = PrefetchIterator(data.generator('dev', cuda=use_gpu(opt)),
+                    opt.prefetch_batches, device)
             valid_stats = self.validate(valid_iter)
             print('Validation loss: %g' % valid_stats.mean_loss())
 
@@ -117,7 +123,8 @@ class Trainer(object):
     def train_epoch(self, train_iter, opt, epoch, report_func=None):
         """ Train next epoch.
         Args:
-            train_iter: training data iterator
+            train_iter: training data iterator; time spent waiting for
+                batches is reported if it is a PrefetchIterator
             epoch(int): the epoch number
             report_func(fn): function for logging
 
@@ -155,6 +162,9 @@ class Trainer(object):
             self._gradient_accumulation(true_batchs, total_stats, report_stats)
             true_batchs = []
 
+        if isinstance(train_iter, PrefetchIterator):
+            train_iter.report(total_stats.elapsed_time())
+
         return total_stats
 
     def validate(self, valid_iter):
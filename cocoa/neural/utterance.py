@@ -72,7 +72,7 @@ class UtteranceBuilder(object):
 
         sent_ids = variables.data.cpu().numpy()
         pad_id = vocab.to_ind(markers.PAD)
-        sent_words = [vocab.to_word(x) for x in sent_ids if x != pad_id]
+        sent_words = vocab.to_words(sent_ids[sent_ids != pad_id])
         sent_strings = [str(x) if is_entity(x) else x for x in sent_words]
         readable_sent = ' '.join(sent_strings)
 
@@ -101,7 +101,7 @@ class UtteranceBuilder(object):
         utterances = []
         for b in range(batch_size):
             #src_raw = batch.context_data['encoder_tokens'][b]
-            src_raw = map(self.vocab.to_word, batch.encoder_inputs.data[:, b])
+            src_raw = self.vocab.to_words(batch.encoder_inputs.data[:, b])
             if not batch.context_data['decoder_tokens'][b]:
                 continue
             pred_sents = [self.build_target_tokens(preds[b][n])
@@ -109,7 +109,7 @@ class UtteranceBuilder(object):
             gold_sent = None
             if tgt is not None:
                 #gold_sent = self.build_target_tokens(tgt[:, b])
-                gold_sent = map(self.vocab.to_word, tgt[:, b])
+                gold_sent = self.vocab.to_words(tgt[:, b])
 
             utterance = Utterance(src_raw, pred_sents,
                                   attn[b], pred_score[b], gold_sent,
@@ -1,9 +1,9 @@
 # =============== core ===============
 def add_dataset_arguments(parser):
     parser.add_argument('--train-examples-paths', nargs='*', default=[],
-        help='Input training examples')
+        help='Input training examples (JSON files or one columnar directory, see cocoa.core.columnar)')
     parser.add_argument('--test-examples-paths', nargs='*', default=[],
-        help='Input test examples')
+        help='Input test examples (JSON files or one columnar directory)')
     parser.add_argument('--train-max-examples', type=int,
         help='Maximum number of training examples')
     parser.add_argument('--test-max-examples', type=int,
@@ -56,6 +56,9 @@ def add_trainer_arguments(parser):
     #                    help='Data comes from a generator, which is unlimited, so we need to set some artificial limit.')
     group.add_argument('--epochs', type=int, default=14,
                        help='Number of training epochs')
+    group.add_argument('--prefetch-batches', type=int, default=2,
+                       help="""Number of batches built ahead of training by a
+                       background thread (0 to build them on the training thread)""")
     group.add_argument('--optim', default='sgd', help="""Optimization method.""",
                        choices=['sgd', 'adagrad', 'adadelta', 'adam'])
     group.add_argument('--max-grad-norm', type=float, default=5,
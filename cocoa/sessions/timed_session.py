@@ -29,6 +29,9 @@ class TimedSessionWrapper(Session):
         self.received = False
         self.num_utterances = 0
         self.start_typing = False
+        # Random delays are drawn once per waiting period / queued event
+        self.patience = random.uniform(1, self.PATIENCE)
+        self.wait = None
 
     @property
     def config(self):
@@ -43,25 +46,21 @@ class TimedSessionWrapper(Session):
             return
         if len(self.queued_event) == 0:
             self.last_message_timestamp = time.time()
+            self.patience = random.uniform(1, self.PATIENCE)
         self.num_utterances = 0
         self.session.receive(event)
         self.received = True
         self.queued_event.clear()
+        self.wait = None
 
-    def send(self):
-        # TODO: even if cross talk is enabled, we don't want the bot to talk in a row
-        if self.num_utterances >= 1:
-            return None
-        if self.received is False and (self.prev_action == 'select' or \
-            self.last_message_timestamp + random.uniform(1, self.PATIENCE) > time.time()):
-            return None
-
-        if len(self.queued_event) == 0:
-            self.queued_event.append(self.session.send())
+    def get_wait(self, event):
+        """Return (delay, reading_time) of the next queued event.
 
-        event = self.queued_event[0]
-        if event is None:
-            return self.queued_event.popleft()
+        `delay` is the number of seconds after the last message at which the event is sent, and `reading_time` is
+        the number of seconds after which we start typing.
+        """
+        if self.wait is not None:
+            return self.wait
         if event.action == 'message':
             delay = float(len(event.data)) / self.CHAR_RATE + random.uniform(0, self.EPSILON)
         elif event.action == 'select':
@@ -75,10 +74,52 @@ class TimedSessionWrapper(Session):
             delay = 0.5
         else:
             raise ValueError('Unknown event type: %s' % event.action)
+        # Add reading time before start typing
+        reading_time = 0 if self.prev_action == 'join' else random.uniform(0.5, 1)
+        self.wait = (delay, reading_time)
+        return self.wait
+
+    def pop_event(self):
+        self.wait = None
+        return self.queued_event.popleft()
+
+    def next_action_time(self):
+        """Return the earliest time at which send() returns an event, or None if we are waiting for the partner.
+        """
+        if self.num_utterances >= 1:
+            return None
+        if self.received is False:
+            if self.prev_action == 'select':
+                return None
+            start_time = self.last_message_timestamp + self.patience
+        else:
+            start_time = 0
+        if len(self.queued_event) == 0 or self.queued_event[0] is None:
+            return start_time
+        event = self.queued_event[0]
+        delay, reading_time = self.get_wait(event)
+        action_time = self.last_message_timestamp + delay
+        if event.action == 'message' and self.start_typing is False:
+            action_time = min(action_time, self.last_message_timestamp + reading_time)
+        return max(start_time, action_time)
+
+    def send(self):
+        # TODO: even if cross talk is enabled, we don't want the bot to talk in a row
+        if self.num_utterances >= 1:
+            return None
+        if self.received is False and (self.prev_action == 'select' or \
+            self.last_message_timestamp + self.patience > time.time()):
+            return None
+
+        if len(self.queued_event) == 0:
+            self.queued_event.append(self.session.send())
+
+        event = self.queued_event[0]
+        if event is None:
+            return self.pop_event()
+        delay, reading_time = self.get_wait(event)
 
         if self.last_message_timestamp + delay > time.time():
-            # Add reading time before start typing
-            reading_time = 0 if self.prev_action == 'join' else random.uniform(0.5, 1)
             if event.action == 'message' and self.start_typing is False and \
                     self.last_message_timestamp + reading_time < time.time():
                 self.start_typing = True
@@ -90,13 +131,14 @@ class TimedSessionWrapper(Session):
                 self.start_typing = False
                 return Event.TypingEvent(self.agent, 'stopped')
             elif event.action == 'join':
-                event = self.queued_event.popleft()
+                event = self.pop_event()
                 return event
             else:
-                event = self.queued_event.popleft()
+                event = self.pop_event()
                 self.prev_action = event.action
                 self.received = False
                 self.num_utterances += 1
                 self.last_message_timestamp = time.time()
+                self.patience = random.uniform(1, self.PATIENCE)
                 event.time = str(self.last_message_timestamp)
                 return event
@@ -92,11 +92,12 @@ class Backend(object):
                              Messages,
                              active_system=app.config.get('active_system'),
                              active_scenario=app.config.get('active_scenario'),
+                             scheduler=app.config.get('scheduler'),
                              )
             backend = g._backend
         return backend
 
-    def __init__(self, params, schema, scenario_db, systems, sessions, controller_map, num_chats_per_scenario, messages=Messages, active_system=None, active_scenario=None):
+    def __init__(self, params, schema, scenario_db, systems, sessions, controller_map, num_chats_per_scenario, messages=Messages, active_system=None, active_scenario=None, scheduler=None):
         self.config = params
         self.conn = sqlite3.connect(params["db"]["location"])
         self.conn.row_factory = sqlite3.Row
@@ -115,6 +116,8 @@ class Backend(object):
         self.num_chats_per_scenario = num_chats_per_scenario
         self.logger = WebLogger.get_logger()
         self.messages = messages
+        # If not None, controllers are stepped by the ChatScheduler instead of request handlers
+        self.scheduler = scheduler
 
     def display_received_event(self, event):
         """Convert a received event to string to be shown in the chat box.
@@ -835,7 +838,8 @@ class Backend(object):
             # fail silently - this just means that receive is called between the time that the chat has ended and the
             # time that the page is refreshed
             return None
-        controller.step(self)
+        if self.scheduler is None:
+            controller.step(self)
         session = self._get_session(userid)
         return session.poll_inbox()
 
@@ -866,7 +870,10 @@ class Backend(object):
             # fail silently because this just means that the user tries to send something after their partner has left
             # (but before the chat has ended)
             return None
-        controller.step(self)
+        if self.scheduler is not None:
+            self.scheduler.schedule(controller)
+        else:
+            controller.step(self)
         # self.add_event_to_db(controller.get_chat_id(), event)
 
     def submit_survey(self, userid, data):
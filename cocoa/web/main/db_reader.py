@@ -5,6 +5,7 @@ import json
 from cocoa.core.dataset import Example
 from cocoa.core.event import Event
 from cocoa.core.util import write_json
+from cocoa.core.columnar import write_columnar
 
 class DatabaseReader(object):
     date_fmt = '%Y-%m-%d %H-%M-%S'
@@ -149,13 +150,15 @@ class DatabaseReader(object):
         return Example(scenario, scenario_uuid, events, outcome, chat_id, agent_types)
 
     @classmethod
-    def dump_chats(cls, cursor, scenario_db, json_path, uids=None):
+    def dump_chats(cls, cursor, scenario_db, json_path, uids=None, columnar=False):
         """Dump chat transcripts to a JSON file.
 
         Args:
             scenario_db (ScenarioDB): retrieve Scenario by logged uuid.
             json_path (str): output path.
             uids (list): if provided, only log chats from these users.
+            columnar (bool): write a columnar directory (see cocoa.core.columnar) to json_path instead,
+                adding chats one at a time.
 
         """
         if uids is None:
@@ -175,11 +178,14 @@ class DatabaseReader(object):
                 agent_event[event.agent] += 1
             return agent_event[0] == 0 or agent_event[1] == 0
 
-        examples = []
-        for chat_id in ids:
-            ex = cls.get_chat_example(cursor, chat_id[0], scenario_db)
-            if ex is None or is_single_agent(ex):
-                continue
-            examples.append(ex)
+        def iter_examples():
+            for chat_id in ids:
+                ex = cls.get_chat_example(cursor, chat_id[0], scenario_db)
+                if ex is None or is_single_agent(ex):
+                    continue
+                yield ex
 
-        write_json([ex.to_dict() for ex in examples], json_path)
+        if columnar:
+            write_columnar(iter_examples(), json_path)
+        else:
+            write_json([ex.to_dict() for ex in iter_examples()], json_path)
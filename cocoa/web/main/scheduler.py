@@ -0,0 +1,187 @@
+import heapq
+import time
+from itertools import count
+from flask import request
+from flask_socketio import join_room
+
+from cocoa.sessions.human_session import HumanSession
+
+
+class LatencyStats(object):
+    """Latency of the scheduled steps of one chat.
+
+    lag: seconds between the time a step is due and the time it runs.
+    step: seconds spent in Controller.step (including model inference of bots).
+    """
+    def __init__(self):
+        self.num_steps = 0
+        self.num_events = 0
+        self.total_lag = 0.
+        self.max_lag = 0.
+        self.total_step = 0.
+        self.max_step = 0.
+
+    def update(self, lag, step_time, num_events):
+        self.num_steps += 1
+        self.num_events += num_events
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_step += step_time
+        self.max_step = max(self.max_step, step_time)
+
+    def to_dict(self):
+        n = float(max(self.num_steps, 1))
+        return {'num_steps': self.num_steps,
+                'num_events': self.num_events,
+                'mean_lag': self.total_lag / n,
+                'max_lag': self.max_lag,
+                'mean_step_time': self.total_step / n,
+                'max_step_time': self.max_step,
+                }
+
+
+class ChatScheduler(object):
+    """Run controllers on the server and push received events to users over a socket.
+
+    Without the scheduler, a chat only makes progress when a client polls /_check_inbox/, which steps the
+    controller of that chat (see Backend.receive). The scheduler keeps a timer heap of controllers keyed by the
+    time their next bot action is due (see TimedSessionWrapper.next_action_time) and steps each controller in a
+    background task when it is due, so that bot responses are generated off the request handlers and do not
+    depend on the client poll rate. Controllers are (re)scheduled when a user sends an event (Backend.send).
+
+    Events in the inbox of users who joined through the socket are pushed to them. Users who have not joined
+    (e.g. the socket failed to connect) keep receiving events by polling.
+    """
+    namespace = '/chat'
+
+    def __init__(self, app, socketio, get_backend, interval=0.1):
+        """
+        Params:
+        get_backend: Function that returns the Backend of the current app context.
+        interval: Maximum number of seconds to sleep between checking the heap. Also the step interval of bot
+            sessions that do not report their next action time or have nothing to send when they are due.
+        """
+        self.app = app
+        self.socketio = socketio
+        self.get_backend = get_backend
+        self.interval = interval
+        # Heap of (due time, sequence number, controller)
+        self.heap = []
+        self.counter = count()
+        # Map from id(controller) to the due time of its valid heap entry
+        self.due_time = {}
+        # Map from chat id to LatencyStats
+        self.latency = {}
+        # Map from socket session id to user id
+        self.subscribers = {}
+        self.running = False
+
+    def init_handlers(self):
+        self.socketio.on_event('join', self.on_join, namespace=self.namespace)
+        self.socketio.on_event('disconnect', self.on_disconnect, namespace=self.namespace)
+
+    def on_join(self, data):
+        userid = data['uid']
+        join_room(userid)
+        self.subscribers[request.sid] = userid
+        self.socketio.emit('joined', {}, room=request.sid, namespace=self.namespace)
+
+    def on_disconnect(self):
+        self.subscribers.pop(request.sid, None)
+
+    def start(self):
+        self.init_handlers()
+        self.running = True
+        self.socketio.start_background_task(self.run)
+
+    def stop(self):
+        self.running = False
+
+    def schedule(self, controller, due=None):
+        """Step `controller` at time `due` (now if not given), unless it is already due earlier.
+        """
+        if due is None:
+            due = time.time()
+        key = id(controller)
+        if key in self.due_time and self.due_time[key] <= due:
+            return
+        self.due_time[key] = due
+        heapq.heappush(self.heap, (due, next(self.counter), controller))
+
+    def next_due_time(self, controller):
+        """Return the earliest time at which a session of `controller` may send an event, or None.
+        """
+        due = None
+        for agent, session in enumerate(controller.sessions):
+            if session is None or isinstance(session, HumanSession):
+                continue
+            if not controller.allow_cross_talk and controller.session_status[agent] != 'received':
+                continue
+            if hasattr(session, 'next_action_time'):
+                t = session.next_action_time()
+            else:
+                t = time.time() + self.interval
+            if t is not None and (due is None or t < due):
+                due = t
+        return due
+
+    def run(self):
+        with self.app.app_context():
+            backend = self.get_backend()
+            while self.running:
+                self.run_due(backend)
+                self.push_events(backend)
+                now = time.time()
+                wait = self.interval if not self.heap else min(self.interval, self.heap[0][0] - now)
+                self.socketio.sleep(max(wait, 0))
+
+    def run_due(self, backend):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, controller = heapq.heappop(self.heap)
+            key = id(controller)
+            if self.due_time.get(key) != due:
+                # Stale entry: the controller has been rescheduled
+                continue
+            del self.due_time[key]
+            if controller.inactive():
+                continue
+            self.step(backend, controller, due)
+
+    def step(self, backend, controller, due):
+        chat_id = controller.get_chat_id()
+        num_events = len(controller.events)
+        start = time.time()
+        try:
+            controller.step(backend)
+        except Exception as e:
+            backend.logger.error('Failed to step chat {}: {}'.format(chat_id, e))
+            return
+        end = time.time()
+        if chat_id not in self.latency:
+            self.latency[chat_id] = LatencyStats()
+        self.latency[chat_id].update(start - due, end - start, len(controller.events) - num_events)
+
+        next_due = self.next_due_time(controller)
+        if next_due is None:
+            return
+        if next_due <= end and len(controller.events) == num_events:
+            # A session is due but had nothing to send (e.g. the bot's send() returned None): poll it again
+            # after an interval, as a client would, instead of stepping it (and running the model) right away
+            next_due = end + self.interval
+        self.schedule(controller, next_due)
+
+    def get_latency(self):
+        return {chat_id: stats.to_dict() for chat_id, stats in self.latency.iteritems()}
+
+    def push_events(self, backend):
+        for userid in set(self.subscribers.values()):
+            session = backend.sessions.get(userid)
+            if not isinstance(session, HumanSession):
+                continue
+            event = session.poll_inbox()
+            while event is not None:
+                data = backend.display_received_event(event)
+                self.socketio.emit('event', dict(received=True, timestamp=event.time, **data),
+                                   room=userid, namespace=self.namespace)
+                event = session.poll_inbox()
@@ -53,6 +53,15 @@ def check_inbox():
         return jsonify(received=False)
 
 
+@chat.route('/_scheduler_latency/', methods=['GET'])
+def scheduler_latency():
+    """Per-chat latency of server-side steps (empty if push_events is disabled)."""
+    scheduler = app.config.get('scheduler')
+    if scheduler is None:
+        return jsonify(chats={})
+    return jsonify(chats=scheduler.get_latency())
+
+
 @chat.route('/_typing_event/', methods=['GET'])
 def typing_event():
     backend = get_backend()
@@ -217,6 +226,7 @@ def index():
                                icon=app.config['task_icon'],
                                partner_kb=partner_kb,
                                quit_enabled=app.config['user_params']['skip_chat_enabled'],
+                               push=app.config['user_params'].get('push_events', False),
                                quit_after=app.config['user_params']['status_params']['chat']['num_seconds'] -
                                           app.config['user_params']['quit_after'])
     elif status == Status.Survey:
@@ -1,6 +1,8 @@
 from cocoa.core.event import Event as BaseEvent
 
 class Event(BaseEvent):
+    __slots__ = ()
+
     @staticmethod
     def OfferEvent(agent, data, time=None, metadata=None):
         return Event(agent, time, 'offer', data, metadata=metadata)
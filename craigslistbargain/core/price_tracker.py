@@ -4,11 +4,48 @@ from collections import defaultdict
 from itertools import chain
 
 from cocoa.core.entity import Entity, CanonicalEntity
-from cocoa.core.util import read_json, write_pickle, read_pickle
+from cocoa.core.util import read_json, write_pickle, read_pickle, LRUCache
 
 from tokenizer import tokenize
 
 
+class PriceContext(object):
+    '''
+    Price information of a KB that is needed for every utterance: numbers in the
+    listing, the list price and the parameters of PriceScaler. Each field is
+    computed the first time it is used. KBs do not change during a dialogue,
+    so contexts are shared through get_price_context.
+    '''
+    def __init__(self, kb):
+        self.kb = kb
+        self.list_price = kb.facts['item']['Price']
+        self._numbers = None
+        self._parameters = None
+
+    @property
+    def numbers(self):
+        if self._numbers is None:
+            self._numbers = PriceTracker._get_kb_numbers(self.kb)
+        return self._numbers
+
+    @property
+    def parameters(self):
+        '''
+        (slope, constant) of the linear mapping of PriceScaler.
+        '''
+        if self._parameters is None:
+            b, t = PriceScaler.get_price_range(self.kb)
+            self._parameters = PriceScaler.get_parameters(b, t)
+        return self._parameters
+
+
+# PriceContext of each KB (keyed by its id)
+price_contexts = LRUCache(1000)
+
+def get_price_context(kb):
+    return price_contexts.get_or_compute(id(kb), lambda: PriceContext(kb))
+
+
 class PriceScaler(object):
     @classmethod
     def get_price_range(cls, kb):
@@ -39,8 +76,7 @@ class PriceScaler(object):
     # TODO: this is operated on canonical entities, need to be consistent!
     def unscale_price(cls, kb, price):
         p = PriceTracker.get_price(price)
-        b, t = cls.get_price_range(kb)
-        w, c = cls.get_parameters(b, t)
+        w, c = get_price_context(kb).parameters
         assert w != 0
         p = (p - c) / w
         p = int(p)
@@ -51,8 +87,7 @@ class PriceScaler(object):
 
     @classmethod
     def _scale_price(cls, kb, p):
-        b, t = cls.get_price_range(kb)
-        w, c = cls.get_parameters(b, t)
+        w, c = get_price_context(kb).parameters
         p = w * p + c
         # Discretize to two digits
         p = float('{:.2f}'.format(p))
@@ -100,15 +135,19 @@ class PriceTracker(object):
             return False
 
     def get_kb_numbers(self, kb):
+        return get_price_context(kb).numbers
+
+    @classmethod
+    def _get_kb_numbers(cls, kb):
         title = tokenize(re.sub(r'[^\w0-9\.,]', ' ', kb.facts['item']['Title']))
         description = tokenize(re.sub(r'[^\w0-9\.,]', ' ', ' '.join(kb.facts['item']['Description'])))
         numbers = set()
         for token in chain(title, description):
             try:
-                numbers.add(float(self.process_string(token)))
+                numbers.add(float(cls.process_string(token)))
             except ValueError:
                 continue
-        return numbers
+        return frozenset(numbers)
 
     def link_entity(self, raw_tokens, kb=None, scale=True, price_clip=None):
         """
@@ -127,13 +166,13 @@ class PriceTracker(object):
         tokens = ['<s>'] + raw_tokens + ['</s>']
         entity_tokens = []
         if kb:
-            kb_numbers = self.get_kb_numbers(kb)
-            list_price = kb.facts['item']['Price']
+            price_context = get_price_context(kb)
+            list_price = price_context.list_price
+        has_dollar = lambda token: token[0] == '$' or token[-1] == '$'
         for i in xrange(1, len(tokens)-1):  # Ignore the start and end tokens that were just added
             token = tokens[i]
             try:
                 number = float(self.process_string(token))
-                has_dollar = lambda token: token[0] == '$' or token[-1] == '$'
                 # Check context
                 if not has_dollar(token) and \
                         not self.is_price(tokens[i-1], tokens[i+1]):
@@ -147,7 +186,7 @@ class PriceTracker(object):
                         if number > 1.5 * list_price:
                             number = None
                         # Probably a spec number
-                        if number != list_price and number in kb_numbers:
+                        if number != list_price and number in price_context.numbers:
                             number = None
                     if number is not None and price_clip is not None:
                         scaled_price = PriceScaler._scale_price(kb, number)
@@ -1,8 +1,31 @@
 import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
+from nltk.tokenize import word_tokenize as nltk_word_tokenize
 import re
 import string
+import threading
+
+from cocoa.core.util import LRUCache
+
+_punkt_lock = threading.Lock()
+_punkt_loaded = False
+
+def _load_punkt():
+    '''
+    Download the punkt model the first time it is needed instead of on import.
+    '''
+    global _punkt_loaded
+    with _punkt_lock:
+        if not _punkt_loaded:
+            try:
+                nltk.data.find('tokenizers/punkt')
+            except LookupError:
+                nltk.download('punkt')
+            _punkt_loaded = True
+
+def word_tokenize(text):
+    if not _punkt_loaded:
+        _load_punkt()
+    return nltk_word_tokenize(text)
 
 def is_number(s):
     if re.match(r'[.,0-9]+', s):
@@ -53,21 +76,32 @@ def stick_marker_sign(tokens):
             in_brackets = False
     return new_tokens
 
+# Tokenized utterances (templates and bot utterances repeat a lot)
+token_cache = LRUCache(10000)
+
+_DOTS = re.compile(r'\.{2,}')
+_WEIRD_CHARS = re.compile(r'\\|>|/')
+
 def tokenize(utterance, lowercase=True):
     '''
     'hi there!' => ['hi', 'there', '!']
     '''
-    #utterance = utterance.encode('utf-8')
-    if lowercase:
-        utterance = utterance.lower()
-    # NLTK would not tokenize "xx..", so normalize dots to "...".
-    utterance = re.sub(r'\.{2,}', '...', utterance)
-    # Remove some weird chars
-    utterance = re.sub(r'\\|>|/', ' ', utterance)
-    tokens = word_tokenize(utterance)
-    #tokens = stick_marker_sign(tokens)
-    tokens = stick_dollar_sign(tokens)
-    return tokens
+    key = (utterance, lowercase)
+    tokens = token_cache.get(key)
+    if tokens is None:
+        #utterance = utterance.encode('utf-8')
+        if lowercase:
+            utterance = utterance.lower()
+        # NLTK would not tokenize "xx..", so normalize dots to "...".
+        utterance = _DOTS.sub('...', utterance)
+        # Remove some weird chars
+        utterance = _WEIRD_CHARS.sub(' ', utterance)
+        tokens = word_tokenize(utterance)
+        #tokens = stick_marker_sign(tokens)
+        tokens = tuple(stick_dollar_sign(tokens))
+        token_cache.put(key, tokens)
+    # Callers may modify the tokens
+    return list(tokens)
 
 def detokenize(tokens):
     new_tokens = []
@@ -84,4 +118,3 @@ def detokenize(tokens):
 if __name__ == '__main__':
     print tokenize("i have 10,000$!..")
     print tokenize("i haven't $10,000")
-
@@ -3,16 +3,14 @@ from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseG
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
-    def get_filter(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
-        locs = [super(Generator, self).get_filter(used_templates)]
+    def get_filters(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
         assert category and role
-        self._add_filter(locs, self.templates.role == role)
-        self._add_filter(locs, self.templates.category == category)
+        levels = [{'role': role}, {'category': category}]
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            levels.append({'tag': tag})
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            levels.append({'context_tag': context_tag})
+        return levels
 
 class Templates(BaseTemplates):
     def ambiguous_template(self, template):
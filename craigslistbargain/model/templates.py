@@ -7,6 +7,7 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from cocoa.core.dataset import read_examples
 from cocoa.core.entity import is_entity
 from cocoa.core.util import read_pickle, write_json
+from cocoa.model.generator import TemplateIndex
 
 from core.scenario import Scenario
 from core.tokenizer import detokenize
@@ -29,18 +30,18 @@ class Templates(object):
         # TODO: context + response?
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix)
 
     def search(self, context, category=None, role=None, context_tag=None, response_tag=None, used_templates=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates).values
+        assert category and role
+        levels = [{'category': category, 'role': role}]
+        if response_tag:
+            levels.append({'response_tag': response_tag})
+        if context_tag:
+            levels.append({'context_tag': context_tag})
         features = self.vectorizer.transform([context])
-        scores = self.tfidf_matrix * features.T
-
-        scores = scores.todense()[loc]
-        rows = self.templates[loc]
-
-        scores = np.squeeze(np.array(scores))
-        ids = np.argsort(scores)[::-1][:20]
-        rows = rows.iloc[ids]
+        ids = self.index.search(features, levels, used_templates=used_templates, topk=20)
+        rows = self.templates.iloc[ids]
         counts = rows['count'].values
         return self.sample(counts, rows, T=T)
 
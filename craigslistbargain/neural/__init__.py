@@ -19,7 +19,8 @@ def get_data_generator(args, model_args, schema, test=False):
 
     preprocessor = Preprocessor(schema, lexicon, model_args.entity_encoding_form,
         model_args.entity_decoding_form, model_args.entity_target_form,
-        model=model_args.model)
+        model=model_args.model, num_workers=args.preprocess_workers,
+        chunk_size=args.preprocess_chunk_size)
 
     if test:
         model_args.dropout = 0
@@ -30,10 +31,20 @@ def get_data_generator(args, model_args, schema, test=False):
         cache=args.cache, ignore_cache=args.ignore_cache,
         num_context=model_args.num_context,
         batch_size=args.batch_size,
-        model=model_args.model)
+        model=model_args.model,
+        input_files=get_input_files(args, model_args),
+        prebuild=args.prebuild_batches)
 
     return data_generator
 
+def get_input_files(args, model_args):
+    '''
+    Files that the preprocessed data depends on (see DataGenerator).
+    '''
+    paths = list(args.train_examples_paths) + list(args.test_examples_paths)
+    paths.extend([model_args.schema_path, model_args.price_tracker_model])
+    return [p for p in paths if p]
+
 def check_model_args(args):
     if args.pretrained_wordvec:
         if isinstance(args.pretrained_wordvec, list):
@@ -1,5 +1,6 @@
+import copy
 import numpy as np
-from itertools import izip_longest, izip
+from itertools import izip
 
 import torch
 from torch.autograd import Variable
@@ -11,11 +12,52 @@ def pad_list_to_array(l, fillvalue, dtype):
     l: list of lists with unequal length
     return: np array with minimal padding
     '''
-    return np.array(list(izip_longest(*l, fillvalue=fillvalue)), dtype=dtype).T
+    lengths = np.array([len(x) for x in l], dtype=np.int64)
+    max_len = lengths.max() if len(l) > 0 else 0
+    if max_len == 0:
+        return np.array([], dtype=dtype)
+    array = np.full([len(l), max_len], fillvalue, dtype=dtype)
+    array[sequence_mask(lengths, max_len)] = [x for seq in l for x in seq]
+    return array
+
+def sequence_mask(lengths, max_len):
+    '''
+    lengths: (batch_size,)
+    return: (batch_size, max_len) bool array, True where j < lengths[i]
+    '''
+    return np.arange(max_len) < lengths[:, None]
+
+def first_index(array, value):
+    '''
+    Index of the first occurrence of value in each row of array (num_cols if absent).
+    '''
+    nrows, ncols = array.shape
+    if ncols == 0:
+        return np.zeros(nrows, dtype=np.int64)
+    match = (array == value)
+    return np.where(match.any(axis=1), match.argmax(axis=1), ncols)
+
+def last_index(array, value):
+    '''
+    Index of the last occurrence of value in each row of array (-1 if absent).
+    '''
+    nrows, ncols = array.shape
+    if ncols == 0:
+        return np.full(nrows, -1, dtype=np.int64)
+    match = (array == value)
+    return np.where(match.any(axis=1), ncols - 1 - match[:, ::-1].argmax(axis=1), -1)
 
 class Batch(object):
+    tensor_attributes = ('encoder_inputs', 'decoder_inputs', 'title_inputs', 'desc_inputs',
+            'targets', 'context_inputs', 'lengths', 'tgt_lengths')
+
     def __init__(self, encoder_args, decoder_args, context_data, vocab,
-                time_major=True, sort_by_length=True, num_context=None, cuda=False):
+                time_major=True, sort_by_length=True, num_context=None, cuda=False,
+                pin_memory=False):
+        '''
+        pin_memory: keep CPU tensors in page-locked memory so that a batch built
+            ahead of time is copied to the GPU faster (see Batch.cuda).
+        '''
         self.vocab = vocab
         self.num_context = num_context
         self.encoder_inputs = encoder_args['inputs']
@@ -50,48 +92,59 @@ class Batch(object):
                 setattr(self, attr, np.swapaxes(getattr(self, attr), 0, 1))
 
         # To tensor/variable
-        self.encoder_inputs = self.to_variable(self.encoder_inputs, 'long', cuda)
-        self.decoder_inputs = self.to_variable(self.decoder_inputs, 'long', cuda)
-        self.title_inputs = self.to_variable(self.title_inputs, 'long', cuda)
-        self.desc_inputs = self.to_variable(self.desc_inputs, 'long', cuda)
-        self.targets = self.to_variable(self.targets, 'long', cuda)
-        self.lengths = self.to_tensor(self.lengths, 'long', cuda)
-        self.tgt_lengths = self.to_tensor(self.tgt_lengths, 'long', cuda)
+        self.encoder_inputs = self.to_variable(self.encoder_inputs, 'long', cuda, pin_memory)
+        self.decoder_inputs = self.to_variable(self.decoder_inputs, 'long', cuda, pin_memory)
+        self.title_inputs = self.to_variable(self.title_inputs, 'long', cuda, pin_memory)
+        self.desc_inputs = self.to_variable(self.desc_inputs, 'long', cuda, pin_memory)
+        self.targets = self.to_variable(self.targets, 'long', cuda, pin_memory)
+        self.lengths = self.to_tensor(self.lengths, 'long', cuda, pin_memory)
+        self.tgt_lengths = self.to_tensor(self.tgt_lengths, 'long', cuda, pin_memory)
         if num_context > 0:
-            self.context_inputs = self.to_variable(self.context_inputs, 'long', cuda)
+            self.context_inputs = self.to_variable(self.context_inputs, 'long', cuda, pin_memory)
+
+    # numpy dtype of the tensors
+    np_dtypes = {
+            'long': np.int64,
+            'float': np.float32,
+            }
 
     @classmethod
-    def to_tensor(cls, data, dtype, cuda=False):
-        if type(data) == np.ndarray:
-            data = data.tolist()
-        if dtype == "long":
-            tensor = torch.LongTensor(data)
-        elif dtype == "float":
-            tensor = torch.FloatTensor(data)
-        else:
+    def to_tensor(cls, data, dtype, cuda=False, pin_memory=False):
+        if dtype not in cls.np_dtypes:
             raise ValueError
-        return tensor.cuda() if cuda else tensor
+        # One conversion to a contiguous array of the tensor type, then shared by the tensor
+        data = np.ascontiguousarray(data, dtype=cls.np_dtypes[dtype])
+        tensor = torch.from_numpy(data)
+        if cuda:
+            return tensor.cuda()
+        return tensor.pin_memory() if pin_memory else tensor
 
     @classmethod
-    def to_variable(cls, data, dtype, cuda=False):
-        tensor = cls.to_tensor(data, dtype)
+    def to_variable(cls, data, dtype, cuda=False, pin_memory=False):
+        tensor = cls.to_tensor(data, dtype, pin_memory=pin_memory)
         var = Variable(tensor)
         return var.cuda() if cuda else var
 
+    def cuda(self):
+        '''
+        Return a copy of the batch with tensors on the GPU.
+        '''
+        batch = copy.copy(self)
+        for attr in self.tensor_attributes:
+            if hasattr(self, attr):
+                setattr(batch, attr, getattr(self, attr).cuda())
+        return batch
+
     def sort_by_length(self, inputs):
         """
         Args:
             inputs (numpy.ndarray): (batch_size, seq_length)
         """
         pad = self.vocab.word_to_ind[markers.PAD]
-        def get_length(seq):
-            for i, x in enumerate(seq):
-                if x == pad:
-                    return i
-            return len(seq)
-        lengths = [get_length(s) for s in inputs]
+        # Length is the position of the first PAD
+        lengths = first_index(inputs, pad)
         # TODO: look into how it works for all-PAD seqs
-        lengths = [l if l > 0 else 1 for l in lengths]
+        lengths = np.maximum(lengths, 1)
         sorted_id = np.argsort(lengths)[::-1]
         return lengths, sorted_id
 
@@ -100,7 +153,7 @@ class Batch(object):
             return inputs
         else:
             if type(inputs) is np.ndarray:
-                return inputs[ids, :]
+                return inputs[ids]
             elif type(inputs) is list:
                 return [inputs[i] for i in ids]
             else:
@@ -164,6 +217,36 @@ class DialogueBatcher(object):
                 'description': description_batch,
                 }
 
+    def stack_batch_args(self, batch_args):
+        '''
+        Stack (encoder_args, decoder_args, context_data) of single examples
+        (e.g. from different sessions) into the args of one padded batch.
+        '''
+        def stack(arrays, pad):
+            return pad_list_to_array([row for array in arrays for row in array], pad, np.int32)
+
+        encoder_args = [a[0] for a in batch_args]
+        decoder_args = [a[1] for a in batch_args]
+        context_data = [a[2] for a in batch_args]
+        num_context = len(encoder_args[0]['context'])
+        decoder_inputs = stack([a['inputs'] for a in decoder_args], self.pad)
+        kb_context = [a['context'] for a in decoder_args]
+        return {
+                'inputs': stack([a['inputs'] for a in encoder_args], self.pad),
+                'context': [stack([a['context'][i] for a in encoder_args], self.pad)
+                    for i in xrange(num_context)],
+                }, {
+                'inputs': decoder_inputs,
+                'targets': np.copy(decoder_inputs),
+                'context': {
+                    'category': np.concatenate([c['category'] for c in kb_context]),
+                    'title': stack([c['title'] for c in kb_context], self.kb_pad),
+                    'description': stack([c['description'] for c in kb_context], self.kb_pad),
+                    },
+                }, {
+                k: [x for c in context_data for x in c[k]] for k in context_data[0]
+                }
+
     def _get_agent_batch_at(self, dialogues, i):
         return [dialogue.agents[i] for dialogue in dialogues]
 
@@ -172,12 +255,9 @@ class DialogueBatcher(object):
 
     def _remove_last(self, array, value, pad):
         array = np.copy(array)
-        nrows, ncols = array.shape
-        for i in xrange(nrows):
-            for j in xrange(ncols-1, -1, -1):
-                if array[i][j] == value:
-                    array[i][j] = pad
-                    break
+        last = last_index(array, value)
+        rows = np.nonzero(last >= 0)[0]
+        array[rows, last[rows]] = pad
         return array
 
     def _remove_prompt(self, input_arr):
@@ -0,0 +1,186 @@
+'''
+Content-addressed cache of integerized dialogues.
+
+Each cache entry is a directory named by a hash of the input files and the
+preprocessing options. For each fold it stores
+    <fold>.tokens.npy: all integer sequences concatenated (int32)
+    <fold>.offsets.npy: start of each sequence in tokens, plus the end (int64)
+    <fold>.index.npy: one row per dialogue (see INDEX_COLUMNS)
+    <fold>.batches.npy: start of each batch in the dialogue list, plus the end
+    <fold>.meta.bin: pickled non-integer data of each dialogue (uuid, kb, tokens)
+The arrays are memory-mapped and dialogues are read one batch at a time.
+'''
+
+import os
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+from cocoa.core.util import write_json
+
+# Columns of <fold>.index.npy
+INDEX_COLUMNS = ('seq_start', 'num_turns', 'category', 'meta_offset', 'meta_size')
+SEQ_START, NUM_TURNS, CATEGORY, META_OFFSET, META_SIZE = range(len(INDEX_COLUMNS))
+# Sequences of each turn: encoding, decoding, target, lf
+SEQS_PER_TURN = 4
+# Sequences before the turns: title, description
+NUM_KB_SEQS = 2
+
+
+def hash_file(path, chunk_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        while True:
+            chunk = fin.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DialogueCache(object):
+    # Increase when the stored format changes
+    version = 1
+
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+        self.path = os.path.join(root, key)
+
+    @classmethod
+    def get_key(cls, input_files, options):
+        '''
+        Hash of the content of `input_files` and the preprocessing `options` (dict).
+        '''
+        h = hashlib.sha1()
+        h.update('version={}\n'.format(cls.version))
+        for path in input_files:
+            h.update('{}\n'.format(hash_file(path)))
+        for k in sorted(options):
+            h.update('{}={}\n'.format(k, options[k]))
+        return h.hexdigest()
+
+    def _file(self, fold, name):
+        return os.path.join(self.path, '{}.{}'.format(fold, name))
+
+    def _manifest_path(self, fold):
+        return self._file(fold, 'manifest.json')
+
+    def exists(self, fold):
+        return os.path.exists(self._manifest_path(fold))
+
+    def write(self, fold, dialogues, batch_size, options=None):
+        '''
+        Write integerized `dialogues` of `fold` in the order they are batched,
+        i.e. batch i contains dialogues[i*batch_size:(i+1)*batch_size].
+        '''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        lengths = []
+        tokens = []
+        index = np.zeros([len(dialogues), len(INDEX_COLUMNS)], dtype=np.int64)
+        meta_offset = 0
+        with open(self._file(fold, 'meta.bin'), 'wb') as fout:
+            for i, d in enumerate(dialogues):
+                assert d.is_int
+                seqs = [d.title, d.description]
+                for turn in xrange(d.num_turns):
+                    seqs.extend([d.turns[0][turn], d.turns[1][turn], d.turns[2][turn], d.lfs[turn]])
+                index[i, SEQ_START] = len(lengths)
+                index[i, NUM_TURNS] = d.num_turns
+                index[i, CATEGORY] = d.category
+                for seq in seqs:
+                    lengths.append(len(seq))
+                    tokens.extend(seq)
+
+                meta = pickle.dumps((d.uuid, d.agent, d.kb, d.agents, d.token_turns), pickle.HIGHEST_PROTOCOL)
+                fout.write(meta)
+                index[i, META_OFFSET] = meta_offset
+                index[i, META_SIZE] = len(meta)
+                meta_offset += len(meta)
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        batches = np.append(np.arange(0, len(dialogues), batch_size), len(dialogues)).astype(np.int64)
+
+        np.save(self._file(fold, 'tokens.npy'), np.array(tokens, dtype=np.int32))
+        np.save(self._file(fold, 'offsets.npy'), offsets)
+        np.save(self._file(fold, 'index.npy'), index)
+        np.save(self._file(fold, 'batches.npy'), batches)
+
+        # Written last: a fold without a manifest is incomplete
+        manifest = {
+                'version': self.version,
+                'num_dialogues': len(dialogues),
+                'num_batches': len(batches) - 1,
+                'num_tokens': len(tokens),
+                'options': options or {},
+                }
+        write_json(manifest, self._manifest_path(fold))
+
+    def load(self, fold):
+        return CachedFold(self, fold)
+
+
+class CachedFold(object):
+    '''
+    Memory-mapped dialogues of one fold of a DialogueCache.
+    '''
+    def __init__(self, cache, fold):
+        self.tokens = np.load(cache._file(fold, 'tokens.npy'), mmap_mode='r')
+        self.offsets = np.load(cache._file(fold, 'offsets.npy'), mmap_mode='r')
+        self.index = np.load(cache._file(fold, 'index.npy'), mmap_mode='r')
+        self.batches = np.load(cache._file(fold, 'batches.npy'))
+        self.meta_path = cache._file(fold, 'meta.bin')
+
+    @property
+    def num_dialogues(self):
+        return self.index.shape[0]
+
+    @property
+    def num_batches(self):
+        return len(self.batches) - 1
+
+    def num_turns(self, batch_id):
+        '''
+        Number of turns of the longest dialogue in the batch.
+        '''
+        start, end = int(self.batches[batch_id]), int(self.batches[batch_id+1])
+        return int(np.max(self.index[start:end, NUM_TURNS]))
+
+    def _get_seqs(self, start, num_seqs):
+        offsets = self.offsets[start:start+num_seqs+1].tolist()
+        base = offsets[0]
+        tokens = self.tokens[base:offsets[-1]].tolist()
+        return [tokens[offsets[i]-base:offsets[i+1]-base] for i in xrange(num_seqs)]
+
+    def get_dialogue_fields(self, i, meta_file):
+        '''
+        Return a dict of the fields of the i-th dialogue (see Dialogue.from_cache).
+        '''
+        row = self.index[i]
+        num_turns = int(row[NUM_TURNS])
+        seqs = self._get_seqs(int(row[SEQ_START]), NUM_KB_SEQS + SEQS_PER_TURN * num_turns)
+        turn_seqs = seqs[NUM_KB_SEQS:]
+
+        meta_file.seek(int(row[META_OFFSET]))
+        uuid, agent, kb, agents, token_turns = pickle.loads(meta_file.read(int(row[META_SIZE])))
+
+        return {
+                'uuid': uuid,
+                'agent': agent,
+                'kb': kb,
+                'agents': agents,
+                'token_turns': token_turns,
+                'category': int(row[CATEGORY]),
+                'title': seqs[0],
+                'description': seqs[1],
+                'turns': [turn_seqs[stage::SEQS_PER_TURN] for stage in xrange(3)],
+                'lfs': turn_seqs[3::SEQS_PER_TURN],
+                }
+
+    def get_batch_fields(self, batch_id):
+        start, end = int(self.batches[batch_id]), int(self.batches[batch_id+1])
+        with open(self.meta_path, 'rb') as meta_file:
+            return [self.get_dialogue_fields(i, meta_file) for i in xrange(start, end)]
@@ -42,6 +42,7 @@ class LFSampler(Sampler):
         # (2) Sampling
         batch_size = batch.size
         preds = []
+        logprobs = self.tt.FloatTensor(batch_size).zero_()
         for i in xrange(self.max_length):
             # Outputs to probs
             dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
@@ -67,6 +68,7 @@ class LFSampler(Sampler):
             scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
             pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
             preds.append(pred)
+            logprobs += out.gather(1, pred.view(-1, 1)).squeeze(1)
             if pred[0] == self.eos:
                 break
             # Forward step
@@ -75,19 +77,7 @@ class LFSampler(Sampler):
                 inp, memory_bank, dec_states, memory_lengths=lengths)
 
         preds = torch.stack(preds).t()  # (batch_size, seq_len)
-        # Insert one dimension (n_best) so that its structure is consistent
-        # with beam search generator
-        preds = preds.unsqueeze(1)
-        # TODO: add actual scores
-        ret = {"predictions": preds,
-               "scores": [[0]] * batch_size,
-               "attention": [None] * batch_size,
-               "dec_states": dec_states,
-               }
-
-        ret["gold_score"] = [0] * batch_size
-        ret["batch"] = batch
-        return ret
+        return self._make_output(batch, preds, logprobs, dec_states)
 
 
 def get_generator(model, vocab, scorer, args, model_args):
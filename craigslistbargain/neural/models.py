@@ -1,13 +1,45 @@
+import weakref
 import torch.nn as nn
 
+from cocoa.core.util import LRUCache
 from cocoa.neural.models import NMTModel
 
+# (weakref to the model, KBs, memory banks) keyed by the model version and the ids of the KBs of a batch
+kb_encodings = LRUCache(1000)
+
+
 class NegotiationModel(NMTModel):
 
     def __init__(self, encoder, decoder, context_embedder, kb_embedder, stateful=False):
         super(NegotiationModel, self).__init__(encoder, decoder, stateful=stateful)
         self.context_embedder = context_embedder
         self.kb_embedder = kb_embedder
+        # Incremented when the parameters change so that cached KB encodings are not reused
+        self.version = 0
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        super(NegotiationModel, self).load_state_dict(state_dict, *args, **kwargs)
+        self.version += 1
+
+    def encode_kb(self, title, desc, kbs=None):
+        '''
+        Memory banks of the title and the description. The KB context does not
+        change during a dialogue, so if `kbs` (KB of each example) is given the
+        banks are computed once and then read from kb_encodings.
+        '''
+        def compute():
+            _, title_memory_bank = self.kb_embedder(title)
+            _, desc_memory_bank = self.kb_embedder(desc)
+            return title_memory_bank, desc_memory_bank
+        if kbs is None:
+            return compute()
+        key = (id(self), self.version, self.training, tuple(id(kb) for kb in kbs))
+        entry = kb_encodings.get(key)
+        if entry is None or entry[0]() is not self:
+            memory_banks = tuple(bank.detach() for bank in compute())
+            entry = (weakref.ref(self), list(kbs), memory_banks)
+            kb_encodings.put(key, entry)
+        return entry[2]
 
     def forward(self, src, tgt, context, title, desc, lengths, dec_state=None, enc_state=None, tgt_lengths=None):
         enc_final, enc_memory_bank = self.encoder(src, lengths, enc_state)
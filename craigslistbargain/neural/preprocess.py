@@ -6,8 +6,10 @@ import random
 import re
 import time
 import os
+import multiprocessing
 import numpy as np
 from itertools import izip
+from collections import defaultdict
 
 from cocoa.core.util import read_pickle, write_pickle, read_json
 from cocoa.core.entity import Entity, CanonicalEntity, is_entity
@@ -16,6 +18,7 @@ from cocoa.model.vocab import Vocabulary
 from core.price_tracker import PriceTracker, PriceScaler
 from core.tokenizer import tokenize
 from batcher import DialogueBatcherFactory, Batch
+from data_cache import DialogueCache
 from symbols import markers
 from vocab_builder import create_mappings
 from neural import make_model_mappings
@@ -60,13 +63,13 @@ class TextIntMap(object):
         or ground truth.
         '''
         tokens = self.preprocessor.process_utterance(utterance, stage)
-        return [self.vocab.to_ind(token) for token in tokens]
+        return self.vocab.to_inds(tokens)
 
     def int_to_text(self, inds, stage=None, prices=None):
         '''
         Inverse of text_to_int.
         '''
-        toks = [self.vocab.to_word(ind) for ind in inds]
+        toks = self.vocab.to_words(inds)
         if prices is not None:
             assert len(inds) == len(prices)
             toks = [CanonicalEntity(value=p, type='price') if price_filler(x) else x for x, p in izip(toks, prices)]
@@ -114,6 +117,32 @@ class Dialogue(object):
         self.is_int = False  # Whether we've converted it to integers
         self.num_context = None
 
+    @classmethod
+    def from_cache(cls, fields, model='seq2seq'):
+        '''
+        Create an integerized dialogue from the fields read from a DialogueCache
+        (see CachedFold.get_dialogue_fields).
+        '''
+        dialogue = cls.__new__(cls)
+        dialogue.uuid = fields['uuid']
+        dialogue.agent = fields['agent']
+        dialogue.kb = fields['kb']
+        dialogue.model = model
+        dialogue.agent_to_role = cls.get_role_mapping(dialogue.agent, dialogue.kb)
+        dialogue.category_str = dialogue.kb.category
+        dialogue.category = fields['category']
+        dialogue.title = fields['title']
+        dialogue.description = fields['description']
+        dialogue.token_turns = fields['token_turns']
+        dialogue.lfs = fields['lfs']
+        dialogue.turns = fields['turns']
+        dialogue.entities = [[x if is_entity(x) else None for x in turn] for turn in dialogue.token_turns]
+        dialogue.agents = fields['agents']
+        dialogue.roles = [dialogue.agent_to_role[agent] for agent in dialogue.agents]
+        dialogue.is_int = True
+        dialogue.num_context = None
+        return dialogue
+
     @property
     def num_turns(self):
         return len(self.turns[0])
@@ -221,14 +250,14 @@ class Dialogue(object):
 
     def kb_context_to_int(self):
         self.category = self.mappings['cat_vocab'].to_ind(self.category)
-        self.title = map(self.mappings['kb_vocab'].to_ind, self.title)
-        self.description = map(self.mappings['kb_vocab'].to_ind, self.description)
+        self.title = self.mappings['kb_vocab'].to_inds(self.title)
+        self.description = self.mappings['kb_vocab'].to_inds(self.description)
 
     def lf_to_int(self):
         self.lf_token_turns = []
         for i, lf in enumerate(self.lfs):
             self.lf_token_turns.append(lf)
-            self.lfs[i] = map(self.mappings['lf_vocab'].to_ind, lf)
+            self.lfs[i] = self.mappings['lf_vocab'].to_inds(lf)
 
     def convert_to_int(self):
         if self.is_int:
@@ -277,7 +306,14 @@ class Preprocessor(object):
     Preprocess raw utterances: tokenize, entity linking.
     Convert an Example into a Dialogue data structure used by DataGenerator.
     '''
-    def __init__(self, schema, lexicon, entity_encoding_form, entity_decoding_form, entity_target_form, model='seq2seq'):
+    def __init__(self, schema, lexicon, entity_encoding_form, entity_decoding_form, entity_target_form, model='seq2seq',
+            num_workers=1, chunk_size=100):
+        '''
+        num_workers: number of processes used by preprocess; each worker has a copy of the lexicon.
+        chunk_size: number of examples sent to a worker at a time.
+        '''
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
         self.attributes = schema.attributes
         self.attribute_types = schema.get_attributes()
         self.lexicon = lexicon
@@ -342,23 +378,26 @@ class Preprocessor(object):
             tokens.append(PriceScaler.scale_price(kb, price))
         return tokens
 
-    def _process_example(self, ex):
+    def _process_example(self, ex, event_tokens=None):
         """
         Convert example to turn-based dialogue from each agent's perspective
         Create two Dialogue objects for each example
         :type ex: cocoa.core.dataset.Example
+        :param event_tokens: tokenized messages (see tokenize_messages)
         :return: a generator that creates two dialogues, one for the buyer and seller
         """
         kbs = ex.scenario.kbs
+        if event_tokens is None:
+            event_tokens = [None] * len(ex.events)
         for agent in (0, 1):
             dialogue = Dialogue(agent, kbs[agent], ex.ex_id, model=self.model)
-            for e in ex.events:
+            for e, tokens in izip(ex.events, event_tokens):
                 if self.model in ('lf2lf',):
                     lf = e.metadata
                     assert lf is not None
                     utterance = self.lf_to_tokens(dialogue.kb, lf)
                 else:
-                    utterance = self.process_event(e, dialogue.kb)
+                    utterance = self.process_event(e, dialogue.kb, tokens=tokens)
                 if utterance:
                     dialogue.add_utterance(e.agent, utterance, lf=e.metadata)
             yield dialogue
@@ -367,13 +406,16 @@ class Preprocessor(object):
     def price_to_entity(cls, price):
         return Entity(price, CanonicalEntity(price, 'price'))
 
-    def process_event(self, e, kb):
+    def process_event(self, e, kb, tokens=None):
         '''
         Tokenize, link entities
+        tokens: tokenized message if already available
         '''
         if e.action == 'message':
             # Lower, tokenize, link entity
-            entity_tokens = self.lexicon.link_entity(tokenize(e.data), kb=kb, scale=True, price_clip=4.)
+            if tokens is None:
+                tokens = tokenize(e.data)
+            entity_tokens = self.lexicon.link_entity(tokens, kb=kb, scale=True, price_clip=4.)
             if entity_tokens:
                 return entity_tokens
             else:
@@ -398,16 +440,25 @@ class Preprocessor(object):
             raise ValueError('Unknown event action.')
 
     @classmethod
-    def skip_example(cls, example):
+    def tokenize_messages(cls, example):
+        '''
+        Return the tokens of each event (None for non-message events).
+        '''
+        return [tokenize(event.data) if event.action == 'message' else None for event in example.events]
+
+    @classmethod
+    def skip_example(cls, example, event_tokens=None):
         """
         Skip all examples that do not have enough tokens or turns to be a good example
+        :param event_tokens: tokenized messages (see tokenize_messages)
         :return: True if both agents speak less then 40 tokens of if the dialogue has less than two turns
         """
+        if event_tokens is None:
+            event_tokens = cls.tokenize_messages(example)
         tokens = {0: 0, 1: 0}
         turns = {0: 0, 1: 0}
-        for event in example.events:
+        for event, msg_tokens in izip(example.events, event_tokens):
             if event.action == "message":
-                msg_tokens = tokenize(event.data)
                 tokens[event.agent] += len(msg_tokens)
                 turns[event.agent] += 1
         if tokens[0] < 40 and tokens[1] < 40:
@@ -416,36 +467,134 @@ class Preprocessor(object):
             return True
         return False
 
-    def preprocess(self, examples):
+    def preprocess_shard(self, examples):
+        '''
+        Serially preprocess a list of examples.
+        Return the dialogues and the PreprocessStats of each stage.
+        '''
+        stats = PreprocessStats()
         dialogues = []
         for ex in examples:
-            if self.skip_example(ex):
+            start_time = time.time()
+            event_tokens = self.tokenize_messages(ex)
+            stats.add('tokenize', sum([1 for t in event_tokens if t is not None]), time.time() - start_time)
+
+            start_time = time.time()
+            skip = self.skip_example(ex, event_tokens)
+            stats.add('filter', 1, time.time() - start_time)
+            if skip:
                 continue
-            for d in self._process_example(ex):
-                dialogues.append(d)
+
+            start_time = time.time()
+            new_dialogues = list(self._process_example(ex, event_tokens))
+            stats.add('link_entity', len(new_dialogues), time.time() - start_time)
+            dialogues.extend(new_dialogues)
+        return dialogues, stats
+
+    def preprocess(self, examples):
+        '''
+        Preprocess examples in self.num_workers processes. Examples are split
+        into shards of self.chunk_size and the dialogues are returned in the
+        order of the examples, i.e. the same as with one process.
+        '''
+        start_time = time.time()
+        if self.num_workers <= 1:
+            dialogues, stats = self.preprocess_shard(examples)
+        else:
+            dialogues, stats = [], PreprocessStats()
+            # NOTE: slices of a LazyDataset open their own file handles in the worker
+            shards = [examples[i:i+self.chunk_size] for i in xrange(0, len(examples), self.chunk_size)]
+            pool = multiprocessing.Pool(self.num_workers, initializer=_init_preprocess_worker, initargs=(self,))
+            try:
+                for shard_dialogues, shard_stats in pool.imap(_preprocess_shard, shards):
+                    dialogues.extend(shard_dialogues)
+                    stats.update(shard_stats)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        stats.report(time.time() - start_time, self.num_workers)
         return dialogues
 
+class PreprocessStats(object):
+    '''
+    Number of items processed and time spent in each preprocessing stage:
+        tokenize: messages tokenized
+        filter: examples checked by skip_example
+        link_entity: dialogues created (entity linking, lf)
+    '''
+    stages = ('tokenize', 'filter', 'link_entity')
+
+    def __init__(self):
+        self.count = defaultdict(int)
+        self.time = defaultdict(float)
+
+    def add(self, stage, count, seconds):
+        self.count[stage] += count
+        self.time[stage] += seconds
+
+    def update(self, other):
+        for stage in other.count:
+            self.add(stage, other.count[stage], other.time[stage])
+
+    def report(self, elapsed, num_workers=1):
+        print 'Preprocessed in %.2fs with %d worker(s)' % (elapsed, num_workers)
+        for stage in self.stages:
+            t = self.time[stage]
+            print '  %s: %d in %.2fs (%.1f/s per worker)' % (stage, self.count[stage], t, self.count[stage] / t if t > 0 else 0.)
+
+# Preprocessor of each pool process
+_preprocessor = None
+
+def _init_preprocess_worker(preprocessor):
+    global _preprocessor
+    _preprocessor = preprocessor
+
+def _preprocess_shard(examples):
+    return _preprocessor.preprocess_shard(examples)
+
 class DataGenerator(object):
     def __init__(self, train_examples, dev_examples, test_examples, preprocessor,
             schema, mappings_path=None, cache='.cache',
             ignore_cache=False, num_context=1, batch_size=1,
-            model='seq2seq'):
+            model='seq2seq', input_files=(), prebuild=False):
+        """
+        Preprocessed dialogues are cached in a subdirectory of `cache` keyed on
+        the content of `input_files` (examples, schema, price tracker etc.), the
+        vocab and the preprocessing options (see get_cache_options).
+        If `prebuild` is True, tensors of all batches are built once and reused
+        in every epoch (see generator).
+        """
         examples = {'train': train_examples, 'dev': dev_examples, 'test': test_examples}
         self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
         self.num_context = num_context
         self.model = model
+        self.prebuild = prebuild
+        self.prebuilt_batches = {}
+
+        folds = [k for k, v in examples.iteritems() if v]
+        vocab_path = os.path.join(mappings_path, 'vocab.pkl')
+        cache_options = self.get_cache_options(preprocessor, num_context, batch_size, model)
+        cache_options.update({'num_{}_examples'.format(k): v for k, v in self.num_examples.iteritems()})
+        cache_key_files = list(input_files) + [vocab_path]
+
+        # The cache key depends on the vocab, which is built from the dialogues if it does not exist
+        use_cache = (not ignore_cache) and os.path.exists(vocab_path)
+        if use_cache:
+            self.cache = DialogueCache(cache, DialogueCache.get_key(cache_key_files, cache_options))
+            use_cache = all([self.cache.exists(fold) for fold in folds])
 
-        self.cache = cache
-        self.ignore_cache = ignore_cache
-        if (not os.path.exists(cache)) or ignore_cache:
+        if not use_cache:
             # NOTE: each dialogue is made into two examples from each agent's perspective
-            self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems() if v}
+            self.dialogues = {k: preprocessor.preprocess(examples[k]) for k in folds}
 
             for fold, dialogues in self.dialogues.iteritems():
                 print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
         else:
-            self.dialogues = {k: None  for k, v in examples.iteritems() if v}
-            print 'Using cached data from', cache
+            self.dialogues = {k: None for k in folds}
+            print 'Using cached data from', self.cache.path
 
         self.mappings = self.load_mappings(model, mappings_path, schema, preprocessor)
         self.textint_map = TextIntMap(self.mappings['utterance_vocab'], preprocessor)
@@ -459,7 +608,22 @@ class DataGenerator(object):
                         kb_pad=self.mappings['kb_vocab'].to_ind(markers.PAD),
                         mappings=self.mappings, num_context=num_context)
 
-        self.batches = {k: self.create_batches(k, dialogues, batch_size) for k, dialogues in self.dialogues.iteritems()}
+        if not use_cache:
+            self.cache = DialogueCache(cache, DialogueCache.get_key(cache_key_files, cache_options))
+            for fold, dialogues in self.dialogues.iteritems():
+                self.write_cache(fold, dialogues, batch_size, cache_options)
+
+        self.data = {fold: self.cache.load(fold) for fold in folds}
+
+    @classmethod
+    def get_cache_options(cls, preprocessor, num_context, batch_size, model):
+        options = {'{}_form'.format(stage): form for stage, form in preprocessor.entity_forms.iteritems()}
+        options.update({
+            'num_context': num_context,
+            'batch_size': batch_size,
+            'model': model,
+            })
+        return options
 
     def load_mappings(self, model_type, mappings_path, schema, preprocessor):
         vocab_path = os.path.join(mappings_path, 'vocab.pkl')
@@ -493,19 +657,6 @@ class DataGenerator(object):
         # Sort dialogues by number o turns
         return len(d.turns[0])
 
-    def create_dialogue_batches(self, dialogues, batch_size):
-        dialogue_batches = []
-        dialogues.sort(key=lambda d: self.dialogue_sort_score(d))
-        N = len(dialogues)
-        start = 0
-        while start < N:
-            # NOTE: last batch may have a smaller size if we don't have enough examples
-            end = min(start + batch_size, N)
-            dialogue_batch = dialogues[start:end]
-            dialogue_batches.append(self.dialogue_batcher.create_batch(dialogue_batch))
-            start = end
-        return dialogue_batches
-
     def get_all_responses(self, name):
         dialogues = self.dialogues[name]
         responses = {'seller': [], 'buyer': []}
@@ -514,39 +665,62 @@ class DataGenerator(object):
                 responses[role].extend(turn)
         return responses
 
-    def create_batches(self, name, dialogues, batch_size):
-        if not os.path.isdir(self.cache):
-            os.makedirs(self.cache)
-        cache_file = os.path.join(self.cache, '%s_batches.pkl' % name)
-        if (not os.path.exists(cache_file)) or self.ignore_cache:
-            for dialogue in dialogues:
-                dialogue.convert_to_int()
+    def write_cache(self, name, dialogues, batch_size, options):
+        for dialogue in dialogues:
+            dialogue.convert_to_int()
+        # NOTE: dialogues are stored in the batching order
+        dialogues.sort(key=lambda d: self.dialogue_sort_score(d))
+        start_time = time.time()
+        self.cache.write(name, dialogues, batch_size, options)
+        print 'Write %d dialogues to cache %s' % (len(dialogues), self.cache.path)
+        print '[%d s]' % (time.time() - start_time)
 
-            dialogue_batches = self.create_dialogue_batches(dialogues, batch_size)
-            print 'Write %d batches to cache %s' % (len(dialogue_batches), cache_file)
-            start_time = time.time()
-            write_pickle(dialogue_batches, cache_file)
-            print '[%d s]' % (time.time() - start_time)
-        else:
-            start_time = time.time()
-            dialogue_batches = read_pickle(cache_file)
-            print 'Read %d batches from cache %s' % (len(dialogue_batches), cache_file)
-            print '[%d s]' % (time.time() - start_time)
-        return dialogue_batches
+    def load_batch(self, name, batch_id):
+        """
+        Read the dialogues of one batch from the cache and create its turn batches.
+        NOTE: last batch may have a smaller size if we don't have enough examples
+        """
+        dialogues = [Dialogue.from_cache(fields, model=self.model)
+                for fields in self.data[name].get_batch_fields(batch_id)]
+        return self.dialogue_batcher.create_batch(dialogues)
+
+    def num_turn_batches(self, name):
+        data = self.data[name]
+        return sum([len(self.dialogue_batcher.get_encoding_turn_ids(data.num_turns(i)))
+            for i in xrange(data.num_batches)])
+
+    def create_batches(self, name, batch_id, cuda=False, pin_memory=False):
+        return [Batch(batch['encoder_args'],
+                      batch['decoder_args'],
+                      batch['context_data'],
+                      self.mappings['utterance_vocab'],
+                      num_context=self.num_context, cuda=cuda, pin_memory=pin_memory)
+                for batch in self.load_batch(name, batch_id)]
+
+    def prebuild_batches(self, name, pin_memory=False):
+        """
+        Build the CPU tensors of all batches of `name`; with `pin_memory`
+        they are page-locked for fast copies to the GPU.
+        """
+        start_time = time.time()
+        self.prebuilt_batches[name] = [self.create_batches(name, i, pin_memory=pin_memory)
+                for i in xrange(self.data[name].num_batches)]
+        print 'Prebuilt %d batches of %s' % (len(self.prebuilt_batches[name]), name)
+        print '[%d s]' % (time.time() - start_time)
 
     def generator(self, name, shuffle=True, cuda=True):
-        dialogue_batches = self.batches[name]
-        yield sum([len(b) for b in dialogue_batches])
-        inds = range(len(dialogue_batches))
+        if self.prebuild and name not in self.prebuilt_batches:
+            self.prebuild_batches(name, pin_memory=cuda)
+        yield self.num_turn_batches(name)
+        inds = range(self.data[name].num_batches)
         if shuffle:
             random.shuffle(inds)
         for ind in inds:
-            for batch in dialogue_batches[ind]:
-                yield Batch(batch['encoder_args'],
-                            batch['decoder_args'],
-                            batch['context_data'],
-                            self.mappings['utterance_vocab'],
-                            num_context=self.num_context, cuda=cuda)
+            if name in self.prebuilt_batches:
+                for batch in self.prebuilt_batches[name][ind]:
+                    yield batch.cuda() if cuda else batch
+            else:
+                for batch in self.create_batches(name, ind, cuda=cuda):
+                    yield batch
             # End of dialogue
             yield None
-
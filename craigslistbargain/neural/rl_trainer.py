@@ -1,19 +1,29 @@
 import random
 import numpy as np
 import copy
-from collections import defaultdict
+import multiprocessing
+from collections import defaultdict, namedtuple
 
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
-from cocoa.neural.rl_trainer import Statistics
+from cocoa.neural.rl_trainer import Statistics, RunningStats
 
 from core.controller import Controller
 from neural.trainer import Trainer
+from neural.batcher import Batch
+from neural.preprocess import Dialogue
 
 MIXED_MARGIN_FAIR = 'mixed-margin-fair'
 
+# A self-play dialogue pushed by an actor to the learner
+# dialogue: the training agent's Dialogue (converted to int)
+# reward: reward of the training agent
+# actor: id of the actor process
+# version: version of the model snapshot used by the actor
+Episode = namedtuple('Episode', ['dialogue', 'reward', 'actor', 'version'])
+
 
 class RLTrainer(Trainer):
     def __init__(self, agents, scenarios, train_loss, optim, training_agent=0, reward_func='margin', reward_beta=None):
@@ -28,45 +38,76 @@ class RLTrainer(Trainer):
 
         self.best_valid_reward = None
 
-        self.all_rewards = [[], []]
+        self.reward_stats = [RunningStats(), RunningStats()]
         self.reward_func = reward_func
         if self.reward_func == MIXED_MARGIN_FAIR:
             self.reward_beta = reward_beta
             assert 0 <= reward_beta <= 1
 
-    def update(self, batch_iter, reward, model, discount=0.95):
+    def update(self, episodes, model, discount=0.95):
+        """Take one optimizer step on a minibatch of episodes.
+
+        The dialogues are padded into one batch per turn, and the loss is the
+        token NLL weighted by the discounted return, averaged over episodes.
+
+        Args:
+            episodes: a list of (dialogue, scaled reward) of the training agent
+        """
         model.train()
         model.generator.train()
 
-        nll = []
-        # batch_iter gives a dialogue
+        env = self.agents[self.training_agent].env
+        pad = self.train_loss.padding_idx
+        num_episodes = len(episodes)
+        batches = env.dialogue_batcher.create_batch([dialogue for dialogue, _ in episodes])
+
+        nll, mask = [], []
         dec_state = None
-        for batch in batch_iter:
+        order = None
+        for batch in batches:
+            batch['context_data']['ids'] = range(num_episodes)
+            batch = Batch(batch['encoder_args'],
+                          batch['decoder_args'],
+                          batch['context_data'],
+                          env.vocab,
+                          num_context=Dialogue.num_context, cuda=env.cuda)
+            # Batch sorts the episodes by encoder length
+            prev_order, order = order, batch.context_data['ids']
+
             if not model.stateful:
                 dec_state = None
-            enc_state = dec_state.hidden if dec_state is not None else None
+            enc_state = None
+            if dec_state is not None:
+                positions = Variable(torch.LongTensor([prev_order.index(i) for i in order]))
+                enc_state = tuple(h.index_select(1, positions) for h in dec_state.hidden)
 
             outputs, _, dec_state = self._run_batch(batch, None, enc_state)  # (seq_len, batch_size, rnn_size)
             loss, _ = self.train_loss.compute_loss(batch.targets, outputs)  # (seq_len, batch_size)
-            nll.append(loss)
+            # Restore the order of the episodes
+            restore = torch.LongTensor(np.argsort(order).tolist())
+            nll.append(loss.index_select(1, Variable(restore)))
+            mask.append(batch.targets.data.index_select(1, restore).ne(pad))
 
             # Don't backprop fully.
             if dec_state is not None:
                 dec_state.detach()
 
-        nll = torch.cat(nll)  # (total_seq_len, batch_size)
+        nll = torch.cat(nll)  # (total_seq_len, num_episodes)
+        mask = torch.cat(mask).float()
 
-        rewards = [Variable(torch.zeros(1, 1).fill_(reward))]
-        for i in xrange(1, nll.size(0)):
-            rewards.append(rewards[-1] * discount)
-        rewards = rewards[::-1]
-        rewards = torch.cat(rewards)
+        # Return of each token: the episode reward discounted by the number of
+        # tokens generated after it
+        tokens_after = mask.sum(0, keepdim=True).expand_as(mask) - mask.cumsum(0)
+        rewards = torch.FloatTensor([reward for _, reward in episodes])
+        returns = torch.pow(discount, tokens_after) * rewards.unsqueeze(0).expand_as(mask) * mask
 
-        loss = nll.squeeze().dot(rewards.squeeze())
+        loss = (nll * Variable(returns)).sum() / num_episodes
         model.zero_grad()
         loss.backward()
         nn.utils.clip_grad_norm(model.parameters(), 1.)
         self.optim.step()
+        # Invalidate cached KB encodings
+        model.version += 1
 
     def _get_scenario(self, scenario_id=None, split='train'):
         scenarios = self.scenarios[split]
@@ -119,37 +160,143 @@ class RLTrainer(Trainer):
                     episode=episode)
         return path
 
+    def standardize_reward(self, reward, session_id):
+        stats = self.reward_stats[session_id]
+        stats.update(reward)
+        print 'reward:', reward
+        scaled_reward = (reward - stats.mean) / max(1e-4, stats.std())
+        print 'scaled reward:', scaled_reward
+        print 'mean reward:', stats.mean
+        return scaled_reward
+
     def learn(self, args):
+        if args.num_actors > 0:
+            return self.learn_parallel(args)
+
+        episodes = []
         for i in xrange(args.num_dialogues):
             # Rollout
             scenario = self._get_scenario()
             controller = self._get_controller(scenario, split='train')
             example = controller.simulate(args.max_turns, verbose=args.verbose)
 
-            for session_id, session in enumerate(controller.sessions):
-                # Only train one agent
-                if session_id != self.training_agent:
-                    continue
-
-                # Compute reward
-                reward = self.get_reward(example, session)
-                # Standardize the reward
-                all_rewards = self.all_rewards[session_id]
-                all_rewards.append(reward)
-                print 'step:', i
-                print 'reward:', reward
-                reward = (reward - np.mean(all_rewards)) / max(1e-4, np.std(all_rewards))
-                print 'scaled reward:', reward
-                print 'mean reward:', np.mean(all_rewards)
+            # Only train one agent
+            session = controller.sessions[self.training_agent]
+            # Compute reward
+            reward = self.get_reward(example, session)
+            # Standardize the reward
+            print 'step:', i
+            reward = self.standardize_reward(reward, self.training_agent)
 
-                batch_iter = session.iter_batches()
-                T = batch_iter.next()
-                self.update(batch_iter, reward, self.model, discount=args.discount_factor)
+            session.convert_to_int()
+            episodes.append((session.dialogue, reward))
+            if len(episodes) == args.episodes_per_update or i == args.num_dialogues - 1:
+                self.update(episodes, self.model, discount=args.discount_factor)
+                episodes = []
 
             if i > 0 and i % 100 == 0:
                 valid_stats = self.validate(args)
                 self.drop_checkpoint(args, i, valid_stats, model_opt=self.agents[self.training_agent].env.model_args)
 
+    def learn_parallel(self, args):
+        """Actor/learner REINFORCE.
+
+        `args.num_actors` processes run self-play with a copy of the training
+        model and push Episodes to a queue. The learner takes one optimizer step
+        per `args.episodes_per_update` episodes and publishes its parameters to the
+        actors every `args.actor_sync_interval` steps. Validation runs in a
+        separate process on a snapshot of the model.
+        """
+        # Parameters read by the actors
+        snapshot = copy.deepcopy(self.model)
+        snapshot.share_memory()
+        version = multiprocessing.Value('i', 0)
+        lock = multiprocessing.Lock()
+        queue = multiprocessing.Queue(maxsize=2 * args.num_actors * args.episodes_per_update)
+
+        actors = []
+        for actor_id in xrange(args.num_actors):
+            actor = multiprocessing.Process(target=self._run_actor,
+                    args=(actor_id, args, queue, snapshot, version, lock))
+            actor.daemon = True
+            actor.start()
+            actors.append(actor)
+
+        validator = None
+        episodes = []
+        num_updates = 0
+        try:
+            for i in xrange(args.num_dialogues):
+                episode = queue.get()
+                print 'step:', i
+                print 'actor: {} (model version {}/{})'.format(episode.actor, episode.version, version.value)
+                reward = self.standardize_reward(episode.reward, self.training_agent)
+
+                episodes.append((episode.dialogue, reward))
+                if len(episodes) == args.episodes_per_update or i == args.num_dialogues - 1:
+                    self.update(episodes, self.model, discount=args.discount_factor)
+                    episodes = []
+                    num_updates += 1
+                    if num_updates % args.actor_sync_interval == 0:
+                        with lock:
+                            snapshot.load_state_dict(self.model.state_dict())
+                            version.value += 1
+
+                if i > 0 and i % 100 == 0:
+                    # Wait for the previous validation so that checkpoints are saved in order
+                    self._finish_validation(validator)
+                    validator = self._start_validation(args, i)
+        finally:
+            for actor in actors:
+                actor.terminate()
+        self._finish_validation(validator)
+
+    def _run_actor(self, actor_id, args, queue, snapshot, version, lock):
+        seed = args.random_seed + actor_id + 1
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        # Actors share the CPUs
+        torch.set_num_threads(1)
+
+        model_version = None
+        while True:
+            if model_version != version.value:
+                with lock:
+                    self.model.load_state_dict(snapshot.state_dict())
+                    model_version = version.value
+
+            scenario = self._get_scenario()
+            controller = self._get_controller(scenario, split='train')
+            example = controller.simulate(args.max_turns, verbose=args.verbose)
+            session = controller.sessions[self.training_agent]
+            reward = self.get_reward(example, session)
+            session.convert_to_int()
+            queue.put(Episode(session.dialogue, reward, actor_id, model_version))
+
+    def _start_validation(self, args, episode):
+        """Validate and checkpoint the current model in a child process, which
+        has a copy of the model parameters at this episode.
+        """
+        result = multiprocessing.Queue()
+
+        def run():
+            valid_stats = self.validate(args)
+            self.drop_checkpoint(args, episode, valid_stats, model_opt=self.agents[self.training_agent].env.model_args)
+            result.put(self.best_valid_reward)
+
+        validator = multiprocessing.Process(target=run)
+        validator.start()
+        return validator, result
+
+    def _finish_validation(self, validator):
+        if validator is None:
+            return
+        process, result = validator
+        process.join()
+        if process.exitcode == 0:
+            self.best_valid_reward = result.get()
+
     def _is_valid_dialogue(self, example):
         special_actions = defaultdict(int)
         for event in example.events:
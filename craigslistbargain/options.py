@@ -11,9 +11,12 @@ def add_preprocess_arguments(parser):
     parser.add_argument('--entity-encoding-form', choices=['canonical', 'type'], default='canonical', help='Input entity form to the encoder')
     parser.add_argument('--entity-decoding-form', choices=['canonical', 'type'], default='canonical', help='Input entity form to the decoder')
     parser.add_argument('--entity-target-form', choices=['canonical', 'type'], default='canonical', help='Output entity form to the decoder')
-    parser.add_argument('--cache', default='.cache', help='Path to cache for preprocessed batches')
+    parser.add_argument('--cache', default='.cache', help='Directory of the preprocessed data cache (one subdirectory per input files and preprocessing options)')
     parser.add_argument('--ignore-cache', action='store_true', help='Ignore existing cache')
     parser.add_argument('--mappings', help='Path to vocab mappings')
+    parser.add_argument('--preprocess-workers', type=int, default=1, help='Number of processes used to preprocess examples')
+    parser.add_argument('--preprocess-chunk-size', type=int, default=100, help='Number of examples sent to a preprocessing worker at a time')
+    parser.add_argument('--prebuild-batches', action='store_true', help='Build tensors of all batches once and reuse them in every epoch')
 
 def add_data_generator_arguments(parser):
     cocoa.options.add_scenario_arguments(parser)
@@ -83,11 +86,21 @@ def add_rl_arguments(parser):
     parser.add_argument('--reward', choices=['margin', 'length', 'fair', 'mixed-margin-fair'],
             help='Which reward function to use')
     parser.add_argument('--reward-beta', type=float, default=0.5)
+    parser.add_argument('--num-actors', type=int, default=0,
+            help='Number of self-play processes feeding the learner (0 to run rollouts in the learner process)')
+    parser.add_argument('--episodes-per-update', type=int, default=1,
+            help='Number of dialogues in each policy gradient minibatch')
+    parser.add_argument('--actor-sync-interval', type=int, default=1,
+            help='Number of optimizer steps between two updates of the actors\' model parameters')
 
 
 # =============== systems ===============
 def add_neural_system_arguments(parser):
     cocoa.options.add_generator_arguments(parser)
+    parser.add_argument('--inference-batch-size', type=int, default=1,
+            help='Maximum number of generation requests from concurrent sessions to run as one batch (1 to disable batching)')
+    parser.add_argument('--inference-max-wait', type=float, default=0.005,
+            help='Maximum number of seconds a generation request waits for other requests to batch with')
 
 def add_system_arguments(parser):
     cocoa.options.add_rulebased_arguments(parser)
@@ -0,0 +1,135 @@
+'''
+Time batch creation (padding, decoder inputs, lengths and tensors) on random
+dialogue turns and check that it gives the same tensors as the original
+Python-loop implementation.
+'''
+
+import argparse
+import time
+import numpy as np
+from itertools import izip_longest
+
+import torch
+
+from cocoa.model.vocab import Vocabulary
+
+from neural.symbols import markers
+from neural.batcher import Batch, DialogueBatcher, pad_list_to_array
+
+def loop_pad_list_to_array(l, fillvalue, dtype):
+    return np.array(list(izip_longest(*l, fillvalue=fillvalue)), dtype=dtype).T
+
+class LoopBatch(Batch):
+    @classmethod
+    def to_tensor(cls, data, dtype, cuda=False, pin_memory=False):
+        if type(data) == np.ndarray:
+            data = data.tolist()
+        tensor = torch.LongTensor(data) if dtype == 'long' else torch.FloatTensor(data)
+        return tensor.cuda() if cuda else tensor
+
+    def sort_by_length(self, inputs):
+        pad = self.vocab.word_to_ind[markers.PAD]
+        def get_length(seq):
+            for i, x in enumerate(seq):
+                if x == pad:
+                    return i
+            return len(seq)
+        lengths = [get_length(s) for s in inputs]
+        lengths = [l if l > 0 else 1 for l in lengths]
+        sorted_id = np.argsort(lengths)[::-1]
+        return lengths, sorted_id
+
+    def order_by_id(self, inputs, ids):
+        if type(inputs) is list:
+            return [inputs[i] for i in ids]
+        return inputs[ids, :]
+
+class LoopDialogueBatcher(DialogueBatcher):
+    def _remove_last(self, array, value, pad):
+        array = np.copy(array)
+        nrows, ncols = array.shape
+        for i in xrange(nrows):
+            for j in xrange(ncols-1, -1, -1):
+                if array[i][j] == value:
+                    array[i][j] = pad
+                    break
+        return array
+
+def random_turns(rng, vocab, batch_size, max_len):
+    '''
+    <go> tokens <eos> sequences of random lengths.
+    '''
+    go, eos = vocab.to_ind(markers.GO_S), vocab.to_ind(markers.EOS)
+    words = np.arange(vocab.size)
+    return [[go] + rng.choice(words, rng.randint(1, max_len)).tolist() + [eos]
+            for _ in xrange(batch_size)]
+
+def make_batches(batch_class, batcher, pad_fn, data, vocab, num_context):
+    pad = batcher.pad
+    batches = []
+    for enc_turns, dec_turns, title, desc in data:
+        encoder_turns = [pad_fn(turns, pad, np.int32) for turns in enc_turns]
+        decoder_turns = pad_fn(dec_turns, pad, np.int32)
+        decoder_inputs, targets = batcher.make_decoder_inputs_and_targets(decoder_turns)
+        encoder_args = {
+                'inputs': batcher.get_encoder_inputs(encoder_turns),
+                'context': batcher.get_encoder_context(encoder_turns, num_context),
+                }
+        decoder_args = {
+                'inputs': decoder_inputs,
+                'targets': targets,
+                'context': {
+                    'title': pad_fn(title, pad, np.int32),
+                    'description': pad_fn(desc, pad, np.int32),
+                    },
+                }
+        context_data = {'uuids': range(len(dec_turns))}
+        batches.append(batch_class(encoder_args, decoder_args, context_data, vocab, num_context=num_context))
+    return batches
+
+def time_batches(name, *args):
+    start = time.time()
+    batches = make_batches(*args)
+    elapsed = time.time() - start
+    print '{}: {:.2f}s ({:.1f} batches/s)'.format(name, elapsed, len(batches) / max(elapsed, 1e-6))
+    return batches
+
+def same_batch(a, b):
+    for attr in Batch.tensor_attributes:
+        if hasattr(a, attr):
+            x, y = getattr(a, attr), getattr(b, attr)
+            x = x.data if hasattr(x, 'data') else x
+            y = y.data if hasattr(y, 'data') else y
+            if x.tolist() != y.tolist():
+                return False
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-batches', default=500, type=int)
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--max-len', default=30, type=int)
+    parser.add_argument('--num-context', default=2, type=int)
+    parser.add_argument('--vocab-size', default=1000, type=int)
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    vocab = Vocabulary(offset=0, unk=True)
+    vocab.add_words([markers.PAD, markers.GO_S, markers.EOS], special=True)
+    vocab.add_words(['w{}'.format(i) for i in xrange(args.vocab_size)])
+    vocab.finish()
+    mappings = {'utterance_vocab': vocab, 'tgt_vocab': vocab}
+
+    rng = np.random.RandomState(args.seed)
+    turns = lambda: random_turns(rng, vocab, args.batch_size, args.max_len)
+    data = [([turns() for _ in xrange(args.num_context + 1)], turns(), turns(), turns())
+            for _ in xrange(args.num_batches)]
+
+    kwargs = {'kb_pad': vocab.to_ind(markers.PAD), 'mappings': mappings, 'num_context': args.num_context}
+    batches = time_batches('batcher', Batch, DialogueBatcher(**kwargs),
+            pad_list_to_array, data, vocab, args.num_context)
+    expected = time_batches('loop batcher', LoopBatch, LoopDialogueBatcher(**kwargs),
+            loop_pad_list_to_array, data, vocab, args.num_context)
+
+    num_diff = sum([1 for a, b in zip(batches, expected) if not same_batch(a, b)])
+    print '{} batches are different'.format(num_diff)
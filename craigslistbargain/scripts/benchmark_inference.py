@@ -0,0 +1,67 @@
+'''
+Measure generation throughput and latency of a pt-neural system with many concurrent sessions,
+e.g. to compare --inference-batch-size 1 (no batching) with larger batch sizes.
+'''
+
+import argparse
+import random
+import threading
+import time
+import numpy as np
+
+from cocoa.core.util import read_json
+from cocoa.core.schema import Schema
+from cocoa.core.scenario_db import ScenarioDB
+import cocoa.options
+
+from core.scenario import Scenario
+from core.event import Event
+from systems import get_system
+import options
+
+def run_session(session, num_turns, latencies):
+    for i in xrange(num_turns):
+        session.receive(Event.MessageEvent(1 - session.agent, 'hi, is this still available?'))
+        start = time.time()
+        session.send()
+        latencies.append(time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('--checkpoint', required=True, help='Path to the model checkpoint')
+    parser.add_argument('--num-sessions', type=int, default=50, help='Number of concurrent sessions')
+    parser.add_argument('--num-turns', type=int, default=5, help='Number of responses generated by each session')
+    parser.add_argument('--random-seed', type=int, default=1)
+    cocoa.options.add_scenario_arguments(parser)
+    options.add_system_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(args.random_seed)
+    np.random.seed(args.random_seed)
+
+    schema = Schema(args.schema_path)
+    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
+    system = get_system('pt-neural', args, schema, model_path=args.checkpoint)
+
+    scenarios = scenario_db.scenarios_list
+    sessions = []
+    for i in xrange(args.num_sessions):
+        agent = i % 2
+        sessions.append(system.new_session(agent, scenarios[i % len(scenarios)].kbs[agent]))
+
+    latencies = []
+    threads = [threading.Thread(target=run_session, args=(session, args.num_turns, latencies))
+            for session in sessions]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print 'inference batch size={} max wait={}s'.format(args.inference_batch_size, args.inference_max_wait)
+    print '{} responses in {:.2f}s: {:.1f} responses/s'.format(len(latencies), elapsed, len(latencies) / elapsed)
+    print 'latency per response: mean={:.4f}s p50={:.4f}s p95={:.4f}s'.format(
+            np.mean(latencies), np.percentile(latencies, 50), np.percentile(latencies, 95))
+    if system.env.inference_server is not None:
+        system.env.inference_server.report()
@@ -0,0 +1,98 @@
+'''
+Measure the latency of a bot turn of a pt-neural system with --sample, comparing
+Sampler (stops when all sequences have emitted EOS) with the original sampler
+that always runs max_length decoding steps.
+'''
+
+import argparse
+import random
+import time
+import numpy as np
+
+import torch
+from torch.autograd import Variable
+
+from cocoa.core.util import read_json
+from cocoa.core.schema import Schema
+from cocoa.core.scenario_db import ScenarioDB
+from cocoa.neural.generator import Sampler
+import cocoa.options
+
+from core.scenario import Scenario
+from core.event import Event
+from systems import get_system
+import options
+
+class FullLengthSampler(Sampler):
+    '''
+    Reference: sample max_length tokens whether or not EOS has been sampled.
+    '''
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
+        lengths = batch.lengths
+        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+        inp = batch.decoder_inputs[:gt_prefix]
+        dec_out, dec_states, _ = self.model.decoder(
+            inp, memory_bank, dec_states, memory_lengths=lengths)
+        preds = []
+        for i in xrange(self.max_length):
+            out = self.model.generator.forward(dec_out.squeeze(0)).data
+            pred, _ = self._sample(out)
+            preds.append(pred)
+            inp = Variable(pred.view(1, -1))
+            dec_out, dec_states, _ = self.model.decoder(
+                inp, memory_bank, dec_states, memory_lengths=lengths)
+        preds = torch.stack(preds).t()
+        scores = self.tt.FloatTensor(batch.size).zero_()
+        return self._make_output(batch, preds, scores, dec_states)
+
+def time_turns(system, scenarios, num_sessions, num_turns):
+    latencies = []
+    num_tokens = []
+    for i in xrange(num_sessions):
+        agent = i % 2
+        session = system.new_session(agent, scenarios[i % len(scenarios)].kbs[agent])
+        for j in xrange(num_turns):
+            session.receive(Event.MessageEvent(1 - agent, 'hi, is this still available?'))
+            start = time.time()
+            event = session.send()
+            latencies.append(time.time() - start)
+            if event is not None and event.action == 'message':
+                num_tokens.append(len(event.data.split()))
+    return latencies, num_tokens
+
+def report(name, latencies, num_tokens):
+    print '{}: {} turns, {:.1f} words per message, latency mean={:.4f}s p50={:.4f}s p95={:.4f}s'.format(
+            name, len(latencies), np.mean(num_tokens) if num_tokens else 0.,
+            np.mean(latencies), np.percentile(latencies, 50), np.percentile(latencies, 95))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('--checkpoint', required=True, help='Path to the model checkpoint')
+    parser.add_argument('--num-sessions', type=int, default=20, help='Number of dialogues')
+    parser.add_argument('--num-turns', type=int, default=5, help='Number of bot turns in each dialogue')
+    parser.add_argument('--random-seed', type=int, default=1)
+    cocoa.options.add_scenario_arguments(parser)
+    options.add_system_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+    # Sessions call the generator directly
+    args.inference_batch_size = 1
+
+    schema = Schema(args.schema_path)
+    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
+    system = get_system('pt-neural', args, schema, model_path=args.checkpoint)
+    scenarios = scenario_db.scenarios_list
+    generator = system.env.dialogue_generator
+    print 'max_length={} temperature={}'.format(generator.max_length, generator.temperature)
+
+    samplers = [('sampler', generator),
+            ('full-length sampler', FullLengthSampler(generator.model, generator.vocab,
+                temperature=generator.temperature, max_length=generator.max_length, cuda=generator.cuda))]
+    for name, sampler in samplers:
+        random.seed(args.random_seed)
+        np.random.seed(args.random_seed)
+        torch.manual_seed(args.random_seed)
+        system.env = system.env._replace(dialogue_generator=sampler)
+        latencies, num_tokens = time_turns(system, scenarios, args.num_sessions, args.num_turns)
+        report(name, latencies, num_tokens)
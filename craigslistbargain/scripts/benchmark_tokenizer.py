@@ -0,0 +1,59 @@
+'''
+Time tokenize over the messages of a CraigslistBargain corpus, without and with
+the utterance cache, and check that the cache does not change the output.
+'''
+
+import argparse
+import time
+
+from cocoa.core.dataset import read_examples
+
+from core.scenario import Scenario
+from core.tokenizer import tokenize, token_cache
+
+def time_tokenize(messages):
+    start = time.time()
+    tokens = [tokenize(m) for m in messages]
+    return tokens, time.time() - start
+
+def check_cache(messages, cold_tokens):
+    '''
+    Tokens from a warm cache must be the same as from an empty cache, and
+    each call must return a new list since callers modify the tokens.
+    '''
+    num_diffs = 0
+    for m, expected in zip(messages, cold_tokens):
+        tokens = tokenize(m)
+        if tokens != expected:
+            num_diffs += 1
+            print 'Different tokens from the cache:', repr(m), tokens, expected
+        tokens.append('<modified>')
+        assert tokenize(m) == expected, 'tokenize returned a cached list'
+    print '{} messages tokenized differently with the cache'.format(num_diffs)
+    return num_diffs
+
+def report(name, elapsed, num_messages):
+    print '{}: {:.2f}s ({:.1f} messages/s)'.format(name, elapsed, num_messages / max(elapsed, 1e-6))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transcripts', nargs='*', help='JSON transcripts')
+    parser.add_argument('--max-examples', default=-1, type=int)
+    args = parser.parse_args()
+
+    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+    messages = [e.data for ex in examples for e in ex.events if e.action == 'message']
+    print '{} messages ({} unique) from {} dialogues'.format(len(messages), len(set(messages)), len(examples))
+
+    # Nothing stays in the cache with max_size=0
+    token_cache.clear()
+    token_cache.max_size = 0
+    cold_tokens, elapsed = time_tokenize(messages)
+    report('tokenize (no cache)', elapsed, len(messages))
+
+    token_cache.max_size = len(messages)
+    time_tokenize(messages)
+    _, elapsed = time_tokenize(messages)
+    report('tokenize (cached)', elapsed, len(messages))
+
+    check_cache(messages, cold_tokens)
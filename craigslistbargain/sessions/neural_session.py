@@ -1,5 +1,6 @@
 import random
 import re
+from collections import deque
 from itertools import izip
 import numpy as np
 import torch
@@ -13,6 +14,52 @@ from session import Session
 from neural.preprocess import markers, Dialogue
 from neural.batcher import Batch
 
+class DialogueTurns(object):
+    """
+    Integerized turns of a dialogue that grows during a session.
+
+    Each token turn is converted (for all stages, in dialogue.turns) once, and
+    encoder inputs are kept as arrays for the first turn and the last `window`
+    turns only, so that the cost of a turn does not grow with the length of
+    the dialogue. The last turn is converted again if it has been extended,
+    i.e. the same agent has talked again since it was converted.
+    """
+    def __init__(self, dialogue, textint_map, window):
+        self.dialogue = dialogue
+        self.textint_map = textint_map
+        self.first_turn = None
+        self.window = deque(maxlen=window)
+        # Number of tokens in the last turn when it was converted
+        self.last_turn_size = 0
+
+    def update(self):
+        token_turns = self.dialogue.token_turns
+        turns = self.dialogue.turns
+        num_converted = len(turns[Dialogue.ENC])
+        if num_converted > 0 and len(token_turns[num_converted-1]) != self.last_turn_size:
+            num_converted -= 1
+            for curr_turns in turns:
+                curr_turns.pop()
+            self.window.pop()
+
+        for i in xrange(num_converted, len(token_turns)):
+            turn = token_turns[i]
+            for curr_turns, stage in izip(turns, ('encoding', 'decoding', 'target')):
+                curr_turns.append(self.textint_map.text_to_int(turn, stage))
+            turn_arr = np.array(turns[Dialogue.ENC][i], dtype=np.int32).reshape([1, -1])
+            self.window.append(turn_arr)
+            if i == 0:
+                self.first_turn = turn_arr
+            self.last_turn_size = len(turn)
+
+    @property
+    def encoder_turns(self):
+        """
+        Encoder inputs (arrays of shape (1, turn_length)) of the last `window` turns.
+        """
+        return list(self.window)
+
+
 class NeuralSession(Session):
     def __init__(self, agent, kb, env):
         super(NeuralSession, self).__init__(agent)
@@ -27,6 +74,8 @@ class NeuralSession(Session):
         self.dialogue.kb_context_to_int()
         self.kb_context_batch = self.batcher.create_context_batch([self.dialogue], self.batcher.kb_pad)
         self.max_len = 100
+        # The encoder only reads the last turn and num_context turns before it
+        self.dialogue_turns = DialogueTurns(self.dialogue, env.textint_map, Dialogue.num_context + 1)
 
     # TODO: move this to preprocess?
     def convert_to_int(self):
@@ -44,13 +93,10 @@ class NeuralSession(Session):
             target_input (list[list[int]]),
         ]
         encoder_input, decoder_input, and target_input all have the same length: the number of turns
+
+        Turns that have already been converted are not converted again (see DialogueTurns).
         """
-        for i, turn in enumerate(self.dialogue.token_turns):
-            for curr_turns, stage in izip(self.dialogue.turns, ('encoding', 'decoding', 'target')):
-                # Don't convert tokens if they have already been converted
-                # by a previous invocation of this method
-                if i >= len(curr_turns):
-                    curr_turns.append(self.env.textint_map.text_to_int(turn, stage))
+        self.dialogue_turns.update()
 
     def receive(self, event):
         if event.action in Event.decorative_events:
@@ -132,6 +178,10 @@ class PytorchNeuralSession(NeuralSession):
         self.new_turn = False
         self.end_turn = False
 
+        # Memory bank of the last context turns, reused while they do not change
+        self.context_key = None
+        self.context_memory_bank = None
+
     def get_decoder_inputs(self):
         # Don't include EOS
         utterance = self.dialogue._insert_markers(self.agent, [], True)[:-1]
@@ -139,12 +189,12 @@ class PytorchNeuralSession(NeuralSession):
         inputs = np.array(inputs, dtype=np.int32).reshape([1, -1])
         return inputs
 
-    def _create_batch(self):
+    def _create_batch_args(self):
         num_context = Dialogue.num_context
 
-        # All turns up to now
+        # Last num_context + 1 turns
         self.convert_to_int()
-        encoder_turns = self.batcher._get_turn_batch_at([self.dialogue], Dialogue.ENC, None)
+        encoder_turns = self.dialogue_turns.encoder_turns
 
         encoder_inputs = self.batcher.get_encoder_inputs(encoder_turns)
         encoder_context = self.batcher.get_encoder_context(encoder_turns, num_context)
@@ -155,7 +205,7 @@ class PytorchNeuralSession(NeuralSession):
         decoder_args = {
                         'inputs': self.get_decoder_inputs(),
                         'context': self.kb_context_batch,
-                        'targets': np.copy(encoder_turns[0]),
+                        'targets': np.copy(self.dialogue_turns.first_turn),
                     }
 
         context_data = {
@@ -163,16 +213,37 @@ class PytorchNeuralSession(NeuralSession):
                 'kbs': [self.kb],
                 }
 
-        return Batch(encoder_args, decoder_args, context_data,
-                self.vocab, sort_by_length=False, num_context=num_context, cuda=self.cuda)
+        return encoder_args, decoder_args, context_data
+
+    def _create_batch(self):
+        encoder_args, decoder_args, context_data = self._create_batch_args()
+        batch = Batch(encoder_args, decoder_args, context_data,
+                self.vocab, sort_by_length=False, num_context=Dialogue.num_context, cuda=self.cuda)
+        self._set_context_memory_bank(batch, encoder_args['context'][0])
+        return batch
+
+    def _set_context_memory_bank(self, batch, context_inputs):
+        model = self.env.model
+        # Not cached in training mode (dropout)
+        if batch.num_context == 0 or not hasattr(model, 'kb_embedder') or model.training:
+            return
+        key = context_inputs.tobytes()
+        if key != self.context_key:
+            _, self.context_memory_bank = model.context_embedder(batch.context_inputs)
+            self.context_key = key
+        batch.context_memory_bank = self.context_memory_bank
 
     def generate(self):
         if len(self.dialogue.agents) == 0:
             self.dialogue._add_utterance(1 - self.agent, [])
-        batch = self._create_batch()
 
-        enc_state = self.dec_state.hidden if self.dec_state is not None else None
-        output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state)
+        if self.env.inference_server is not None and not self.stateful:
+            # Batched with requests from other sessions
+            output_data = self.env.inference_server.generate(self._create_batch_args())
+        else:
+            batch = self._create_batch()
+            enc_state = self.dec_state.hidden if self.dec_state is not None else None
+            output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state)
 
         if self.stateful:
             # TODO: only works for Sampler for now. cannot do beam search.
@@ -1,5 +1,7 @@
 import os
+import time
 import argparse
+import threading
 from collections import namedtuple
 from onmt.Utils import use_gpu
 
@@ -8,15 +10,132 @@ from cocoa.sessions.timed_session import TimedSessionWrapper
 from cocoa.core.util import read_pickle, read_json
 from cocoa.neural.beam import Scorer
 
-from neural.generator import get_generator
+from neural.generator import get_generator, LFSampler
 from sessions.neural_session import PytorchNeuralSession
 from neural import model_builder, get_data_generator, make_model_mappings
 from neural.preprocess import markers, TextIntMap, Preprocessor, Dialogue
-from neural.batcher import DialogueBatcherFactory
+from neural.batcher import DialogueBatcherFactory, Batch
 from neural.utterance import UtteranceBuilder
 import options
 
 
+class InferenceRequest(object):
+    def __init__(self, batch_args):
+        self.batch_args = batch_args
+        self.submit_time = time.time()
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer(object):
+    """
+    Micro-batching of generation requests from many sessions that share one model.
+
+    A session calling `generate` blocks until its request has been run. A worker thread waits until
+    `max_batch_size` requests are pending, or until the oldest pending request has waited `max_wait` seconds,
+    then pads all pending requests into one batch, runs the generator once and scatters the outputs back.
+    Requests can only be batched if they come from concurrent threads (e.g. parallel self-play or a
+    threaded web server).
+    """
+    def __init__(self, generator, batcher, vocab, gt_prefix, num_context, cuda=False, max_batch_size=32, max_wait=0.005):
+        self.generator = generator
+        self.batcher = batcher
+        self.vocab = vocab
+        self.gt_prefix = gt_prefix
+        self.num_context = num_context
+        self.cuda = cuda
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.pending = []
+        self.cond = threading.Condition()
+
+        # Statistics
+        self.num_requests = 0
+        self.num_batches = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.total_run_time = 0.
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def generate(self, batch_args):
+        """Return the generator output for one example given by `batch_args`
+        (encoder_args, decoder_args, context_data).
+        """
+        request = InferenceRequest(batch_args)
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def _next_batch(self):
+        with self.cond:
+            while True:
+                if self.pending:
+                    wait = self.pending[0].submit_time + self.max_wait - time.time()
+                    if len(self.pending) >= self.max_batch_size or wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+            requests = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            start = time.time()
+            try:
+                self._run_batch(requests)
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            end = time.time()
+            self.num_batches += 1
+            self.total_run_time += end - start
+            for request in requests:
+                latency = end - request.submit_time
+                self.num_requests += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                request.done.set()
+
+    def _run_batch(self, requests):
+        encoder_args, decoder_args, context_data = self.batcher.stack_batch_args(
+                [request.batch_args for request in requests])
+        # Keep track of the request order after sorting by length
+        context_data['ids'] = range(len(requests))
+        batch = Batch(encoder_args, decoder_args, context_data,
+                self.vocab, sort_by_length=True, num_context=self.num_context, cuda=self.cuda)
+        output = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix)
+        for i, request_id in enumerate(batch.context_data['ids']):
+            requests[request_id].output = {k: [output[k][i]] for k in ('predictions', 'scores', 'attention')}
+
+    def get_stats(self):
+        n = float(max(self.num_requests, 1))
+        return {'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': self.num_requests / float(max(self.num_batches, 1)),
+                'mean_latency': self.total_latency / n,
+                'max_latency': self.max_latency,
+                'throughput': self.num_requests / self.total_run_time if self.total_run_time > 0 else 0.,
+                }
+
+    def report(self):
+        stats = self.get_stats()
+        print '{num_requests} requests in {num_batches} batches (mean batch size {mean_batch_size:.2f}): ' \
+              'latency mean={mean_latency:.4f}s max={max_latency:.4f}s, ' \
+              'throughput={throughput:.1f} requests/s of model time'.format(**stats)
+
+
 class PytorchNeuralSystem(System):
     """
     NeuralSystem loads a neural model from disk and provides a function instantiate a new dialogue agent (NeuralSession
@@ -61,15 +180,25 @@ class PytorchNeuralSystem(System):
         Dialogue.mappings = mappings
         Dialogue.num_context = model_args.num_context
 
+        # LFSampler only supports batch size 1; stateful models pass on per-session states
+        if args.inference_batch_size > 1 and not model.stateful and not isinstance(generator, LFSampler):
+            inference_server = InferenceServer(generator, dialogue_batcher, vocab,
+                    gt_prefix=1, num_context=model_args.num_context, cuda=use_cuda,
+                    max_batch_size=args.inference_batch_size, max_wait=args.inference_max_wait)
+        else:
+            inference_server = None
+
         Env = namedtuple('Env', ['model', 'vocab', 'preprocessor', 'textint_map',
             'stop_symbol', 'remove_symbols', 'gt_prefix',
             'max_len', 'dialogue_batcher', 'cuda',
-            'dialogue_generator', 'utterance_builder', 'model_args'])
+            'dialogue_generator', 'utterance_builder', 'model_args',
+            'inference_server'])
         self.env = Env(model, vocab, preprocessor, textint_map,
             stop_symbol=vocab.to_ind(markers.EOS), remove_symbols=remove_symbols,
             gt_prefix=1,
             max_len=20, dialogue_batcher=dialogue_batcher, cuda=use_cuda,
-            dialogue_generator=generator, utterance_builder=builder, model_args=model_args)
+            dialogue_generator=generator, utterance_builder=builder, model_args=model_args,
+            inference_server=inference_server)
 
     @classmethod
     def name(cls):
@@ -14,6 +14,7 @@ from cocoa.core.schema import Schema
 from cocoa.core.util import read_json
 from cocoa.systems.human_system import HumanSystem
 from cocoa.web.main.logger import WebLogger
+from cocoa.web.main.scheduler import ChatScheduler
 import cocoa.options
 
 from core.scenario import Scenario
@@ -228,6 +229,9 @@ if __name__ == "__main__":
     if 'debug' not in params:
         params['debug'] = False
 
+    if 'push_events' not in params:
+        params['push_events'] = False
+
     systems, pairing_probabilities = add_systems(args, params['models'], schema, debug=params['debug'])
 
     db.add_scenarios(scenario_db, systems, update=args.reuse)
@@ -250,8 +254,22 @@ if __name__ == "__main__":
     else:
         app.config['task_icon'] = params['icon']
 
+    if params['push_events']:
+        scheduler = ChatScheduler(app, socketio, Backend.get_backend,
+                                  interval=params.get('scheduler_interval', 0.1))
+        app.config['scheduler'] = scheduler
+        scheduler.start()
+
     print "App setup complete"
 
-    server = WSGIServer(('', args.port), app, log=WebLogger.get_logger(), error_log=error_log_file)
+    server_kwargs = {}
+    if params['push_events']:
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+            server_kwargs['handler_class'] = WebSocketHandler
+        except ImportError:
+            # socket.io falls back to long-polling
+            pass
+    server = WSGIServer(('', args.port), app, log=WebLogger.get_logger(), error_log=error_log_file, **server_kwargs)
     atexit.register(cleanup, flask_app=app)
     server.serve_forever()
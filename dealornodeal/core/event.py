@@ -1,6 +1,8 @@
 from cocoa.core.event import Event as BaseEvent
 
 class Event(BaseEvent):
+    __slots__ = ()
+
     @staticmethod
     def SelectEvent(agent, data, time=None, metadata=None):
         return Event(agent, time, 'select', data, metadata=metadata)
@@ -7,19 +7,19 @@ from core.tokenizer import detokenize
 from parser import Parser
 
 class Generator(BaseGenerator):
-    def get_filter(self, used_templates=None, proposal_type=None, context_tag=None, tag=None, **kwargs):
+    def get_filters(self, used_templates=None, proposal_type=None, context_tag=None, tag=None, **kwargs):
         print 'filter:', proposal_type, context_tag, tag
-        locs = [super(Generator, self).get_filter(used_templates)]
+        levels = []
         if proposal_type:
-            self._add_filter(locs, self.templates.proposal_type == proposal_type)
+            levels.append({'proposal_type': proposal_type})
             # proposal_type must be satisfied
-            if np.sum(locs[-1]) == 0:
+            if self.index.count(levels, used_templates) == 0:
                 return None
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            levels.append({'tag': tag})
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            levels.append({'context_tag': context_tag})
+        return levels
 
 class Templates(BaseTemplates):
     def ambiguous_template(self, template):
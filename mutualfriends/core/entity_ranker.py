@@ -84,6 +84,9 @@ class EntityRanker(object):
             uuid_to_kbs[uuid] = agent_kbs
 
         self.uuid_to_kbs = uuid_to_kbs
+        # Entity surface forms (without types) in each agent's KB
+        self.uuid_to_kb_entities = {uuid: {agent: set([e[1] for e in kb]) for agent, kb in agent_kbs.iteritems()}
+                for uuid, agent_kbs in uuid_to_kbs.iteritems()}
 
 
     def _feature_func(self, span, entity, agent, uuid):
@@ -101,10 +104,9 @@ class EntityRanker(object):
 
         try:
             # Set of entities for given agent
-            kb_entities = self.uuid_to_kbs[uuid][agent]
             # Only consider entity surface form and not type
-            kb_entities = set([e[1] for e in kb_entities])
-        except:
+            kb_entities = self.uuid_to_kb_entities[uuid][agent]
+        except KeyError:
             kb_entities = None
             print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
 
@@ -236,10 +238,20 @@ class EntityRanker(object):
         :param uuid:
         :return:
         """
-        features = self._feature_func(span, entity, agent, uuid)
-        features_transformed = self.vectorizer.transform(features)
+        return self.score_batch([(span, entity)], agent, uuid)
+
 
-        #print "Score: ", self.classifier.predict(features_transformed)
+    def score_batch(self, pairs, agent, uuid):
+        """
+        Score a list of (span, entity) pairs, e.g. all candidates of an utterance or a dialogue,
+        with one call of the classifier
+        :param pairs: List of (span, entity)
+        :param agent:
+        :param uuid:
+        :return: Array of class probabilities (num_pairs, 2)
+        """
+        features = [self._feature_func(span, entity, agent, uuid) for span, entity in pairs]
+        features_transformed = self.vectorizer.transform(features)
         return self.classifier.predict_proba(features_transformed)
 
 
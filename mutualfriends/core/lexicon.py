@@ -1,13 +1,13 @@
 import collections
 import editdistance
 import json
-import re
 import random
 import os.path
 from collections import defaultdict
+from itertools import izip
 from fuzzywuzzy import fuzz
 
-from cocoa.core.util import read_pickle, write_pickle
+from cocoa.core.util import read_pickle, write_pickle, LRUCache
 from cocoa.core.entity import Entity, is_entity
 from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_morphological_variants
 
@@ -73,6 +73,11 @@ class Lexicon(BaseLexicon):
                                    "start", "go", "school", "do", "know", "no", "work", "are",
                                    "he", "she"])
 
+        # Tokens ignored when intersecting candidates of a phrase
+        self.link_stop_words = set(['of'])
+        # LRU cache of best matches of phrases for each KB (see get_match_cache)
+        self.match_cache = LRUCache(100)
+
         #if scenarios_json is not None:
         #    self._process_kbs(scenarios_json)
         #else:
@@ -179,36 +184,34 @@ class Lexicon(BaseLexicon):
         #print 'span:', span
         if not self.learned_lex:
             entity_scores = []
+            span_tokens = span.split()
+
+            def is_stopwords():
+                if len(span_tokens) == 1 and span in self.stop_words:
+                    return True
+                if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
+                    return True
+                all_stop = True
+                for x in span_tokens:
+                    if x not in self.stop_words:
+                        all_stop = False
+                        break
+                if all_stop:
+                    return True
+                return False
+            span_is_stopwords = is_stopwords()
+
             for c in candidates:
                 #print 'c:', c
-                # Clean up punctuation
-                c_s = re.sub("-", " ", c[0])
-                span_tokens = span.split()
-                entity_tokens = c_s.split()
-
-                ed = editdistance.eval(span, c[0])
                 # Filter false positives
                 if c[1] not in kb_entity_types:
                     continue
-
-                def is_stopwords():
-                    if span == c[0]:
-                        return False
-                    if len(span_tokens) == 1 and span in self.stop_words:
-                        return True
-                    if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
-                        return True
-                    all_stop = True
-                    for x in span_tokens:
-                        if x not in self.stop_words:
-                            all_stop = False
-                            break
-                    if all_stop:
-                        return True
-                    return False
-
-                if is_stopwords():
+                if span != c[0] and span_is_stopwords:
                     continue
+
+                # Clean up punctuation
+                c_s = c[0].replace("-", " ")
+                entity_tokens = c_s.split()
                 if len(span_tokens) > len(entity_tokens):
                     continue
                 if c[0] not in kb_entities and known_kb:
@@ -223,7 +226,7 @@ class Lexicon(BaseLexicon):
                 elif len(span_tokens) > 1 and span in c_s:
                     score = 1
                 else:
-                    score = ed + 2
+                    score = editdistance.eval(span, c[0]) + 2
                 # Prioritize entity in KB even if we are not sure
                 if not known_kb and c[0] not in kb_entities and c[0] != span:
                     score += 3
@@ -254,14 +257,15 @@ class Lexicon(BaseLexicon):
             #else:
             #    best_match = (span, None)
         else:
-            # Use learned ranker
+            # Use learned ranker: score the candidates and the span itself in one batch
+            pairs = [(span, c[0]) for c in candidates] + [(span, span)]
+            scores = self.entity_ranker.score_batch(pairs, agent, uuid)
             entity_scores = []
-            for c in candidates:
-                score = self.entity_ranker.score(span, c[0], agent, uuid).squeeze()
+            for c, score in izip(candidates, scores):
                 entity_scores.append(c + (score[0] - score[1],))
 
             # Where does original span fit into all this? If smaller than some threshold
-            span_score = self.entity_ranker.score(span, span, agent, uuid).squeeze()
+            span_score = scores[-1]
 
             # Sort entity scores
             entity_scores = sorted(entity_scores, key=lambda x: x[2])
@@ -274,6 +278,33 @@ class Lexicon(BaseLexicon):
 
         return best_match
 
+    def get_candidate_chain(self, tokens, start, max_length):
+        """
+        Candidate entities of the phrases tokens[start:start+1], ..., tokens[start:start+max_length].
+        Candidates of a phrase are entities that all its tokens (except 'of') map to in the lexicon,
+        so each phrase extends the candidates of the phrase one token shorter. The chain stops at the
+        first phrase without candidates since all longer phrases have none either.
+        """
+        chain = []
+        candidate_entities = None
+        for idx, token in enumerate(tokens[start:start+max_length]):
+            results = self.lookup(token)
+            if idx == 0:
+                candidate_entities = results
+            if token not in self.link_stop_words:
+                candidate_entities = list(set(candidate_entities).intersection(set(results)))
+            chain.append(candidate_entities)
+            if len(candidate_entities) == 0:
+                break
+        return chain
+
+    def get_match_cache(self, kb_entities, kb_entity_types, agent, uuid, known_kb):
+        """
+        Memoized score_and_match results (phrase tokens -> best match) for the given KB.
+        """
+        key = (frozenset(kb_entities), frozenset(kb_entity_types), agent, uuid, known_kb)
+        return self.match_cache.get_or_compute(key, dict)
+
     # TODO: hacky fix.
     def combine_repeated_entity(self, entity_tokens):
         is_entity = lambda x: not isinstance(x, basestring)
@@ -318,23 +349,21 @@ class Lexicon(BaseLexicon):
             kb_entities = None
             kb_entity_types = None
 
+        if kb_entities is not None:
+            matches = self.get_match_cache(kb_entities, kb_entity_types, agent, uuid, known_kb)
         i = 0
         found_entities = []
         linked = []
-        stop_words = set(['of'])
         while i < len(raw_tokens):
             candidate_entities = None
             single_char = False
+            # Candidates of phrases starting at i, computed in one pass
+            candidate_chain = self.get_candidate_chain(raw_tokens, i, 6)
             # Find longest phrase (if any) that matches an entity
             for l in range(6, 0, -1):
-                phrase = ' '.join(raw_tokens[i:i+l])
                 raw = raw_tokens[i:i+l]
-
-                for idx, token in enumerate(raw):
-                    results = self.lookup(token)
-                    if idx == 0: candidate_entities = results
-                    if token not in stop_words:
-                        candidate_entities = list(set(candidate_entities).intersection(set(results)))
+                phrase = ' '.join(raw)
+                candidate_entities = candidate_chain[len(raw)-1] if len(raw) <= len(candidate_chain) else []
 
                 # Single character token so disregard candidate entities
                 if l == 1 and len(phrase) == 1:
@@ -344,7 +373,11 @@ class Lexicon(BaseLexicon):
                 # Found some match
                 if len(candidate_entities) > 0:
                     if kb_entities is not None:
-                        best_match = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
+                        key = tuple(raw)
+                        if key not in matches:
+                            # The learned ranker scores all candidates of the phrase in one batch
+                            matches[key] = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
+                        best_match = matches[key]
                     else:
                         # TODO: Fix default system, if no kb_entities provided -- only returns random candidate now
                         best_match = random.sample(candidate_entities, 1)[0]
@@ -358,10 +391,6 @@ class Lexicon(BaseLexicon):
                     else:
                         candidate_entities = None
                         continue
-                    # else:
-                    #     i += l
-                    #     entities.append(candidate_entities)
-                    #     break
 
             if not candidate_entities or single_char:
                 linked.append(raw_tokens[i])
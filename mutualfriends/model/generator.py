@@ -1,23 +1,22 @@
 from collections import defaultdict
-import numpy as np
 from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseGenerator
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
-    def get_filter(self, used_templates=None, signature=None, context_tag=None, tag=None, **kwargs):
-        locs = [super(Generator, self).get_filter(used_templates)]
+    def get_filters(self, used_templates=None, signature=None, context_tag=None, tag=None, **kwargs):
+        levels = []
         if signature:
-            self._add_filter(locs, self.templates.signature == signature)
+            levels.append({'signature': signature})
             # signature must be satisfied
-            if np.sum(locs[-1]) == 0:
+            if self.index.count(levels, used_templates) == 0:
                 print 'no signature=', signature
                 return None
         if tag:
             print 'tag=', tag
-            self._add_filter(locs, self.templates.tag == tag)
+            levels.append({'tag': tag})
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            levels.append({'context_tag': context_tag})
+        return levels
 
 class Templates(BaseTemplates):
     def _get_entities(self, template):
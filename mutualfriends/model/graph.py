@@ -1,7 +1,7 @@
-from collections import defaultdict
 import numpy as np
 from itertools import izip, islice, chain, repeat
 from cocoa.model.vocab import Vocabulary
+from cocoa.core.util import LRUCache
 from cocoa.core.entity import is_entity
 from graph_embedder_config import GraphEmbedderConfig
 
@@ -83,7 +83,7 @@ class GraphBatch(object):
         return max([graph.paths.shape[0] for graph in self.graphs])
 
     def _max_num_paths_per_node(self):
-        return max([max([paths.shape[0] for paths in graph.node_paths]) for graph in self.graphs])
+        return max([graph.max_num_paths_per_node for graph in self.graphs])
 
     def _make_batch(self, shape, fill_value, dtype, attr):
         batch_data = np.full(shape, fill_value, dtype=dtype)
@@ -98,7 +98,7 @@ class GraphBatch(object):
     def _batch_mask(self, max_num_nodes):
         mask = np.full((self.batch_size, max_num_nodes), False, dtype=np.bool)
         for i, graph in enumerate(self.graphs):
-            mask[i][:len(graph.node_ids)] = True
+            mask[i][:graph.nodes.size] = True
         return mask
 
     def _batch_entity_ids(self, max_num_nodes):
@@ -110,8 +110,9 @@ class GraphBatch(object):
     def _batch_node_paths(self, max_num_nodes, max_num_paths_per_node):
         batch_data = np.full((self.batch_size, max_num_nodes, max_num_paths_per_node), Graph.metadata.PAD_PATH_ID, dtype=np.int32)
         for i, graph in enumerate(self.graphs):
-            for j, node_path in enumerate(graph.node_paths):
-                batch_data[i][j][:len(node_path)] = node_path
+            # New entity nodes only have the padded path
+            kb_graph = graph.kb_graph
+            batch_data[i][:kb_graph.num_nodes][kb_graph.node_path_mask(max_num_paths_per_node)] = kb_graph.path_ids
         return batch_data
 
     def _batch_node_feats(self, max_num_nodes):
@@ -268,15 +269,206 @@ class GraphBatch(object):
                 }
         return batch
 
+def node_type(node):
+    # Use fine categorty for item and attr nodes
+    name, type_ = node
+    return name if type_ == 'item' or type_ == 'attr' else type_
+    #return type_
+
+def bin_degrees(degrees, num_items):
+    '''
+    Relative degree of nodes: 0 if the degree is 0, 5 if it is num_items,
+    and 1-4 for each quarter in between.
+    '''
+    # NOTE: we consider degree only for attr and entity nodes (only count edges connected
+    # to item nodes).
+    assert (degrees <= num_items).all()
+    p = degrees / float(max(num_items, 1))
+    bins = 1 + np.searchsorted([0.25, 0.5, 0.75], p, side='right')
+    bins[p == 0] = 0
+    bins[p == 1] = 5
+    return bins
+
+def _get_index(feat_name, feat_values):
+    offset, size = Graph.metadata.feat_inds[feat_name]
+    assert (feat_values < size).all()
+    return offset + feat_values
+
+def get_feat_vec(degrees, node_types, num_items):
+    '''
+    Input: degree and node type of each node
+    Output: one-hot encoded numpy feature matrix
+    '''
+    f = np.zeros([len(node_types), Graph.metadata.feat_size], dtype=np.float32)
+    rows = np.arange(len(node_types))
+    type_ids = np.array(Graph.metadata.node_types.to_inds(node_types), dtype=np.int64)
+    f[rows, _get_index('node_type', type_ids)] = 1
+
+    # Don't consider degree of item nodes (number of attrs, same for all items)
+    has_degree = np.array([not t.startswith('item') for t in node_types], dtype=np.bool)
+    rows = rows[has_degree]
+    degrees = np.asarray(degrees, dtype=np.int64)[has_degree]
+    f[rows, _get_index('rel_degree', bin_degrees(degrees, num_items))] = 1
+    f[rows, _get_index('degree', degrees)] = 1
+
+    return f
+
+class KBGraph(object):
+    '''
+    The part of the graph read from a KB, which does not change during a dialogue.
+    Construct 3 types of nodes: item, entity, attribute
+    and 2 types of paths: (item, has_attr, entity) and (attr has entity).
+    Paths starting from node i are path_ids[path_offsets[i]:path_offsets[i+1]].
+    '''
+    def __init__(self, kb):
+        self.metadata = Graph.metadata
+        self.num_items = len(kb.items)
+        self.nodes = []
+        self.node_to_ind = {}
+
+        # (item, entity) and (attr, entity) pairs; each one gives a path and its inverse
+        item_paths = ([], [], [])
+        attr_ents = []
+        attr_ent_set = set()
+        for i, item in enumerate(kb.items):
+            # Item nodes
+            item_id = self._add_node((item_to_str(i), 'item'))
+            for attr_name, value in sorted(item.items(), key=lambda x: x[0]):
+                type_ = self.metadata.attribute_types[attr_name]
+                attr_name = attr_name.lower()
+                # Attribute nodes
+                attr_id = self._add_node((attr_name, 'attr'))
+                # Entity nodes
+                entity_id = self._add_node((value.lower(), type_))
+                # Path: item has_attr entity
+                for ids, x in izip(item_paths, (item_id, attr_name, entity_id)):
+                    ids.append(x)
+                if (attr_id, entity_id) not in attr_ent_set:
+                    attr_ent_set.add((attr_id, entity_id))
+                    attr_ents.append((attr_id, entity_id))
+        self.num_nodes = len(self.nodes)
+
+        # Path: attr has entity
+        relation_map = self.metadata.relation_map
+        relations = item_paths[1] + ['has'] * len(attr_ents)
+        heads = np.array(item_paths[0] + [a for a, e in attr_ents], dtype=np.int32)
+        tails = np.array(item_paths[2] + [e for a, e in attr_ents], dtype=np.int32)
+        # NOTE: The first path is always a padding path
+        paths = np.empty([1 + 2 * len(relations), 3], dtype=np.int32)
+        paths[0] = self.metadata.PATH_PAD
+        paths[1::2, 0], paths[1::2, 1], paths[1::2, 2] = heads, relation_map.to_inds(relations), tails
+        paths[2::2, 0], paths[2::2, 1], paths[2::2, 2] = tails, relation_map.to_inds([inv_rel(r) for r in relations]), heads
+        self.paths = paths
+
+        # CSR of node -> paths, skipping the first padding path
+        path_counts = np.bincount(paths[1:, 0], minlength=self.num_nodes)
+        self.path_offsets = np.concatenate(([0], np.cumsum(path_counts))).astype(np.int32)
+        self.path_ids = (np.argsort(paths[1:, 0], kind='mergesort') + 1).astype(np.int32)
+        self.max_num_paths_per_node = int(path_counts.max()) if self.num_nodes > 0 else 0
+
+        self.entity_ids = np.array(self.metadata.entity_map.to_inds(self.nodes), dtype=np.int32)
+        self.feats = self.get_features(path_counts)
+
+    def _add_node(self, node):
+        if node not in self.node_to_ind:
+            self.node_to_ind[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.node_to_ind[node]
+
+    def get_features(self, path_counts):
+        degrees = np.array(path_counts, dtype=np.int64)
+        # The padding path starts from node 0
+        if self.num_nodes > 0:
+            degrees[0] += 1
+        # For entity node, -1 degree so that it excludes the edge incident to the attr node
+        is_entity = np.array([node[1] != 'item' and node[1] != 'attr' for node in self.nodes], dtype=np.bool)
+        degrees[is_entity] -= 1
+        return get_feat_vec(degrees, [node_type(node) for node in self.nodes], self.num_items)
+
+    def node_path_mask(self, max_num_paths_per_node):
+        '''
+        (num_nodes, max_num_paths_per_node) mask of the positions of path_ids
+        in the padded node_paths matrix.
+        '''
+        path_counts = np.diff(self.path_offsets)
+        return np.arange(max_num_paths_per_node) < path_counts[:, None]
+
+# (KB, KBGraph) of each KB (keyed by its id)
+kb_graphs = LRUCache(1000)
+
+def get_kb_graph(kb):
+    entry = kb_graphs.get(id(kb))
+    # Graphs depend on the graph metadata
+    if entry is None or entry[1].metadata is not Graph.metadata:
+        entry = (kb, KBGraph(kb))
+        kb_graphs.put(id(kb), entry)
+    return entry[1]
+
+class GraphNodes(object):
+    '''
+    Map between nodes and node ids: nodes of the KB graph followed by entity
+    nodes added during the dialogue, in the order they are added.
+    Lookups are the same as Vocabulary.
+    '''
+    def __init__(self, kb_graph):
+        self.kb_nodes = kb_graph.nodes
+        self.kb_node_to_ind = kb_graph.node_to_ind
+        self.new_nodes = []
+        self.new_node_to_ind = {}
+
+    @property
+    def size(self):
+        return len(self.kb_nodes) + len(self.new_nodes)
+
+    def __len__(self):
+        return self.size
+
+    def has(self, node):
+        return node in self.kb_node_to_ind or node in self.new_node_to_ind
+
+    def add_words(self, nodes):
+        for node in nodes:
+            if not self.has(node):
+                self.new_node_to_ind[node] = self.size
+                self.new_nodes.append(node)
+
+    def to_ind(self, node):
+        if node in self.kb_node_to_ind:
+            return self.kb_node_to_ind[node]
+        return self.new_node_to_ind[node]
+
+    def to_word(self, ind):
+        if 0 <= ind < len(self.kb_nodes):
+            return self.kb_nodes[ind]
+        if len(self.kb_nodes) <= ind < self.size:
+            return self.new_nodes[ind - len(self.kb_nodes)]
+        raise KeyError(ind)
+
 class Graph(object):
     '''
-    Maintain a (dynamic) knowledge graph of the agent.
+    Maintain a (dynamic) knowledge graph of the agent: the static graph of the KB
+    (shared through get_kb_graph) and entity nodes mentioned in the dialogue.
     '''
     metadata = None
 
     def __init__(self, kb):
         assert Graph.metadata is not None
         self.kb = kb
+        self.kb_graph = get_kb_graph(kb)
+        self.num_items = self.kb_graph.num_items
+        # All paths in the KB; each path is a 3-tuple (node_id, edge_id, node_id)
+        # NOTE: The first path is always a padding path
+        self.paths = self.kb_graph.paths
+
+        # Node data of KB nodes followed by entity nodes; rows of entity nodes
+        # are written when they are added
+        num_nodes = self.kb_graph.num_nodes
+        capacity = num_nodes + Graph.metadata.max_num_entities
+        self._feats = np.zeros([capacity, Graph.metadata.feat_size], dtype=np.float32)
+        self._feats[:num_nodes] = self.kb_graph.feats
+        self._entity_ids = np.zeros(capacity, dtype=np.int32)
+        self._entity_ids[:num_nodes] = self.kb_graph.entity_ids
+
         self.reset()
 
     def reset(self):
@@ -285,32 +477,42 @@ class Graph(object):
         This is required during training when we go through one dialogue multiple times.
         '''
         # Map each node in the graph to an integer
-        self.nodes = Vocabulary(unk=False)
-        # All paths in the KB; each path is a 3-tuple (node_id, edge_id, node_id)
-        # NOTE: The first path is always a padding path
-        self.paths = [Graph.metadata.PATH_PAD]
-        # Read information form KB to fill in nodes and paths
-        self.num_items = len(self.kb.items)
-        self.load_kb(self.kb)
-
-        # Input data to feed_dict
-        self.node_ids = np.arange(self.nodes.size, dtype=np.int32)
-        self.entity_ids = np.array([Graph.metadata.entity_map.to_ind(self.nodes.to_word(i)) for i in xrange(self.nodes.size)], dtype=np.int32)
-        self.paths = np.array(self.paths, dtype=np.int32)
-        self.feats = self.get_features()
-        self.node_paths = self.get_node_paths()
-
+        self.nodes = GraphNodes(self.kb_graph)
         # Entity/token sequence in the dialogue
         self.entities = []
 
-    def get_node_paths(self):
-        node_paths = []
-        for node_id in self.node_ids:
-            # Skip the first padding path
-            paths = [path_id for path_id, path in enumerate(self.paths) if path_id != Graph.metadata.PAD_PATH_ID and path[0] == node_id]
-            node_paths.append(np.array(paths, dtype=np.int32))
+    @property
+    def node_ids(self):
+        return np.arange(self.nodes.size, dtype=np.int32)
+
+    @property
+    def entity_ids(self):
+        return self._entity_ids[:self.nodes.size]
+
+    @property
+    def feats(self):
+        return self._feats[:self.nodes.size]
+
+    @property
+    def num_new_nodes(self):
+        return self.nodes.size - self.kb_graph.num_nodes
+
+    @property
+    def node_paths(self):
+        '''
+        Ids of the paths starting from each node. New entities map to the padded path.
+        '''
+        offsets, path_ids = self.kb_graph.path_offsets, self.kb_graph.path_ids
+        node_paths = [path_ids[offsets[i]:offsets[i+1]] for i in xrange(self.kb_graph.num_nodes)]
+        node_paths.extend([np.array([Graph.metadata.PAD_PATH_ID], dtype=np.int32)] * self.num_new_nodes)
         return node_paths
 
+    @property
+    def max_num_paths_per_node(self):
+        if self.num_new_nodes > 0:
+            return max(self.kb_graph.max_num_paths_per_node, 1)
+        return self.kb_graph.max_num_paths_per_node
+
     def get_input_data(self):
         '''
         Return feed_dict data to the GraphEmbed model.
@@ -318,47 +520,6 @@ class Graph(object):
         assert self.node_ids.shape[0] == self.feats.shape[0]
         return (self.node_ids, self.entity_ids, self.paths, self.feats)
 
-    def _add_path(self, node1, relation, node2):
-        node1_id = self.nodes.to_ind(node1)
-        node2_id = self.nodes.to_ind(node2)
-        rel = Graph.metadata.relation_map.to_ind(relation)
-        irel = Graph.metadata.relation_map.to_ind(inv_rel(relation))
-        self.paths.append((node1_id, rel, node2_id))
-        self.paths.append((node2_id, irel, node1_id))
-
-    def load_kb(self, kb):
-        '''
-        Construct 3 types of nodes: item, entity, attribute
-        and 2 types of paths: (item, has_attr, entity) and (attr has entity)
-        '''
-        attr_ents = defaultdict(set)  # Entities of each attribute
-        for i, item in enumerate(kb.items):
-            # Item nodes
-            item_node = (item_to_str(i), 'item')
-            #item_name = item_to_str(i)
-            #item_node = (item_name, item_name)
-            self.nodes.add_word(item_node)
-            attrs = sorted(item.items(), key=lambda x: x[0])
-            for attr_name, value in attrs:
-                type_ = Graph.metadata.attribute_types[attr_name]
-                attr_name = attr_name.lower()
-                value = value.lower()
-                # Attribute nodes
-                attr_node = (attr_name, 'attr')
-                #attr_node = (attr_name, attr_name)
-                self.nodes.add_word(attr_node)
-                # Entity nodes
-                entity_node = (value, type_)
-                self.nodes.add_word(entity_node)
-                # Path: item has_attr entity
-                self._add_path(item_node, attr_name, entity_node)
-                attr_ents[attr_node].add(entity_node)
-        # Path: attr has entity
-        for attr_node, ent_set in attr_ents.iteritems():
-            for entity_node in ent_set:
-                self._add_path(attr_node, 'has', entity_node)
-        self.paths = np.array(self.paths, dtype=np.int32)
-
     def read_utterance(self, tokens, stage=None):
         '''
         Map entities to node ids and tokens to -1. Add new nodes if needed.
@@ -372,33 +533,28 @@ class Graph(object):
         node_ids = [self.nodes.to_ind(x[1]) for x in tokens if is_entity(x)]
         self.entities.append(node_ids)
 
-    def _update_nodes(self, entities):
-        self.nodes.add_words(entities)
-        self.node_ids = np.arange(self.nodes.size, dtype=np.int32)
-
-    def _update_feats(self, entities):
-        # degree=0, node_type=entity type
-        feats = [[0, self._node_type(x)] for x in entities]
-        new_feat_vec = self.get_feat_vec(feats)
-        self.feats = np.concatenate((self.feats, new_feat_vec), axis=0)
-
-    def _update_entity_ids(self, entities):
-        self.entity_ids = np.concatenate([self.entity_ids,
-                   [Graph.metadata.entity_map.to_ind(entity) for entity in entities]], axis=0)
-
-    def _update_node_paths(self, entities):
-        '''
-        New entities map to the padded path.
-        '''
-        for _ in entities:
-            self.node_paths.append(np.array([Graph.metadata.PAD_PATH_ID]))
+    def _reserve(self, num_nodes):
+        capacity = self._feats.shape[0]
+        if num_nodes <= capacity:
+            return
+        capacity = max(num_nodes, 2 * capacity)
+        feats = np.zeros([capacity, self._feats.shape[1]], dtype=self._feats.dtype)
+        feats[:self._feats.shape[0]] = self._feats
+        entity_ids = np.zeros(capacity, dtype=self._entity_ids.dtype)
+        entity_ids[:self._entity_ids.shape[0]] = self._entity_ids
+        self._feats, self._entity_ids = feats, entity_ids
 
     def add_entity_nodes(self, entities):
         # Paths do not change, no need to update
-        self._update_nodes(entities)
-        self._update_entity_ids(entities)
-        self._update_feats(entities)
-        self._update_node_paths(entities)
+        entities = [x for x in entities if not self.nodes.has(x)]
+        start = self.nodes.size
+        self.nodes.add_words(entities)
+        end = self.nodes.size
+        self._reserve(end)
+        # degree=0, node_type=entity type
+        self._feats[start:end] = get_feat_vec(np.zeros(len(entities), dtype=np.int64),
+                [node_type(x) for x in entities], self.num_items)
+        self._entity_ids[start:end] = Graph.metadata.entity_map.to_inds(entities)
 
     def get_entity_list(self):
         '''
@@ -418,62 +574,6 @@ class Graph(object):
             else:
                 return list(set(self.entities[-1]))
 
-    def _node_type(self, node):
-        # Use fine categorty for item and attr nodes
-        name, type_ = node
-        return name if type_ == 'item' or type_ == 'attr' else type_
-        #return type_
-
-    def get_features(self):
-        nodes = [self.nodes.to_word(i) for i in xrange(self.nodes.size)]
-        # For entity node, -1 degree so that it excludes the edge incident to the attr node
-        feats = [[0, self._node_type(node)] if node[1] == 'item' or node[1] == 'attr'
-                else [-1, self._node_type(node)] for node in nodes]
-        # Compute degree of each node
-        for path in self.paths:
-            n1, r, n2 = path
-            feats[n1][0] += 1
-        return self.get_feat_vec(feats)
-
     @classmethod
     def degree_feat_size(cls):
         return 6
-
-    def _bin_degree(self, degree):
-        # NOTE: we consider degree only for attr and entity nodes (only count edges connected
-        # to item nodes).
-        assert degree <= self.num_items
-        p = degree / float(self.num_items)
-        if p == 0:
-            return 0
-        if p < 0.25:
-            return 1
-        if p >= 0.25 and p < 0.5:
-            return 2
-        if p >= 0.5 and p < 0.75:
-            return 3
-        if p >= 0.75 and p < 1:
-            return 4
-        if p == 1:
-            return 5
-
-    def _get_index(self, feat_name, feat_value):
-        offset, size = Graph.metadata.feat_inds[feat_name]
-        assert feat_value < size
-        return offset + feat_value
-
-    def get_feat_vec(self, raw_feats):
-        '''
-        Input: a list of features [degree, node_type] for each node
-        Output: one-hot encoded numpy feature matrix
-        '''
-        f = np.zeros([len(raw_feats), Graph.metadata.feat_size])
-
-        for i, (degree, node_type) in enumerate(raw_feats):
-            # Don't consider degree of item nodes (number of attrs, same for all items)
-            if not node_type.startswith('item'):
-                f[i][self._get_index('rel_degree', self._bin_degree(degree))] = 1
-                f[i][self._get_index('degree', degree)] = 1
-            f[i][self._get_index('node_type', Graph.metadata.node_types.to_ind(node_type))] = 1
-
-        return f
@@ -0,0 +1,72 @@
+'''
+Self-play throughput of the heuristic bot (HeuristicSystem) on MutualFriends scenarios.
+'''
+
+import argparse
+import random
+import time
+import numpy as np
+
+from cocoa.core.util import read_json
+from cocoa.core.schema import Schema
+from cocoa.core.scenario_db import ScenarioDB
+import cocoa.options
+
+from core.scenario import Scenario
+from core.controller import Controller
+from systems.heuristic_system import HeuristicSystem, add_heuristic_system_arguments
+
+def self_play(system, scenario, max_turns):
+    '''
+    Run a dialogue like Controller.simulate without printing. Both sessions
+    may keep waiting (send returns None), so the number of sends is bounded too.
+    Return the number of turns and the reward.
+    '''
+    sessions = [system.new_session(agent, scenario.kbs[agent]) for agent in (0, 1)]
+    controller = Controller(scenario, sessions)
+    first_speaker = 0 if random.random() < 0.5 else 1
+    num_turns = 0
+    for i in xrange(4 * max_turns):
+        agent = (first_speaker + i) % 2
+        event = sessions[agent].send()
+        if not event:
+            continue
+        controller.event_callback(event)
+        num_turns += 1
+        if controller.game_over() or num_turns >= max_turns:
+            break
+        sessions[1 - agent].receive(event)
+    return num_turns, controller.get_outcome()['reward']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-dialogues', default=1000, type=int)
+    parser.add_argument('--max-turns', default=100, type=int)
+    parser.add_argument('--random-seed', default=1, type=int)
+    cocoa.options.add_scenario_arguments(parser)
+    add_heuristic_system_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(args.random_seed)
+    schema = Schema(args.schema_path)
+    scenarios = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario).scenarios_list
+    system = HeuristicSystem(args.joint_facts, args.ask)
+
+    num_turns, rewards = [], []
+    num_errors = 0
+    start = time.time()
+    for i in xrange(args.num_dialogues):
+        try:
+            n, reward = self_play(system, scenarios[i % len(scenarios)], args.max_turns)
+        except AssertionError:
+            # HeuristicSession.update asserts that facts are disjoint, which joint facts may violate
+            num_errors += 1
+            continue
+        num_turns.append(n)
+        rewards.append(reward)
+    elapsed = time.time() - start
+
+    print '{} dialogues in {:.2f}s: {:.1f} dialogues/s, {:.1f} turns/s'.format(
+            args.num_dialogues, elapsed, args.num_dialogues / elapsed, sum(num_turns) / elapsed)
+    print 'success rate={:.3f}, turns per dialogue={:.1f}, failed dialogues={}'.format(
+            np.mean(rewards), np.mean(num_turns), num_errors)
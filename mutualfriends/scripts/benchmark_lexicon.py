@@ -0,0 +1,88 @@
+'''
+Time entity linking over the messages of a MutualFriends corpus and check that
+Lexicon.link_entity gives the same output as the original span-by-span linker.
+'''
+
+import argparse
+import random
+import time
+
+from cocoa.core.dataset import read_examples
+from cocoa.core.schema import Schema
+from cocoa.core.entity import Entity
+
+from core.scenario import Scenario
+from core.lexicon import Lexicon, add_lexicon_arguments
+from core.tokenizer import tokenize
+
+def naive_link_entity(lexicon, raw_tokens, kb):
+    '''
+    Reference linker: looks up every phrase of length 6..1 from scratch and
+    scores candidates without memoization.
+    '''
+    kb_entities = kb.entity_set
+    kb_entity_types = kb.entity_type_set
+    i = 0
+    linked = []
+    while i < len(raw_tokens):
+        candidate_entities = None
+        single_char = False
+        for l in range(6, 0, -1):
+            phrase = ' '.join(raw_tokens[i:i+l])
+            for idx, token in enumerate(raw_tokens[i:i+l]):
+                results = lexicon.lookup(token)
+                if idx == 0: candidate_entities = results
+                if token != 'of':
+                    candidate_entities = list(set(candidate_entities).intersection(set(results)))
+            if l == 1 and len(phrase) == 1:
+                single_char = True
+                break
+            if len(candidate_entities) > 0:
+                best_match = lexicon.score_and_match(phrase, candidate_entities, 1, 'NONE', kb_entities, kb_entity_types, True)
+                if best_match[1] is not None:
+                    linked.append((phrase, best_match))
+                    i += l
+                    break
+                else:
+                    candidate_entities = None
+                    continue
+        if not candidate_entities or single_char:
+            linked.append(raw_tokens[i])
+            i += 1
+    linked = lexicon.combine_repeated_entity(linked)
+    return [Entity.from_elements(x[0], x[1][0], x[1][1]) if not isinstance(x, basestring) else x for x in linked]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transcripts', nargs='*', help='JSON transcripts')
+    parser.add_argument('--max-examples', default=-1, type=int)
+    parser.add_argument('--schema-path', help='Path to schema')
+    parser.add_argument('--check', action='store_true', help='Compare with the reference linker')
+    add_lexicon_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(1)
+    schema = Schema(args.schema_path)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon)
+    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+
+    # (tokens, kb of the receiving agent)
+    messages = []
+    for example in examples:
+        for event in example.events:
+            if event.action == 'message':
+                messages.append((tokenize(event.data), example.scenario.kbs[1 - event.agent]))
+    print '{} messages from {} dialogues'.format(len(messages), len(examples))
+
+    start = time.time()
+    linked = [lexicon.link_entity(tokens, kb=kb) for tokens, kb in messages]
+    elapsed = time.time() - start
+    print 'link_entity: {:.2f}s ({:.2f}ms per message)'.format(elapsed, elapsed * 1000. / max(1, len(messages)))
+
+    if args.check:
+        start = time.time()
+        expected = [naive_link_entity(lexicon, tokens, kb) for tokens, kb in messages]
+        elapsed = time.time() - start
+        print 'reference: {:.2f}s ({:.2f}ms per message)'.format(elapsed, elapsed * 1000. / max(1, len(messages)))
+        num_diff = sum([1 for a, b in zip(linked, expected) if a != b])
+        print '{} messages linked differently'.format(num_diff)
@@ -1,17 +1,93 @@
-from simple_session import SimpleSession
-from collections import defaultdict
+from session import Session
 import random
 from cocoa.core.event import Event
-import copy
 DEBUG = 0
 
 #GREETING = ['hi', 'hello', 'hey']
 GREETING = ['hi']
 
-class HeuristicSession(SimpleSession):
+def popcount(mask):
+    return bin(mask).count('1')
+
+def lowest_bit(mask):
+    '''
+    Index of the lowest set bit.
+    '''
+    return (mask & -mask).bit_length() - 1
+
+class ItemIndex(object):
+    '''
+    Sets of items of a KB as bitmasks, where bit i is kb.items[i], and the mask
+    of items having each (attribute, value).
+    '''
+    def __init__(self, items):
+        self.items = items
+        self.all_items = (1 << len(items)) - 1
+        # {(name, value): mask}
+        self.masks = {}
+        # Items with the same attribute values
+        self.item_masks = {}
+        values = {}
+        for i, item in enumerate(items):
+            for name, value in item.iteritems():
+                if (name, value) not in self.masks:
+                    self.masks[(name, value)] = 0
+                    values.setdefault(name, []).append(value)
+                self.masks[(name, value)] |= 1 << i
+            key = self.item_key(item)
+            self.item_masks[key] = self.item_masks.get(key, 0) | (1 << i)
+        # {name: [(value, mask)]}
+        self.value_masks = {name: [(v, self.masks[(name, v)]) for v in vs] for name, vs in values.iteritems()}
+
+    @classmethod
+    def item_key(cls, item):
+        return tuple(sorted(item.iteritems()))
+
+    def to_items(self, mask):
+        return [item for i, item in enumerate(self.items) if (mask >> i) & 1]
+
+    def item_mask(self, item):
+        return self.item_masks.get(self.item_key(item), 0)
+
+    def fact_mask(self, fact):
+        '''
+        Items that satisfy the joint constraint of the fact (see HeuristicSession.satisfy).
+        '''
+        attr_values, count = fact
+        mask = self.all_items
+        for name, value in attr_values:
+            mask &= self.masks.get((name, value), 0)
+        return mask if count > 0 else self.all_items & ~mask
+
+    def count_attrs(self, mask):
+        '''
+        {name: {value: number of items in mask with the value}}
+        '''
+        # Keys are added in the order of items as when counting item by item
+        state = {}
+        if mask == 0:
+            return state
+        first_item = self.items[lowest_bit(mask)]
+        for name in first_item.iterkeys():
+            counts = []
+            for value, value_mask in self.value_masks[name]:
+                value_mask &= mask
+                if value_mask:
+                    counts.append((lowest_bit(value_mask), value, popcount(value_mask)))
+            counts.sort(key=lambda x: x[0])
+            state[name] = {}
+            for _, value, count in counts:
+                state[name][value] = count
+        return state
+
+class HeuristicSession(Session):
+    '''
+    Item sets (curr_set, possible_set) are {'items': bitmask of kb.items, 'attrs': checked attributes}.
+    '''
     def __init__(self, agent, kb, joint_facts, ask):
-        self.agent = agent
+        super(HeuristicSession, self).__init__(agent)
         self.kb = kb
+        self.index = ItemIndex(self.kb.items)
         self.total_num_attrs = len(self.kb.items[0])
 
         # All items start with weight 1 and get decreased
@@ -22,9 +98,9 @@ class HeuristicSession(SimpleSession):
         self.received_state = None
         self.state = None
         self.matched_item = None
-        self.curr_set = {'items': self.kb.items, 'attrs': set()}
-        self.possible_set = {'items': self.kb.items, 'attrs': set()}
-        self.prev_possible_set = copy.deepcopy(self.possible_set)
+        self.curr_set = {'items': self.index.all_items, 'attrs': set()}
+        self.possible_set = {'items': self.index.all_items, 'attrs': set()}
+        self.prev_possible_set = self.copy_set(self.possible_set)
 
         self.informed_facts = set()
         self.last_selected_item = None
@@ -33,12 +109,20 @@ class HeuristicSession(SimpleSession):
         self.joint_facts = joint_facts
         self.ask_action = ask
 
+    def copy_set(self, item_set):
+        return {'items': item_set['items'], 'attrs': set(item_set['attrs'])}
+
+    def num_items(self, item_set):
+        return popcount(item_set['items'])
+
+    def get_items(self, item_set):
+        return self.index.to_items(item_set['items'])
+
     def count_attrs(self, items):
-        state = defaultdict(lambda : defaultdict(int))
-        for item in items:
-            for name, value in item.iteritems():
-                state[name][value] += 1
-        return state
+        '''
+        items: bitmask
+        '''
+        return self.index.count_attrs(items)
 
     def get_majority_attrs(self, attr_counts, checked_attrs):
         '''
@@ -110,9 +194,9 @@ class HeuristicSession(SimpleSession):
             # Randomly select two attributes
             attr_names = random.sample(attr_counts.keys(), 2)
             # Randomly select one item to fill in attribute values
-            item = random.choice(items)
+            item = random.choice(self.index.to_items(items))
             attr_values = [(name, item[name]) for name in attr_names]
-            count = sum([1 for it in items if self.satisfy(it, (attr_values, 1))])
+            count = popcount(items & self.index.fact_mask((attr_values, 1)))
             fact = [(attr_values, count)]
             facts.append(fact)
 
@@ -123,16 +207,11 @@ class HeuristicSession(SimpleSession):
         return selected
 
     def sample_fact(self, facts):
+        # Sample among facts that have not been informed
+        facts = [f for f in (self.filter_fact(fact) for fact in facts) if len(f) > 0]
         if len(facts) == 0:
             return None
-        i = 0
-        while i < 100:
-            fact = random.choice(facts)
-            fact = self.filter_fact(fact)
-            if len(fact) > 0:
-                return fact
-            i += 1
-        return None
+        return random.choice(facts)
 
     def number_to_str(self, count, total):
         if count == 0:
@@ -151,7 +230,7 @@ class HeuristicSession(SimpleSession):
 
     def fact_to_str(self, fact, item_set, include_count=True):
         fact_str = []
-        total = len(item_set['items'])  # Total number of items in the set being considered
+        total = self.num_items(item_set)  # Total number of items in the set being considered
         for attrs, count in fact:
             if include_count:
                 s = '%s %s' % (self.number_to_str(count, total), ' and '.join([a[1] for a in attrs]))
@@ -172,7 +251,7 @@ class HeuristicSession(SimpleSession):
         self.state = ('inform', fact)
         self.update_informed_facts(fact)
         fact_str = self.fact_to_str(fact, item_set)
-        conditioned = True if len(item_set['items']) < len(self.curr_set['items']) else False
+        conditioned = True if self.num_items(item_set) < self.num_items(self.curr_set) else False
         # Global information
         if not conditioned:
             message = 'I have %s.' % fact_str
@@ -186,12 +265,12 @@ class HeuristicSession(SimpleSession):
         return self.message(message, self.state)
 
     def reset_possible_set(self):
-        self.possible_set['items'] = list(self.curr_set['items'])
+        self.possible_set['items'] = self.curr_set['items']
         self.possible_set['attrs'] = set(self.curr_set['attrs'])
 
     def answer(self):
         # TODO: partial satisfaction
-        if len(self.possible_set['items']) == 0:
+        if self.possible_set['items'] == 0:
             self.state = ('answer', False)
             self.reset_possible_set()
             return self.message('No.', self.state)
@@ -229,20 +308,21 @@ class HeuristicSession(SimpleSession):
         return satisfy == (count > 0)
 
     def filter(self, item_set, facts):
-        items, attrs = item_set['items'], item_set['attrs']
-        item_ids = []
+        '''
+        Keep items in item_set that satisfy any of the facts.
+        '''
+        attrs = item_set['attrs']
+        mask = 0
         for fact in facts:
             # Attributes that don't exist shouldn't be counted as checked
             if fact[1] > 0:
                 for name, value in fact[0]:
                     attrs.add(name)
-            for i, item in enumerate(items):
-                if self.satisfy(item, fact):
-                    item_ids.append(i)
-        item_set['items'] = [items[i] for i in set(item_ids)]
+            mask |= self.index.fact_mask(fact)
+        item_set['items'] &= mask
 
     def print_items(self, item_set):
-        items, attrs = item_set['items'], item_set['attrs']
+        items, attrs = self.get_items(item_set), item_set['attrs']
         for item in items:
             print item.values()
         print attrs
@@ -264,8 +344,9 @@ class HeuristicSession(SimpleSession):
             return
         # We selected a wrong item
         if self.state and self.state[0] == 'select':
-            self.curr_set['items'] = [item for item in self.curr_set['items'] if item != self.state[1]]
-            self.possible_set['items'] = [item for item in self.possible_set['items'] if item != self.state[1]]
+            selected = self.index.item_mask(self.state[1])
+            self.curr_set['items'] &= ~selected
+            self.possible_set['items'] &= ~selected
 
         self.received_state = state
         intent = state[0]
@@ -282,20 +363,21 @@ class HeuristicSession(SimpleSession):
                 # Negate all facts
                 facts = [(fact[0], 0) for fact in self.state[1]]
                 # If this is No to all items, enforce the constraint globally
-                if sum([fact[1] for fact in self.state[1]]) == len(self.curr_set['items']):
+                if sum([fact[1] for fact in self.state[1]]) == self.num_items(self.curr_set):
                     certain_facts = facts
             else:
                 facts = self.state[1]
 
         # Exclude items based on must-have and must-not-have attribute values
         if len(certain_facts) > 0:
-            print 'certain facts:', certain_facts
+            if DEBUG:
+                print 'certain facts:', certain_facts
             self.filter(self.curr_set, certain_facts)
-            assert len(self.curr_set['items']) > 0
+            assert self.curr_set['items'] != 0
 
         # Hypothetical items
         if facts:
-            if len(self.possible_set['items']) == 0:
+            if self.possible_set['items'] == 0:
                 self.reset_possible_set()
             self.filter(self.possible_set, facts)
 
@@ -307,14 +389,14 @@ class HeuristicSession(SimpleSession):
             self.print_items(self.curr_set)
 
     def interesting_fact(self, fact, subset):
-        total = len(subset['items'])
+        total = self.num_items(subset)
         for attrs, count in fact:
             if count == 1 or count == total:
                 return True
         return False
 
     def receive(self, event):
-        self.prev_possible_set = copy.deepcopy(self.possible_set)
+        self.prev_possible_set = self.copy_set(self.possible_set)
         if event.action == 'message':
             # NOTE: assume we can see the state. In practice need to parse.
             self.update(event.state)
@@ -330,10 +412,10 @@ class HeuristicSession(SimpleSession):
             return self.select(self.matched_item)
 
         # Check if we get a match
-        if len(self.curr_set['items']) == 1:
-            return self.select(self.curr_set['items'][0])
-        if len(self.possible_set['items']) == 1 and len(self.possible_set['attrs']) == self.total_num_attrs:
-            return self.select(self.possible_set['items'][0])
+        if self.num_items(self.curr_set) == 1:
+            return self.select(self.get_items(self.curr_set)[0])
+        if self.num_items(self.possible_set) == 1 and len(self.possible_set['attrs']) == self.total_num_attrs:
+            return self.select(self.get_items(self.possible_set)[0])
 
         #if random.random() < 0.2:  # Wait randomly
         #    return None
@@ -355,7 +437,7 @@ class HeuristicSession(SimpleSession):
         if self.state and self.state[0] == 'ask' and (not self.received_state or self.received_state[0] != 'answer'):
             return None
 
-        if len(self.possible_set['items']) == 0:
+        if self.possible_set['items'] == 0:
             self.reset_possible_set()
             # Inform when the partner's constraint results in an empty set
             if self.received_state[0] == 'inform':
@@ -367,14 +449,14 @@ class HeuristicSession(SimpleSession):
 
         subset = self.possible_set
         # Take a guess
-        if len(subset['items']) < 3:
+        if self.num_items(subset) < 3:
             if random.random() < 0.5:
-                return self.select(random.choice(subset['items']))
+                return self.select(random.choice(self.get_items(subset)))
         # Select a fact to ask or inform
         fact = self.choose_fact(subset)
         # Run out of facts to inform
         if not fact:
-            return self.select(random.choice(subset['items']))
+            return self.select(random.choice(self.get_items(subset)))
         if self.ask_action and random.random() < 0.5:
             return self.ask(fact, subset)
         else:
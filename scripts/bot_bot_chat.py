@@ -4,32 +4,30 @@ Takes two agent implementations and generates the dialogues.
 
 import argparse
 import random
-import json
+from functools import partial
 import numpy as np
 
 from cocoa.core.util import read_json
 from cocoa.core.schema import Schema
-from cocoa.core.scenario_db import ScenarioDB, add_scenario_arguments
-from cocoa.core.dataset import add_dataset_arguments
+from cocoa.core.scenario_db import ScenarioDB
+from cocoa.core.dataset import TranscriptWriter
+from cocoa.core.rollout import RolloutEngine, RolloutTask, RolloutLog, add_rollout_arguments
+import cocoa.options
 
 from core.scenario import Scenario
 from core.controller import Controller
-from systems import add_system_arguments, get_system
+from systems import get_system
+import options
 
-def generate_examples(agents, agent_names, scenarios, num_examples, max_turns):
-    examples = []
+def generate_tasks(agent_names, scenarios, num_examples, offset=0):
+    tasks = []
     for i in range(num_examples):
-        scenario = scenarios[i % len(scenarios)]
+        scenario_index = i % len(scenarios)
         # Each agent needs to play both buyer and seller
         for j in (0, 1):
-            new_agents = [agents[j], agents[1-j]]
-            new_agent_names = [agent_names[j], agent_names[1-j]]
-            sessions = [new_agents[0].new_session(0, scenario.kbs[0]),
-                    new_agents[1].new_session(1, scenario.kbs[1])]
-            controller = Controller(scenario, sessions, session_names=new_agent_names)
-            ex = controller.simulate(max_turns, verbose=args.verbose)
-            examples.append(ex)
-    return examples
+            new_agent_names = (agent_names[j], agent_names[1-j])
+            tasks.append(RolloutTask(offset + len(tasks), scenario_index, new_agent_names, new_agent_names))
+    return tasks
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(conflict_handler='resolve')
@@ -37,29 +35,41 @@ if __name__ == '__main__':
     parser.add_argument('--max-turns', default=20, type=int, help='Maximum number of turns')
     parser.add_argument('--num-examples', type=int)
     parser.add_argument('--examples-path')
+    parser.add_argument('--random-seed', help='Random seed', type=int, default=1)
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='whether or not to have verbose prints')
-    add_scenario_arguments(parser)
-    add_system_arguments(parser)
+    add_rollout_arguments(parser)
+    cocoa.options.add_scenario_arguments(parser)
+    options.add_system_arguments(parser)
     args = parser.parse_args()
+    if args.random_seed:
+        random.seed(args.random_seed)
+        np.random.seed(args.random_seed)
 
     schema = Schema(args.schema_path)
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
 
-    agents = {}
+    system_specs = {}
     for agent_params in args.agent:
         agent_type, model_path, agent_name = agent_params
-        agents[agent_name] = get_system(agent_type, args, schema, model_path=model_path)
+        system_specs[agent_name] = (agent_type, model_path)
 
     scenarios = scenario_db.scenarios_list
-    examples = []
+    tasks = []
     for base_agent_name in ('sl-words',):
-        base_agent = agents[base_agent_name]
-        for agent_name, agent in agents.iteritems():
+        for agent_name in system_specs:
             if agent_name != base_agent_name:
-                agents = [base_agent, agent]
                 agent_names = [base_agent_name, agent_name]
-                examples.extend(generate_examples(agents, agent_names, scenarios, args.num_examples, args.max_turns))
-
-    with open(args.examples_path, 'w') as out:
-        print >>out, json.dumps([e.to_dict() for e in examples])
+                tasks.extend(generate_tasks(agent_names, scenarios, args.num_examples, offset=len(tasks)))
 
+    engine = RolloutEngine(partial(get_system, args=args, schema=schema), system_specs,
+            scenarios, Controller,
+            num_workers=args.num_workers, chunk_size=args.chunk_size,
+            max_turns=args.max_turns, seed=args.random_seed, verbose=args.verbose)
+    # Arguments that determine the tasks and dialogues of a run (checked on --resume)
+    run_args = {k: getattr(args, k) for k in ('random_seed', 'agent', 'num_examples', 'scenarios_path', 'max_turns')}
+    with TranscriptWriter(args.examples_path, resume=args.resume) as writer, \
+            RolloutLog(args.examples_path, run_args, writer.last_uuid, resume=args.resume) as log:
+        tasks = log.remaining_tasks(tasks)
+        for i, ex, complete in engine.run(tasks):
+            log.add(i, ex['uuid'])
+            writer.write(ex)
@@ -4,12 +4,14 @@ Takes two agent implementations and generates the dialogues.
 
 import argparse
 import random
-import json
+from functools import partial
 import numpy as np
 
 from cocoa.core.util import read_json
 from cocoa.core.schema import Schema
 from cocoa.core.scenario_db import ScenarioDB
+from cocoa.core.dataset import TranscriptWriter
+from cocoa.core.rollout import RolloutEngine, RolloutTask, RolloutLog, add_rollout_arguments
 import cocoa.options
 
 from core.scenario import Scenario
@@ -17,27 +19,27 @@ from core.controller import Controller
 from systems import get_system
 import options
 
-def generate_examples(num_examples, scenario_db, examples_path, max_examples, remove_fail, max_turns):
-    examples = []
+def generate_examples(engine, num_examples, scenario_db, examples_path, max_examples, remove_fail, run_args, resume=False):
     num_failed = 0
     scenarios = scenario_db.scenarios_list
     #scenarios = [scenario_db.scenarios_map['S_8COuPdjZZkYgrzhb']]
     #random.shuffle(scenarios)
-    for i in range(max_examples):
-        scenario = scenarios[num_examples % len(scenarios)]
-        sessions = [agents[0].new_session(0, scenario.kbs[0]), agents[1].new_session(1, scenario.kbs[1])]
-        controller = Controller(scenario, sessions)
-        ex = controller.simulate(max_turns, verbose=args.verbose)
-        if not controller.complete():
-            num_failed += 1
-            if remove_fail:
-                continue
-        examples.append(ex)
-        num_examples += 1
-    with open(examples_path, 'w') as out:
-        print >>out, json.dumps([e.to_dict() for e in examples])
+    tasks = [RolloutTask(i, (num_examples + i) % len(scenarios), (0, 1), None)
+            for i in range(max_examples)]
+    with TranscriptWriter(examples_path, resume=resume) as writer, \
+            RolloutLog(examples_path, run_args, writer.last_uuid, resume=resume) as log:
+        tasks = log.remaining_tasks(tasks)
+        for i, ex, complete in engine.run(tasks):
+            if not complete:
+                num_failed += 1
+                if remove_fail:
+                    log.add(i, None)
+                    continue
+            log.add(i, ex['uuid'])
+            writer.write(ex)
+        num_written = writer.num_written
     if num_failed == 0:
-        print 'All {} dialogues succeeded!'.format(num_examples)
+        print 'All {} dialogues succeeded!'.format(num_written)
     else:
         print 'Number of failed dialogues:', num_failed
 
@@ -54,6 +56,7 @@ if __name__ == '__main__':
     parser.add_argument('--max-examples', default=20, type=int,
             help='Number of test examples to predict')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='whether or not to have verbose prints')
+    add_rollout_arguments(parser)
     cocoa.options.add_scenario_arguments(parser)
     cocoa.options.add_dataset_arguments(parser)
     options.add_system_arguments(parser)
@@ -66,8 +69,15 @@ if __name__ == '__main__':
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
 
     assert len(args.agent_checkpoints) == len(args.agents)
-    agents = [get_system(name, args, schema, model_path=model_path)
-            for name, model_path in zip(args.agents, args.agent_checkpoints)]
+    system_specs = {i: (name, model_path)
+            for i, (name, model_path) in enumerate(zip(args.agents, args.agent_checkpoints))}
+    engine = RolloutEngine(partial(get_system, args=args, schema=schema), system_specs,
+            scenario_db.scenarios_list, Controller,
+            num_workers=args.num_workers, chunk_size=args.chunk_size,
+            max_turns=args.max_turns, seed=args.random_seed, verbose=args.verbose)
     num_examples = args.scenario_offset
 
-    generate_examples(num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, args.max_turns)
+    # Arguments that determine the tasks and dialogues of a run (checked on --resume)
+    run_args = {k: getattr(args, k) for k in ('random_seed', 'agents', 'agent_checkpoints',
+        'scenario_offset', 'scenarios_path', 'remove_fail', 'max_turns')}
+    generate_examples(engine, num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, run_args, resume=args.resume)
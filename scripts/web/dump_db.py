@@ -70,6 +70,7 @@ if __name__ == "__main__":
     add_scenario_arguments(parser)
     parser.add_argument('--db', type=str, required=True, help='Path to database file containing logged events')
     parser.add_argument('--output', type=str, required=True, help='File to write JSON examples to.')
+    parser.add_argument('--columnar', action='store_true', help='Write examples to a columnar directory at --output instead of a JSON file.')
     parser.add_argument('--uid', type=str, nargs='*', help='Only print chats from these uids')
     parser.add_argument('--surveys', type=str, help='If provided, writes a file containing results from user surveys.')
     parser.add_argument('--batch-results', type=str, help='If provided, write a mapping from chat_id to worker_id')
@@ -80,7 +81,7 @@ if __name__ == "__main__":
     conn = sqlite3.connect(args.db)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    DatabaseReader.dump_chats(cursor, scenario_db, args.output, args.uid)
+    DatabaseReader.dump_chats(cursor, scenario_db, args.output, args.uid, columnar=args.columnar)
     if args.surveys:
         DatabaseReader.dump_surveys(cursor, args.surveys)
     # TODO: move this to db_reader
@@ -0,0 +1,136 @@
+'''
+Simulate concurrent chat clients against a running chat server and report server throughput.
+
+In `poll` mode every client polls /_check_inbox/ like chat.html does without push_events.
+In `push` mode clients receive events over socket.io (requires socketIO-client) and only
+poll /_check_chat_valid/; the server must be started with "push_events": true.
+'''
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib
+import urllib2
+import numpy as np
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.num_errors = 0
+        self.num_events = 0
+
+    def add_request(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def add_error(self):
+        with self.lock:
+            self.num_errors += 1
+
+    def add_event(self):
+        with self.lock:
+            self.num_events += 1
+
+
+class Client(threading.Thread):
+    def __init__(self, base_url, userid, args, stats):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.base_url = base_url
+        self.userid = userid
+        self.args = args
+        self.stats = stats
+
+    def get(self, route, **params):
+        params['uid'] = self.userid
+        url = '{}/{}?{}'.format(self.base_url, route, urllib.urlencode(params))
+        start = time.time()
+        try:
+            response = urllib2.urlopen(url, timeout=30).read()
+        except (urllib2.URLError, IOError):
+            self.stats.add_error()
+            return None
+        self.stats.add_request(time.time() - start)
+        return response
+
+    def receive(self, response):
+        if response is not None and json.loads(response).get('received'):
+            self.stats.add_event()
+
+    def run(self):
+        # Create the user (the server pairs it with a partner) and enter the chat
+        self.get('')
+        self.get('_connect/')
+        self.get('_join_chat/')
+        if self.args.mode == 'push':
+            self.start_socket()
+
+        end_time = time.time() + self.args.duration
+        next_poll = next_valid_check = next_message = time.time()
+        while time.time() < end_time:
+            now = time.time()
+            if self.args.mode == 'poll' and now >= next_poll:
+                self.receive(self.get('_check_inbox/'))
+                next_poll = now + self.args.poll_interval
+            if now >= next_valid_check:
+                self.get('_check_chat_valid/')
+                next_valid_check = now + 3
+            if self.args.message_interval > 0 and now >= next_message:
+                self.get('_send_message/', message='hi, is this still available?', time_taken=1)
+                next_message = now + random.expovariate(1. / self.args.message_interval)
+            time.sleep(0.01)
+
+    def start_socket(self):
+        from socketIO_client import SocketIO, BaseNamespace
+        stats = self.stats
+        userid = self.userid
+
+        class ChatNamespace(BaseNamespace):
+            def on_connect(self):
+                self.emit('join', {'uid': userid})
+
+            def on_event(self, *args):
+                stats.add_event()
+
+        host, port = self.base_url.replace('http://', '').split(':')
+        socket = SocketIO(host, int(port))
+        socket.define(ChatNamespace, '/chat')
+        thread = threading.Thread(target=socket.wait)
+        thread.daemon = True
+        thread.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--num-chats', type=int, default=10, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=60, help='Number of seconds to run each client')
+    parser.add_argument('--mode', choices=['poll', 'push'], default='poll')
+    parser.add_argument('--poll-interval', type=float, default=1., help='Seconds between two inbox polls')
+    parser.add_argument('--message-interval', type=float, default=10.,
+                        help='Average seconds between two messages sent by a client (0 to never send)')
+    args = parser.parse_args()
+
+    base_url = 'http://{}:{}'.format(args.host, args.port)
+    stats = Stats()
+    clients = [Client(base_url, 'LOAD_{}_{}'.format(int(time.time()), i), args, stats)
+               for i in xrange(args.num_chats)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latencies = np.array(stats.latencies)
+    print 'mode={} chats={} duration={:.1f}s'.format(args.mode, args.num_chats, elapsed)
+    print 'requests: {} ({:.1f} req/s), errors: {}'.format(len(latencies), len(latencies) / elapsed, stats.num_errors)
+    if len(latencies) > 0:
+        print 'latency: mean={:.1f}ms p50={:.1f}ms p95={:.1f}ms'.format(
+            np.mean(latencies) * 1000, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000)
+    print 'events received: {}'.format(stats.num_events)
@@ -0,0 +1,52 @@
+'''
+Convert JSON / JSON-lines examples to a columnar directory (see cocoa.core.columnar),
+which can then be passed as --train-examples-paths / --test-examples-paths.
+'''
+
+import argparse
+import time
+
+from cocoa.core.dataset import iter_examples
+from cocoa.core.columnar import ColumnarWriter, ColumnarDataset
+
+from core.scenario import Scenario
+
+def check_round_trip(paths, output):
+    '''
+    Check that stored examples convert back to the same dicts as Example.to_dict,
+    both through get_raw and through the Example objects.
+    Return the number of different examples.
+    '''
+    dataset = ColumnarDataset(output, Scenario)
+    num_diffs = 0
+    i = 0
+    for path in paths:
+        for ex in iter_examples(path, Scenario):
+            expected = ex.to_dict()
+            if dataset.get_raw(i) != expected or dataset[i].to_dict() != expected:
+                num_diffs += 1
+                print 'Example {} ({}) is different after conversion'.format(i, expected['uuid'])
+            i += 1
+    if i != len(dataset):
+        print 'Converted {} examples, read {}'.format(len(dataset), i)
+        num_diffs += abs(len(dataset) - i)
+    dataset.close()
+    return num_diffs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--examples-paths', nargs='+', required=True, help='JSON or JSON-lines transcripts')
+    parser.add_argument('--output', required=True, help='Output directory')
+    parser.add_argument('--check', action='store_true', help='Check that the examples round-trip unchanged')
+    args = parser.parse_args()
+
+    start = time.time()
+    with ColumnarWriter(args.output) as writer:
+        for path in args.examples_paths:
+            for ex in iter_examples(path, Scenario):
+                writer.add(ex)
+    print 'Converted {} examples in {:.1f}s'.format(len(writer.event_offsets) - 1, time.time() - start)
+
+    if args.check:
+        num_diffs = check_round_trip(args.examples_paths, args.output)
+        print '{} examples are different after conversion'.format(num_diffs)